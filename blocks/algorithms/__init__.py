@@ -7,12 +7,16 @@ from six.moves import reduce
 
 from picklable_itertools.extras import equizip
 
+import numpy
 import theano
 from six import add_metaclass
 from theano import tensor
 
+from blocks.algorithms.schedules import (Schedule, schedule_updates,
+                                         schedule_value)
 from blocks.graph import ComputationGraph
-from blocks.utils import dict_subset, named_copy, pack, shared_floatx
+from blocks.utils import (dict_subset, is_shared_variable, named_copy, pack,
+                          shared_floatx)
 from blocks.theano_expressions import l2_norm
 
 logger = logging.getLogger(__name__)
@@ -177,6 +181,53 @@ class GradientDescent(DifferentiableCostMinimizer):
         sub-expressions and would like Theano to use that information
         to compute parameter gradients. Only makes sense when `gradients`
         is `None`.
+    flat_buffers : bool, optional
+        If ``True``, the gradients of all the parameters of the same
+        data type are concatenated into a single vector, and the step
+        rule is applied to it as if it were a single parameter. A
+        stateful step rule then keeps its state (e.g. the moments of
+        :class:`Adam`) in one contiguous buffer per data type, and
+        computes the steps with a few large operations instead of a few
+        small ones for every parameter. Only step rules that treat the
+        elements of the steps independently of the shapes of the
+        parameters and of which parameter they belong to can be used this
+        way; :class:`VariableClipping`, :class:`RemoveNotFinite` and
+        :class:`Restrict` raise a :class:`ValueError`.
+        ``False`` by default.
+    sparse_updates : bool, optional
+        If ``True``, the parameters that the cost only uses by selecting
+        some of their rows, like the weights of a :class:`.LookupTable`,
+        are updated row-wise: the step rule is only applied to the rows
+        selected in the batch, and only these rows of the parameters and
+        of the parameter-shaped states of the step rule are updated. The
+        gradients for rows selected several times are summed first. The
+        other rows keep their state, so that e.g. the moments of
+        :class:`Adam` are only decayed when their rows are used. The
+        step rule must not keep a state computed from the gradients that
+        does not have the shape of its parameter, like the factored
+        states of :class:`RMSProp` and :class:`Adam`. Requires the
+        gradients to be taken automatically. ``False`` by default.
+    master_dtype : str, optional
+        If given, a master copy of this data type is kept for every
+        parameter of a different data type, e.g. a ``'float32'`` copy
+        of the parameters stored in a reduced precision (see the
+        `param_dtype` argument of :class:`.Initializable`). The
+        gradients are cast to this data type, the step rule is applied
+        to the master copies, and the parameters are set to the rounded
+        updated master copies, so that small steps are not lost to
+        rounding.
+    loss_scale : float, optional
+        If given, the cost is multiplied by this factor before it is
+        differentiated, and the gradients are divided by it again after
+        they are cast to the data type of the master copies. This keeps
+        small gradients from underflowing in a reduced precision.
+        Requires the gradients to be taken automatically.
+    theano_func_kwargs : dict, optional
+        Keyword arguments passed to :func:`theano.function` when the
+        training function is compiled. For instance, a `mode` with a
+        linker that does not collect garbage, e.g.
+        ``theano.Mode(linker='cvm_nogc')``, makes the function reuse the
+        storage of its intermediate results between calls.
 
     Attributes
     ----------
@@ -184,56 +235,661 @@ class GradientDescent(DifferentiableCostMinimizer):
         The gradient dictionary.
     step_rule : instance of :class:`StepRule`
         The step rule.
+    sparse_indices : OrderedDict
+        The distinct row indices selected in a batch, in increasing
+        order, for every parameter updated row-wise. The steps for these
+        parameters are given for the selected rows only, in the same
+        order.
+    masters : OrderedDict
+        The master copies of the parameters that have one.
+    loss_scale : :class:`~tensor.TensorSharedVariable`
+        The shared variable storing the loss scale, or ``None`` if the
+        loss is not scaled.
+    step_rule_state_memory : int
+        The number of bytes taken by the state of the step rule.
+
+    Notes
+    -----
+    The master copies are made from the values of the parameters when
+    the algorithm is constructed. :meth:`initialize` makes them again
+    for the parameters that were changed since, e.g. loaded from a file
+    before training starts, so that they are not overwritten by stale
+    master copies. Master copies that round to the values of their
+    parameters, e.g. restored from a dump, keep their precision. If the
+    parameters are changed after the training function is compiled, call
+    :meth:`reset_master_copies`.
+
+    The names and types of the inputs of the training function are
+    computed once by :meth:`initialize`. The data of a batch that are
+    arrays of exactly the input types are then passed to the compiled
+    function without it checking or converting them again, which makes
+    a difference when the model is small.
 
     """
     def __init__(self, step_rule=None, gradients=None, known_grads=None,
-                 **kwargs):
+                 flat_buffers=False, sparse_updates=False, master_dtype=None,
+                 loss_scale=None, theano_func_kwargs=None, **kwargs):
         if gradients:
             kwargs.setdefault("params", gradients.keys())
         super(GradientDescent, self).__init__(**kwargs)
 
+        self.theano_func_kwargs = (theano_func_kwargs
+                                   if theano_func_kwargs else {})
+        self.masters = OrderedDict()
+        if master_dtype:
+            for param in self.params:
+                if param.dtype != master_dtype:
+                    name = param.name + '_master' if param.name else None
+                    self.masters[param] = theano.shared(
+                        param.get_value().astype(master_dtype), name=name)
+        self.loss_scale = None
+        if loss_scale is not None:
+            if gradients:
+                raise ValueError("loss scaling requires the gradients to "
+                                 "be taken automatically")
+            self.loss_scale = shared_floatx(loss_scale, name='loss_scale')
+            if known_grads:
+                known_grads = OrderedDict(
+                    (variable, gradient * tensor.cast(self.loss_scale,
+                                                      gradient.dtype))
+                    for variable, gradient in known_grads.items())
+
         self.gradients = gradients
+        self.sparse_indices = OrderedDict()
+        self._row_gradients = OrderedDict()
+        if sparse_updates:
+            if gradients:
+                raise ValueError("sparse updates require the gradients to "
+                                 "be taken automatically")
+            if flat_buffers:
+                raise ValueError("sparse updates can not be combined with "
+                                 "flat buffers")
         if not self.gradients:
             logger.info("Taking the cost gradient")
-            self.gradients = dict(
-                equizip(self.params, tensor.grad(self.cost, self.params,
-                                                 known_grads=known_grads)))
+            if sparse_updates:
+                self._take_sparse_gradients(known_grads)
+            else:
+                gradients = tensor.grad(self._scaled_cost(), self.params,
+                                        known_grads=known_grads)
+                self.gradients = dict(
+                    (param, self._unscale(gradient, param))
+                    for param, gradient in equizip(self.params, gradients))
             logger.info("The cost gradient computation graph is built")
         else:
             if known_grads:
                 raise ValueError("known_grads has no effect when gradients "
                                  "are passed in")
+            if self.masters:
+                self.gradients = OrderedDict(
+                    (param, self._unscale(gradient, param))
+                    for param, gradient in self.gradients.items())
         self.step_rule = step_rule if step_rule else Scale()
 
-        self.total_gradient_norm = named_copy(l2_norm(self.gradients.values()),
-                                              "total_gradient_norm")
-        self.steps, self.step_rule_updates = (
-            self.step_rule.compute_steps(self.gradients))
-        self.total_step_norm = named_copy(l2_norm(self.steps.values()),
-                                          "total_step_norm")
+        self.total_gradient_norm = named_copy(
+            l2_norm(self._norm_terms(self.gradients, self._row_gradients)),
+            "total_gradient_norm")
+        # The step rule is given the gradients in the order of the
+        # parameters, which makes the order of its updates reproducible.
+        self.flat_buffers = flat_buffers
+        if flat_buffers:
+            self.steps, self.step_rule_updates = self._compute_flat_steps()
+        elif self.sparse_indices or self.masters:
+            self.steps, self.step_rule_updates = (
+                self._compute_replaced_steps())
+        else:
+            self.steps, self.step_rule_updates = (
+                self.step_rule.compute_steps(OrderedDict(
+                    (param, self.gradients[param]) for param in self.params)))
+        self.total_step_norm = named_copy(
+            l2_norm(self._norm_terms(self.steps, self.steps)),
+            "total_step_norm")
+        self.step_rule_updates += schedule_updates(
+            list(self.steps.values()) +
+            [update for _, update in self.step_rule_updates],
+            updated=[variable for variable, _ in self.step_rule_updates])
+
+    @property
+    def step_rule_state_memory(self):
+        return sum(variable.get_value(borrow=True).nbytes
+                   for variable, _ in self.step_rule_updates)
+
+    def _master(self, param):
+        return self.masters.get(param, param)
+
+    def _scaled_cost(self):
+        if self.loss_scale is None:
+            return self.cost
+        return self.cost * tensor.cast(self.loss_scale, self.cost.dtype)
+
+    def _unscale(self, gradient, param):
+        """Cast a gradient to the precision of the master copy."""
+        gradient = tensor.cast(gradient, self._master(param).dtype)
+        if self.loss_scale is not None:
+            gradient = gradient / tensor.cast(self.loss_scale,
+                                              gradient.dtype)
+        return gradient
+
+    def reset_master_copies(self, only_stale=False):
+        """Copy the values of the parameters to their master copies.
+
+        Parameters
+        ----------
+        only_stale : bool, optional
+            If ``True``, the master copies that round to the values of
+            their parameters are kept. ``False`` by default.
+
+        """
+        for param, master in self.masters.items():
+            value = param.get_value()
+            if only_stale and numpy.array_equal(
+                    master.get_value().astype(value.dtype), value):
+                continue
+            master.set_value(value.astype(master.dtype))
+
+    def _take_sparse_gradients(self, known_grads):
+        """Take the gradients with respect to the selected rows.
+
+        The parameters that are only used through
+        :class:`~theano.tensor.subtensor.AdvancedSubtensor1` operations
+        are differentiated with respect to the outputs of these
+        operations instead.
+
+        """
+        lookups = OrderedDict((param, []) for param in self.params)
+        for variable in self._cost_computation_graph.variables:
+            if not variable.owner:
+                continue
+            for i, input_ in enumerate(variable.owner.inputs):
+                if input_ in lookups and lookups[input_] is not None:
+                    if (isinstance(variable.owner.op,
+                                   tensor.subtensor.AdvancedSubtensor1) and
+                            i == 0):
+                        lookups[input_].append(variable)
+                    else:
+                        lookups[input_] = None
+        dense_params = [param for param in self.params
+                        if not lookups[param]]
+        selections = [variable for param in self.params
+                      if lookups[param] for variable in lookups[param]]
+        gradients = tensor.grad(self._scaled_cost(),
+                                dense_params + selections,
+                                known_grads=known_grads)
+        self.gradients = dict(
+            (param, self._unscale(gradient, param)) for param, gradient
+            in equizip(dense_params, gradients[:len(dense_params)]))
+        selection_gradients = dict(equizip(selections,
+                                           gradients[len(dense_params):]))
+        for param in self.params:
+            if not lookups[param]:
+                continue
+            indices = tensor.concatenate(
+                [variable.owner.inputs[1] for variable in lookups[param]])
+            rows = tensor.concatenate(
+                [self._unscale(selection_gradients[variable], param)
+                 for variable in lookups[param]])
+            # Rows selected several times get the sum of their gradients:
+            # the indices are sorted, and the gradients of every run of
+            # equal indices are summed into a row of a compact buffer
+            order = tensor.argsort(indices)
+            sorted_indices = indices[order]
+            starts = tensor.cast(tensor.concatenate(
+                [tensor.ones((1,), dtype='int8'),
+                 tensor.neq(sorted_indices[1:], sorted_indices[:-1])]),
+                'int64')
+            runs = tensor.extra_ops.cumsum(starts) - 1
+            unique_indices = sorted_indices[starts.nonzero()[0]]
+            self.sparse_indices[param] = unique_indices
+            self._row_gradients[param] = tensor.inc_subtensor(
+                tensor.zeros_like(rows)[:unique_indices.shape[0]][runs],
+                rows[order])
+            self.gradients[param] = tensor.inc_subtensor(
+                tensor.zeros_like(self._master(param))[indices], rows)
+
+    def _norm_terms(self, values, row_values):
+        """Terms for the norm, using the selected rows when possible."""
+        terms = []
+        for param in self.params:
+            if param in self.sparse_indices:
+                terms.append(row_values[param])
+            else:
+                terms.append(values[param])
+        return terms
+
+    def _compute_replaced_steps(self):
+        """Apply the step rule to the master copies and selected rows.
+
+        The step rule is given placeholders for the gradients, so that
+        the parameters can be replaced by their master copies, and for
+        parameters updated row-wise, the parameters and the states of the
+        step rule by their selected rows, in the expressions it builds,
+        but not in the gradients themselves.
+
+        """
+        placeholders = OrderedDict()
+        replacements = OrderedDict()
+        for param in self.params:
+            gradient = self._row_gradients.get(param, self.gradients[param])
+            placeholder = gradient.type()
+            placeholders[param] = placeholder
+            replacements[placeholder] = gradient
+        steps, updates = self.step_rule.compute_steps(placeholders)
+        for param, master in self.masters.items():
+            replacements[param] = master
+        row_states = OrderedDict()
+        for param, indices in self.sparse_indices.items():
+            replacements[param] = self._master(param)[indices]
+            shape = param.get_value().shape
+            for state, update in updates:
+                if (placeholders[param] not in
+                        theano.gof.graph.ancestors([update])):
+                    continue
+                if (state.ndim != param.ndim or
+                        state.get_value().shape != shape):
+                    raise ValueError("the state {} of the step rule depends "
+                                     "on the gradient of {} but does not "
+                                     "have its shape, e.g. because it is "
+                                     "factored, so it can not be updated "
+                                     "row-wise".format(state, param))
+                if state in row_states:
+                    raise ValueError("can not tell to which parameter the "
+                                     "state {} of the step rule belongs"
+                                     .format(state))
+                row_states[state] = param
+                replacements[state] = state[indices]
+        outputs = theano.clone(
+            list(steps.values()) + [update for _, update in updates],
+            replace=replacements)
+        steps = OrderedDict(equizip(steps.keys(), outputs[:len(steps)]))
+        row_updates = []
+        for (state, _), update in equizip(updates, outputs[len(steps):]):
+            if state in row_states:
+                update = tensor.set_subtensor(
+                    state[self.sparse_indices[row_states[state]]], update)
+            row_updates.append((state, update))
+        return steps, row_updates
+
+    def _increment_rows(self, param, variable, increment):
+        """Increment the rows of a variable selected in the batch."""
+        return tensor.inc_subtensor(variable[self.sparse_indices[param]],
+                                    increment)
+
+    def _compute_flat_steps(self):
+        """Apply the step rule to the concatenated gradients.
+
+        The step rule is given a symbolic placeholder for every group of
+        parameters with the same data type, which is replaced by the
+        concatenation of the parameters in the resulting expressions. The
+        size of the group is stored in the ``shape`` tag of the
+        placeholder, from which :func:`_shared_state` allocates the
+        states of the step rule.
+
+        """
+        _check_elementwise(self.step_rule)
+        groups = OrderedDict()
+        for param in self.params:
+            groups.setdefault(self._master(param).dtype, []).append(param)
+        flat_gradients = OrderedDict()
+        replacements = OrderedDict()
+        for dtype, params in groups.items():
+            size = sum(param.get_value().size for param in params)
+            flat_param = tensor.vector('flat_params_' + dtype, dtype=dtype)
+            flat_param.tag.shape = (size,)
+            flat_gradients[flat_param] = tensor.concatenate(
+                [self.gradients[param].flatten() for param in params])
+            replacements[flat_param] = tensor.concatenate(
+                [self._master(param).flatten() for param in params])
+        flat_steps, updates = self.step_rule.compute_steps(flat_gradients)
+        outputs = theano.clone(
+            list(flat_steps.values()) + [update for _, update in updates],
+            replace=replacements)
+        flat_steps = dict(equizip(flat_steps.keys(),
+                                  outputs[:len(flat_steps)]))
+        updates = list(equizip([variable for variable, _ in updates],
+                               outputs[len(flat_steps):]))
+        steps = OrderedDict()
+        for flat_param, params in equizip(flat_gradients.keys(),
+                                          groups.values()):
+            offset = 0
+            for param in params:
+                size = param.get_value().size
+                steps[param] = flat_steps[flat_param][
+                    offset:offset + size].reshape(param.shape)
+                offset += size
+        return OrderedDict((param, steps[param])
+                           for param in self.params), updates
 
     def initialize(self):
         logger.info("Initializing the training algorithm")
+        self.reset_master_copies(only_stale=True)
         all_updates = self.updates
         # Note: the gradients are computed in the same order in which
         # the parameters were given. Keep it like that to ensure
         # reproducibility.
         for param in self.params:
-            all_updates.append((param, param - self.steps[param]))
+            master = self._master(param)
+            if param in self.sparse_indices:
+                all_updates.append((master, self._increment_rows(
+                    param, master, -self.steps[param])))
+                if param in self.masters:
+                    indices = self.sparse_indices[param]
+                    all_updates.append((param, tensor.set_subtensor(
+                        param[indices],
+                        tensor.cast(master[indices] - self.steps[param],
+                                    param.dtype))))
+            else:
+                update = master - self.steps[param]
+                all_updates.append((master,
+                                    tensor.cast(update, master.dtype)))
+                if param in self.masters:
+                    all_updates.append((param,
+                                        tensor.cast(update, param.dtype)))
         all_updates += self.step_rule_updates
-        self._function = theano.function(self.inputs, [], updates=all_updates)
+        logger.info("The state of the step rule takes {} bytes".format(
+            self.step_rule_state_memory))
+        self._function = theano.function(self.inputs, [], updates=all_updates,
+                                         **self.theano_func_kwargs)
+        self._input_names = [v.name for v in self.inputs]
+        # Inputs with broadcastable dimensions need their shapes checked
+        self._input_types = [
+            (v.dtype, v.ndim) if not any(v.broadcastable) else None
+            for v in self.inputs]
         logger.info("The training algorithm is initialized")
 
     def process_batch(self, batch):
-        if not set(batch.keys()) == set([v.name for v in self.inputs]):
+        # The batch has the right sources iff it has as many as there are
+        # inputs and all the names of the inputs are among them
+        try:
+            if len(batch) != len(self._input_names):
+                raise KeyError
+            ordered_batch = [batch[name] for name in self._input_names]
+        except KeyError:
             raise ValueError("mismatch of variable names and data sources" +
                              variable_mismatch_error.format(
                                  sources=batch.keys(),
-                                 variables=[v.name for v in self.inputs]))
-        ordered_batch = [batch[v.name] for v in self.inputs]
+                                 variables=self._input_names))
+        trust_input = True
+        for value, input_type in zip(ordered_batch, self._input_types):
+            if (input_type is None or
+                    type(value) is not numpy.ndarray or
+                    (value.dtype, value.ndim) != input_type):
+                trust_input = False
+                break
+        self._function.trust_input = trust_input
         self._function(*ordered_batch)
 
 
+class LBFGS(DifferentiableCostMinimizer):
+    """Minimizes the cost with the limited-memory BFGS method.
+
+    Every call of :meth:`process_batch` makes one step of L-BFGS on the
+    batch, so that a main loop iterating over a data stream that yields
+    the whole dataset (or large chunks of it) as single batches makes
+    one step per iteration. The step direction is computed from the
+    history of parameter and gradient changes by the two-loop recursion,
+    and its length by a backtracking line search that ensures a
+    sufficient decrease of the cost (the Armijo condition). The
+    parameters are handled as a single flat vector in NumPy.
+
+    Parameters
+    ----------
+    history : int, optional
+        The number of past steps used to approximate the inverse
+        Hessian. Defaults to 10.
+    max_line_search_steps : int, optional
+        The maximum number of times the step is shrunk during the line
+        search. If no sufficient decrease is found, the parameters are
+        not changed and the history is cleared. Defaults to 20.
+    shrink : float, optional
+        The factor by which the step is shrunk during the line search.
+        Defaults to 0.5.
+    sufficient_decrease : float, optional
+        The fraction of the decrease predicted by the gradient that a
+        step must achieve to be accepted. Defaults to 1e-4.
+
+    Attributes
+    ----------
+    cost_value : float
+        The cost at the parameters before the last step.
+    gradient_norm : float
+        The L2 norm of the gradient at the parameters before the last
+        step.
+    step_length : float
+        The length of the last step relative to the one proposed, 0 if
+        no step was taken.
+
+    Notes
+    -----
+    The updates of the algorithm (see :meth:`add_updates`) are done once
+    per step, when the cost is computed at the current parameters; the
+    cost evaluations of the line search do not do them. Since the
+    history relies on the gradients of successive steps being
+    comparable, the batches should be large enough for the cost to
+    change little between them.
+
+    """
+    def __init__(self, history=10, max_line_search_steps=20, shrink=0.5,
+                 sufficient_decrease=1e-4, **kwargs):
+        super(LBFGS, self).__init__(**kwargs)
+        self.history = history
+        self.max_line_search_steps = max_line_search_steps
+        self.shrink = shrink
+        self.sufficient_decrease = sufficient_decrease
+        self._gradients = tensor.grad(self.cost, self.params)
+        self._parameter_changes = []
+        self._gradient_changes = []
+        self.cost_value = None
+        self.gradient_norm = None
+        self.step_length = None
+
+    def initialize(self):
+        logger.info("Initializing the training algorithm")
+        outputs = [self.cost] + self._gradients
+        self._function = theano.function(self.inputs, outputs,
+                                         updates=self.updates)
+        self._evaluate = theano.function(self.inputs, outputs)
+        self._input_names = [v.name for v in self.inputs]
+        logger.info("The training algorithm is initialized")
+
+    def _get_flat_params(self):
+        return numpy.concatenate([param.get_value().ravel()
+                                  for param in self.params])
+
+    def _set_flat_params(self, value):
+        offset = 0
+        for param in self.params:
+            old_value = param.get_value()
+            param.set_value(
+                value[offset:offset + old_value.size].reshape(
+                    old_value.shape).astype(old_value.dtype))
+            offset += old_value.size
+
+    def _flat_cost_and_gradient(self, function, ordered_batch):
+        outputs = function(*ordered_batch)
+        return (float(outputs[0]),
+                numpy.concatenate([gradient.ravel()
+                                   for gradient in outputs[1:]]))
+
+    def _direction(self, gradient):
+        """Multiply the gradient by the approximate inverse Hessian."""
+        direction = -gradient
+        alphas = []
+        for s, y in reversed(list(zip(self._parameter_changes,
+                                      self._gradient_changes))):
+            alpha = s.dot(direction) / y.dot(s)
+            direction -= alpha * y
+            alphas.append(alpha)
+        if self._parameter_changes:
+            s, y = self._parameter_changes[-1], self._gradient_changes[-1]
+            direction *= s.dot(y) / y.dot(y)
+        for (s, y), alpha in zip(zip(self._parameter_changes,
+                                     self._gradient_changes),
+                                 reversed(alphas)):
+            beta = y.dot(direction) / y.dot(s)
+            direction += (alpha - beta) * s
+        return direction
+
+    def process_batch(self, batch):
+        try:
+            if len(batch) != len(self._input_names):
+                raise KeyError
+            ordered_batch = [batch[name] for name in self._input_names]
+        except KeyError:
+            raise ValueError("mismatch of variable names and data sources" +
+                             variable_mismatch_error.format(
+                                 sources=batch.keys(),
+                                 variables=self._input_names))
+        params = self._get_flat_params()
+        cost, gradient = self._flat_cost_and_gradient(self._function,
+                                                      ordered_batch)
+        self.cost_value = cost
+        self.gradient_norm = numpy.sqrt(gradient.dot(gradient))
+        self.step_length = 0.
+        if not self.gradient_norm:
+            return
+        direction = self._direction(gradient)
+        slope = gradient.dot(direction)
+        if slope >= 0:
+            # Not a descent direction, start over from the gradient
+            del self._parameter_changes[:], self._gradient_changes[:]
+            direction = -gradient
+            slope = -self.gradient_norm ** 2
+        step_length = 1.
+        if not self._parameter_changes:
+            step_length = min(1., 1. / numpy.abs(gradient).sum())
+        for _ in range(self.max_line_search_steps + 1):
+            new_params = params + step_length * direction
+            self._set_flat_params(new_params)
+            new_cost, new_gradient = self._flat_cost_and_gradient(
+                self._evaluate, ordered_batch)
+            if (numpy.isfinite(new_cost) and new_cost <= cost +
+                    self.sufficient_decrease * step_length * slope):
+                break
+            step_length *= self.shrink
+        else:
+            logger.warning("The line search failed, the parameters are "
+                           "not changed")
+            self._set_flat_params(params)
+            del self._parameter_changes[:], self._gradient_changes[:]
+            return
+        self.step_length = step_length
+        parameter_change = new_params - params
+        gradient_change = new_gradient - gradient
+        # Only keep the pairs that keep the inverse Hessian approximation
+        # positive definite
+        if parameter_change.dot(gradient_change) > 1e-10:
+            self._parameter_changes.append(parameter_change)
+            self._gradient_changes.append(gradient_change)
+            if len(self._parameter_changes) > self.history:
+                del self._parameter_changes[0], self._gradient_changes[0]
+
+
+def _shared_state(param, name=None, dtype=None, shape=None):
+    """Allocate a zero-initialized state of a step rule.
+
+    Parameters
+    ----------
+    param : :class:`~tensor.TensorSharedVariable`
+        The parameter the state belongs to, or the placeholder of a flat
+        buffer of parameters, whose shape is given by its ``shape`` tag.
+    name : str, optional
+        The name of the state, suffixed by the name of the parameter.
+    dtype : str, optional
+        The data type the state is stored in. Defaults to ``floatX``.
+    shape : tuple, optional
+        The shape of the state. Defaults to the shape of the parameter.
+
+    """
+    if shape is None:
+        shape = (param.get_value(borrow=True).shape
+                 if is_shared_variable(param) else param.tag.shape)
+    if name and param.name:
+        name += '_' + param.name
+    return theano.shared(
+        numpy.zeros(shape, dtype=dtype if dtype else theano.config.floatX),
+        name=name)
+
+
+def _check_elementwise(step_rule):
+    """Check that a step rule can be applied to flat buffers.
+
+    Raises
+    ------
+    ValueError
+        If the step rule, or one of the rules it chains, depends on the
+        shapes of the parameters or on which parameter a step belongs to.
+
+    """
+    if isinstance(step_rule, CompositeRule):
+        for rule in step_rule.components:
+            _check_elementwise(rule)
+    elif isinstance(step_rule, (Restrict, VariableClipping,
+                                RemoveNotFinite)):
+        # On a flat buffer these would clip the norm of, or skip the
+        # steps of, all the parameters of a data type together
+        raise ValueError("{} can not be applied to flat buffers".format(
+            step_rule.__class__.__name__))
+
+
+def _factored_mean_square(param, previous_step, decay_rate, dtype=None):
+    """Keep a running average of the squared steps of a matrix factored.
+
+    Only the averages over the rows and over the columns are stored, and
+    the average of every element is estimated from their outer product,
+    as done by Adafactor [Shazeer2018]_.
+
+    .. [Shazeer2018] Noam Shazeer, Mitchell Stern, *Adafactor: Adaptive
+       Learning Rates with Sublinear Memory Cost*, arXiv:1804.04235.
+
+    Returns
+    -------
+    mean_square : :class:`~tensor.TensorVariable`
+        The estimate of the running average for the current step.
+    updates : list
+        The updates of the row and column averages.
+
+    """
+    rows, columns = param.get_value(borrow=True).shape
+    row_mean_square = _shared_state(param, 'row_mean_square', dtype,
+                                    (rows,))
+    column_mean_square = _shared_state(param, 'column_mean_square', dtype,
+                                       (columns,))
+    # The small constant keeps the estimate finite for zero steps
+    square = tensor.sqr(previous_step) + 1e-30
+    row_mean_square_t = (
+        decay_rate * tensor.cast(row_mean_square, previous_step.dtype) +
+        (1 - decay_rate) * square.mean(axis=1))
+    column_mean_square_t = (
+        decay_rate * tensor.cast(column_mean_square, previous_step.dtype) +
+        (1 - decay_rate) * square.mean(axis=0))
+    mean_square = (tensor.outer(row_mean_square_t, column_mean_square_t) /
+                   row_mean_square_t.mean())
+    updates = [(row_mean_square,
+                tensor.cast(row_mean_square_t, row_mean_square.dtype)),
+               (column_mean_square,
+                tensor.cast(column_mean_square_t, column_mean_square.dtype))]
+    return mean_square, updates
+
+
+def _running_mean_square(param, previous_step, decay_rate, dtype=None,
+                         factored=False, name='mean_square'):
+    """Keep a running average of the squared steps.
+
+    Returns the average for the current step and the updates, like
+    :func:`_factored_mean_square`, which is used for matrices if
+    `factored` is ``True``.
+
+    """
+    if factored and param.ndim == 2:
+        return _factored_mean_square(param, previous_step, decay_rate,
+                                     dtype)
+    mean_square = _shared_state(param, name, dtype)
+    mean_square_t = (
+        decay_rate * tensor.cast(mean_square, previous_step.dtype) +
+        (1 - decay_rate) * tensor.sqr(previous_step))
+    return mean_square_t, [(mean_square,
+                            tensor.cast(mean_square_t, mean_square.dtype))]
+
+
 @add_metaclass(ABCMeta)
 class StepRule(object):
     """A rule to compute steps for a gradient descent algorithm."""
@@ -329,18 +985,22 @@ class Scale(StepRule):
 
     Parameters
     ----------
-    learning_rate : float
+    learning_rate : float or :class:`.Schedule`
         The learning rate by which the previous step is multiplied to
         produce the step.
 
     Attributes
     ----------
     learning_rate : :class:`~tensor.TensorSharedVariable`
-        The shared variable storing the learning rate used.
+        The shared variable storing the learning rate used, or the value
+        of the schedule if one was given.
 
     """
     def __init__(self, learning_rate=1.0):
-        self.learning_rate = shared_floatx(learning_rate)
+        if isinstance(learning_rate, Schedule):
+            self.learning_rate = learning_rate.variable
+        else:
+            self.learning_rate = shared_floatx(learning_rate)
 
     def compute_step(self, param, previous_step):
         return self.learning_rate * previous_step, []
@@ -351,8 +1011,11 @@ class BasicMomentum(StepRule):
 
     Parameters
     ----------
-    momentum : float, optional
+    momentum : float or :class:`.Schedule`, optional
         The momentum coefficient. Defaults to 0.
+    state_dtype : str, optional
+        The data type the velocities are stored in, e.g. ``'float16'`` to
+        halve the memory they take. Defaults to ``floatX``.
 
     Notes
     -----
@@ -361,13 +1024,18 @@ class BasicMomentum(StepRule):
     experience, look at :class:`Momentum`.
 
     """
-    def __init__(self, momentum=0.):
-        self.momentum = shared_floatx(momentum)
+    def __init__(self, momentum=0., state_dtype=None):
+        if isinstance(momentum, Schedule):
+            self.momentum = momentum.variable
+        else:
+            self.momentum = shared_floatx(momentum)
+        self.state_dtype = state_dtype
 
     def compute_step(self, param, previous_step):
-        velocity = shared_floatx(param.get_value() * 0.)
-        step = self.momentum * velocity + previous_step
-        updates = [(velocity, step)]
+        velocity = _shared_state(param, 'velocity', self.state_dtype)
+        step = (self.momentum * tensor.cast(velocity, previous_step.dtype) +
+                previous_step)
+        updates = [(velocity, tensor.cast(step, velocity.dtype))]
         return step, updates
 
 
@@ -379,10 +1047,13 @@ class Momentum(CompositeRule):
 
     Parameters
     ----------
-    learning_rate : float, optional
+    learning_rate : float or :class:`.Schedule`, optional
         The learning rate by which the previous step scaled. Defaults to 1.
-    momentum : float, optional
+    momentum : float or :class:`.Schedule`, optional
         The momentum coefficient. Defaults to 0.
+    state_dtype : str, optional
+        The data type the velocities are stored in. Defaults to
+        ``floatX``.
 
     Attributes
     ----------
@@ -396,9 +1067,10 @@ class Momentum(CompositeRule):
     :class:`SharedVariableModifier`
 
     """
-    def __init__(self, learning_rate=1.0, momentum=0.):
+    def __init__(self, learning_rate=1.0, momentum=0., state_dtype=None):
         scale = Scale(learning_rate=learning_rate)
-        basic_momentum = BasicMomentum(momentum=momentum)
+        basic_momentum = BasicMomentum(momentum=momentum,
+                                       state_dtype=state_dtype)
         self.learning_rate = scale.learning_rate
         self.momentum = basic_momentum.momentum
         self.components = [scale, basic_momentum]
@@ -413,6 +1085,10 @@ class AdaDelta(StepRule):
         Decay rate in [0, 1]. Defaults to 0.95.
     epsilon : float, optional
         Stabilizing constant for RMS. Defaults to 1e-6.
+    state_dtype : str, optional
+        The data type the running averages are stored in, e.g.
+        ``'float16'`` to halve the memory they take. Defaults to
+        ``floatX``.
 
     Notes
     -----
@@ -422,33 +1098,35 @@ class AdaDelta(StepRule):
        Rate Method*, arXiv:1212.5701.
 
     """
-    def __init__(self, decay_rate=0.95, epsilon=1e-6):
+    def __init__(self, decay_rate=0.95, epsilon=1e-6, state_dtype=None):
         if not 0.0 <= decay_rate <= 1.0:
             raise ValueError("decay rate needs to be in [0, 1]")
         self.decay_rate = shared_floatx(decay_rate)
         self.epsilon = shared_floatx(epsilon)
+        self.state_dtype = state_dtype
 
     def compute_step(self, param, previous_step):
-        mean_square_step_tm1 = shared_floatx(param.get_value() * 0.)
-        mean_square_delta_x_tm1 = shared_floatx(param.get_value() * 0.)
-
-        mean_square_step_t = (
-            self.decay_rate * mean_square_step_tm1 +
-            (1 - self.decay_rate) * tensor.sqr(previous_step)
-        )
-
-        rms_delta_x_tm1 = tensor.sqrt(mean_square_delta_x_tm1 + self.epsilon)
+        mean_square_step_t, updates = _running_mean_square(
+            param, previous_step, self.decay_rate, self.state_dtype)
+        mean_square_delta_x_tm1 = _shared_state(
+            param, 'mean_square_delta_x', self.state_dtype)
+        mean_square_delta_x_tm1_value = tensor.cast(mean_square_delta_x_tm1,
+                                                    previous_step.dtype)
+
+        rms_delta_x_tm1 = tensor.sqrt(mean_square_delta_x_tm1_value +
+                                      self.epsilon)
         rms_step_t = tensor.sqrt(mean_square_step_t + self.epsilon)
         delta_x_t = rms_delta_x_tm1 / rms_step_t * previous_step
 
         mean_square_delta_x_t = (
-            self.decay_rate * mean_square_delta_x_tm1 +
+            self.decay_rate * mean_square_delta_x_tm1_value +
             (1 - self.decay_rate) * tensor.sqr(delta_x_t)
         )
 
         step = delta_x_t
-        updates = [(mean_square_step_tm1, mean_square_step_t),
-                   (mean_square_delta_x_tm1, mean_square_delta_x_t)]
+        updates.append((mean_square_delta_x_tm1,
+                        tensor.cast(mean_square_delta_x_t,
+                                    mean_square_delta_x_tm1.dtype)))
         return step, updates
 
 
@@ -463,6 +1141,16 @@ class BasicRMSProp(StepRule):
     max_scaling : float, optional
         Maximum scaling of the step size, in case the running average is
         really small. Needs to be greater than 0. Defaults to 1e5.
+    state_dtype : str, optional
+        The data type the running averages are stored in, e.g.
+        ``'float16'`` to halve the memory they take. Defaults to
+        ``floatX``.
+    factored : bool, optional
+        If ``True``, only the running averages over the rows and over the
+        columns of matrices are stored, which takes memory proportional to
+        their number of rows plus columns instead of their size. This
+        can not be combined with the sparse updates of
+        :class:`GradientDescent`. Defaults to ``False``.
 
     Notes
     -----
@@ -478,23 +1166,24 @@ class BasicRMSProp(StepRule):
     For more information, see [Hint2014]_.
 
     """
-    def __init__(self, decay_rate=0.9, max_scaling=1e5):
+    def __init__(self, decay_rate=0.9, max_scaling=1e5, state_dtype=None,
+                 factored=False):
         if not 0.0 <= decay_rate <= 1.0:
             raise ValueError("decay rate needs to be in [0, 1]")
         if max_scaling <= 0:
             raise ValueError("max. scaling needs to be greater than 0")
         self.decay_rate = shared_floatx(decay_rate)
         self.epsilon = 1. / max_scaling
+        self.state_dtype = state_dtype
+        self.factored = factored
 
     def compute_step(self, param, previous_step):
-        mean_square_step_tm1 = shared_floatx(param.get_value() * 0.)
-        mean_square_step_t = (
-            self.decay_rate * mean_square_step_tm1 +
-            (1 - self.decay_rate) * tensor.sqr(previous_step))
+        mean_square_step_t, updates = _running_mean_square(
+            param, previous_step, self.decay_rate, self.state_dtype,
+            self.factored)
         rms_step_t = tensor.maximum(
             tensor.sqrt(mean_square_step_t), self.epsilon)
         step = previous_step / rms_step_t
-        updates = [(mean_square_step_tm1, mean_square_step_t)]
         return step, updates
 
 
@@ -510,7 +1199,7 @@ class RMSProp(CompositeRule):
 
     Parameters
     ----------
-    learning_rate : float, optional
+    learning_rate : float or :class:`.Schedule`, optional
         The learning rate by which the previous step scaled. Defaults to 1.
     decay_rate : float, optional
         How fast the running average decays (lower is faster).
@@ -518,6 +1207,12 @@ class RMSProp(CompositeRule):
     max_scaling : float, optional
         Maximum scaling of the step size, in case the running average is
         really small. Defaults to 1e5.
+    state_dtype : str, optional
+        The data type the running averages are stored in. Defaults to
+        ``floatX``.
+    factored : bool, optional
+        Whether to store the running averages of matrices factored, see
+        :class:`BasicRMSProp`. Defaults to ``False``.
 
     Attributes
     ----------
@@ -531,9 +1226,12 @@ class RMSProp(CompositeRule):
     :class:`SharedVariableModifier`
 
     """
-    def __init__(self, learning_rate=1.0, decay_rate=0.9, max_scaling=1e5):
+    def __init__(self, learning_rate=1.0, decay_rate=0.9, max_scaling=1e5,
+                 state_dtype=None, factored=False):
         basic_rms_prop = BasicRMSProp(decay_rate=decay_rate,
-                                      max_scaling=max_scaling)
+                                      max_scaling=max_scaling,
+                                      state_dtype=state_dtype,
+                                      factored=factored)
         scale = Scale(learning_rate=learning_rate)
         self.learning_rate = scale.learning_rate
         self.decay_rate = basic_rms_prop.decay_rate
@@ -654,12 +1352,15 @@ class AdaGrad(StepRule):
 
     Parameters
     ----------
-    learning_rate : float, optional
+    learning_rate : float or :class:`.Schedule`, optional
         Step size.
         Default value is set to 0.0002.
     epsilon : float, optional
         Stabilizing constant for one over root of sum of squares.
         Defaults to 1e-6.
+    state_dtype : str, optional
+        The data type the sums of squares are stored in. Defaults to
+        ``floatX``.
 
     Notes
     -----
@@ -671,22 +1372,20 @@ class AdaGrad(StepRule):
        http://www.jmlr.org/papers/volume12/duchi11a/duchi11a.pdf
 
     """
-    def __init__(self, learning_rate=0.002, epsilon=1e-6):
+    def __init__(self, learning_rate=0.002, epsilon=1e-6, state_dtype=None):
         self.learning_rate = learning_rate
         self.epsilon = epsilon
+        self.state_dtype = state_dtype
 
     def compute_step(self, param, previous_step):
-        name = 'adagrad_sqs'
-        if param.name:
-            name += '_' + param.name
-        ssq = shared_floatx(param.get_value() * 0.,
-                            name=name)
-
-        ssq_t = (tensor.sqr(previous_step) + ssq)
-        step = (self.learning_rate * previous_step /
+        ssq = _shared_state(param, 'adagrad_sqs', self.state_dtype)
+
+        ssq_t = (tensor.sqr(previous_step) +
+                 tensor.cast(ssq, previous_step.dtype))
+        step = (schedule_value(self.learning_rate) * previous_step /
                 (tensor.sqrt(ssq_t) + self.epsilon))
 
-        updates = [(ssq, ssq_t)]
+        updates = [(ssq, tensor.cast(ssq_t, ssq.dtype))]
 
         return step, updates
 
@@ -700,7 +1399,7 @@ class Adam(StepRule):
 
     Parameters
     ----------
-    learning_rate : float, optional
+    learning_rate : float or :class:`.Schedule`, optional
         Step size.
         Default value is set to 0.0002.
     beta1 : float, optional
@@ -713,36 +1412,45 @@ class Adam(StepRule):
         Default value is set to 1e-8.
     decay_factor : float, optional
         Default value is set to 1 - 1e-8.
+    state_dtype : str, optional
+        The data type the moment estimates are stored in, e.g.
+        ``'float16'`` to halve the memory they take. Defaults to
+        ``floatX``.
+    factored : bool, optional
+        If ``True``, the second moment estimates of matrices are stored
+        factored, see :class:`BasicRMSProp`. Defaults to ``False``.
 
     """
     def __init__(self, learning_rate=0.002,
                  beta1=0.1, beta2=0.001, epsilon=1e-8,
-                 decay_factor=(1 - 1e-8)):
+                 decay_factor=(1 - 1e-8), state_dtype=None, factored=False):
         self.learning_rate = learning_rate
         self.beta1 = beta1
         self.beta2 = beta2
         self.epsilon = epsilon
         self.decay_factor = decay_factor
+        self.state_dtype = state_dtype
+        self.factored = factored
 
     def compute_step(self, param, previous_step):
-        mean = shared_floatx(param.get_value() * 0., 'mean')
-        variance = shared_floatx(param.get_value() * 0., 'variance')
+        mean = _shared_state(param, 'mean', self.state_dtype)
         time = shared_floatx(0., 'time')
 
         t1 = time + 1
-        learning_rate = (self.learning_rate *
+        learning_rate = (schedule_value(self.learning_rate) *
                          tensor.sqrt((1. - (1. - self.beta2)**t1)) /
                          (1. - (1. - self.beta1)**t1))
         beta_1t = 1 - (1 - self.beta1) * self.decay_factor ** (t1 - 1)
-        mean_t = beta_1t * previous_step + (1. - beta_1t) * mean
-        variance_t = (self.beta2 * tensor.sqr(previous_step) +
-                      (1. - self.beta2) * variance)
+        mean_t = (beta_1t * previous_step +
+                  (1. - beta_1t) * tensor.cast(mean, previous_step.dtype))
+        variance_t, variance_updates = _running_mean_square(
+            param, previous_step, 1. - self.beta2, self.state_dtype,
+            self.factored, 'variance')
         step = (learning_rate * mean_t /
                 (tensor.sqrt(variance_t) + self.epsilon))
 
-        updates = [(mean, mean_t),
-                   (variance, variance_t),
-                   (time, t1)]
+        updates = ([(mean, tensor.cast(mean_t, mean.dtype))] +
+                   variance_updates + [(time, t1)])
 
         return step, updates
 
@@ -0,0 +1,236 @@
+"""Hyperparameter schedules computed by the training function.
+
+Changing a hyperparameter from Python, like
+:class:`.SharedVariableModifier` does, costs a function call and a
+transfer to the device after every batch. The schedules in this module
+are instead Theano expressions of an iteration counter, which
+:class:`~blocks.algorithms.GradientDescent` increments together with
+the parameters. A schedule is given to a step rule wherever the latter
+accepts a number, e.g. ``Scale(learning_rate=CosineDecay(0.1, 1000))``.
+
+"""
+import math
+from abc import ABCMeta, abstractmethod
+
+import numpy
+import theano
+from six import add_metaclass
+from theano import tensor
+
+from blocks.graph import ComputationGraph
+
+
+@add_metaclass(ABCMeta)
+class Schedule(object):
+    """A hyperparameter value that depends on the number of updates done.
+
+    Attributes
+    ----------
+    iterations : :class:`~tensor.TensorSharedVariable`
+        The integer number of updates done so far. It is incremented by
+        :class:`~blocks.algorithms.GradientDescent` after every batch
+        and can be reset with ``set_value`` to restart the schedule.
+    variable : :class:`~tensor.TensorVariable`
+        The value of the schedule for the current update, which can also
+        be monitored.
+
+    """
+    def __init__(self):
+        self.iterations = theano.shared(numpy.int64(0), name='iterations')
+        self.iterations.tag.schedule_counter = True
+        self._variable = None
+
+    @property
+    def variable(self):
+        if self._variable is None:
+            iterations = tensor.cast(self.iterations, theano.config.floatX)
+            self._variable = tensor.cast(self.compute(iterations),
+                                         theano.config.floatX)
+            self._variable.name = self.__class__.__name__.lower()
+        return self._variable
+
+    @abstractmethod
+    def compute(self, iterations):
+        """Build the value of the schedule.
+
+        Parameters
+        ----------
+        iterations : :class:`~tensor.TensorVariable`
+            The number of updates done before the current one, as a
+            floating point scalar.
+
+        Returns
+        -------
+        value : :class:`~tensor.TensorVariable`
+            The value of the hyperparameter for the current update.
+
+        """
+        pass
+
+
+def schedule_value(value):
+    """Return the value of a schedule, or a given number unchanged."""
+    if isinstance(value, Schedule):
+        return value.variable
+    return value
+
+
+def schedule_updates(variables, updated=()):
+    """Increment the counters of the schedules used in a graph.
+
+    Parameters
+    ----------
+    variables : list of :class:`~tensor.TensorVariable`
+        The outputs of the graph, e.g. the steps of a training algorithm.
+    updated : iterable of :class:`~tensor.TensorSharedVariable`
+        Shared variables already updated elsewhere, which are skipped.
+
+    Returns
+    -------
+    updates : list of tuples
+        An update incrementing each counter found once.
+
+    """
+    updated = set(updated)
+    return [(counter, counter + 1)
+            for counter in ComputationGraph(variables).shared_variables
+            if getattr(counter.tag, 'schedule_counter', False) and
+            counter not in updated]
+
+
+class StepDecay(Schedule):
+    """Multiplies the value by a factor every few updates.
+
+    Parameters
+    ----------
+    initial : float
+        The value for the first updates.
+    factor : float
+        The factor the value is multiplied by.
+    every : int
+        The number of updates after which the value is multiplied.
+
+    """
+    def __init__(self, initial, factor, every):
+        super(StepDecay, self).__init__()
+        if every <= 0:
+            raise ValueError("the decay period needs to be positive")
+        self.initial = initial
+        self.factor = factor
+        self.every = every
+
+    def compute(self, iterations):
+        return self.initial * self.factor ** tensor.floor(
+            iterations / self.every)
+
+
+class ExponentialDecay(Schedule):
+    """Decays the value smoothly by a rate per number of updates.
+
+    The value after :math:`t` updates is
+    :math:`v_0 r^{t / T}` for an initial value :math:`v_0`, a decay rate
+    :math:`r` and a decay period :math:`T`.
+
+    Parameters
+    ----------
+    initial : float
+        The initial value.
+    rate : float
+        The factor the value is multiplied by every `period` updates.
+    period : int, optional
+        The number of updates over which the value decays by `rate`.
+        Defaults to 1.
+
+    """
+    def __init__(self, initial, rate, period=1):
+        super(ExponentialDecay, self).__init__()
+        if period <= 0:
+            raise ValueError("the decay period needs to be positive")
+        self.initial = initial
+        self.rate = rate
+        self.period = period
+
+    def compute(self, iterations):
+        return self.initial * self.rate ** (iterations / self.period)
+
+
+class CosineDecay(Schedule):
+    """Anneals the value along half a cosine period.
+
+    Parameters
+    ----------
+    initial : float
+        The initial value.
+    length : int
+        The number of updates after which the final value is reached and
+        kept.
+    final : float, optional
+        The final value. Defaults to 0.
+
+    """
+    def __init__(self, initial, length, final=0.):
+        super(CosineDecay, self).__init__()
+        if length <= 0:
+            raise ValueError("the length needs to be positive")
+        self.initial = initial
+        self.length = length
+        self.final = final
+
+    def compute(self, iterations):
+        progress = tensor.minimum(iterations, self.length) / self.length
+        return self.final + (self.initial - self.final) * 0.5 * (
+            1 + tensor.cos(math.pi * progress))
+
+
+class InverseSquareRoot(Schedule):
+    r"""Decays the value with the inverse square root of the updates done.
+
+    After an optional linear warm-up over `warmup` updates, which ends at
+    `initial`, the value is proportional to :math:`1 / \sqrt{t + 1}`.
+
+    Parameters
+    ----------
+    initial : float
+        The largest value, reached at the end of the warm-up.
+    warmup : int, optional
+        The number of warm-up updates. Defaults to 0, in which case the
+        value starts at `initial`.
+
+    """
+    def __init__(self, initial, warmup=0):
+        super(InverseSquareRoot, self).__init__()
+        self.initial = initial
+        self.warmup = warmup
+
+    def compute(self, iterations):
+        steps = iterations + 1
+        warmup = max(self.warmup, 1)
+        return self.initial * math.sqrt(warmup) * tensor.minimum(
+            steps ** -0.5, steps * warmup ** -1.5)
+
+
+class LinearWarmup(Schedule):
+    """Increases the value linearly at the beginning of training.
+
+    Parameters
+    ----------
+    value : float or :class:`Schedule`
+        The value to warm up to. A schedule given here is computed from
+        the counter of the warm-up, so that its own counter is unused.
+    warmup : int
+        The number of updates over which the value grows from
+        ``value / warmup`` to `value`.
+
+    """
+    def __init__(self, value, warmup):
+        super(LinearWarmup, self).__init__()
+        if warmup <= 0:
+            raise ValueError("the warm-up length needs to be positive")
+        self.value = value
+        self.warmup = warmup
+
+    def compute(self, iterations):
+        value = self.value
+        if isinstance(value, Schedule):
+            value = value.compute(iterations)
+        return tensor.minimum(1., (iterations + 1) / self.warmup) * value
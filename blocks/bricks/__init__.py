@@ -2,6 +2,7 @@
 import logging
 
 import numpy
+import theano
 from six import add_metaclass
 from theano import tensor
 from theano.sandbox.rng_mrg import MRG_RandomStreams
@@ -87,6 +88,14 @@ class Initializable(Brick):
         :meth:`~.Brick.initialize`. Only supported by bricks for which
         :attr:`has_biases` is ``True``.
     rng : :class:`numpy.random.RandomState`
+    param_dtype : :obj:`str`, optional
+        The data type of the parameters of this brick and of its
+        :class:`Initializable` children that do not set one themselves,
+        e.g. ``'float16'`` to halve the memory they take. The brick's
+        computations are done in this precision if its inputs have it
+        too. See the `master_dtype` argument of :class:`.GradientDescent`
+        to train such parameters. If ``None`` (default), the parameters
+        are of type :attr:`config.floatX`.
 
     Attributes
     ----------
@@ -102,8 +111,9 @@ class Initializable(Brick):
 
     @lazy()
     def __init__(self, weights_init=None, biases_init=None, use_bias=True,
-                 seed=None, **kwargs):
+                 seed=None, param_dtype=None, **kwargs):
         super(Initializable, self).__init__(**kwargs)
+        self.param_dtype = param_dtype
         self.weights_init = weights_init
         if self.has_biases:
             self.biases_init = biases_init
@@ -139,6 +149,37 @@ class Initializable(Brick):
     def rng(self, rng):
         self._rng = rng
 
+    def allocate(self):
+        if self.param_dtype is not None:
+            for child in self.children:
+                if (isinstance(child, Initializable) and
+                        child.param_dtype is None):
+                    child.param_dtype = self.param_dtype
+        super(Initializable, self).allocate()
+        if self.param_dtype is not None:
+            self._cast_params(self.param_dtype)
+
+    def _cast_params(self, dtype):
+        """Replace the parameters by copies of the given data type.
+
+        The attributes of the brick referring to the parameters are
+        updated as well.
+
+        """
+        replaced = {}
+        for i, param in enumerate(self.params):
+            if param.dtype == dtype:
+                continue
+            copy = theano.shared(param.get_value().astype(dtype),
+                                 name=param.name)
+            for role in getattr(param.tag, 'roles', []):
+                add_role(copy, role)
+            replaced[id(param)] = param, copy
+            self.params[i] = copy
+        for name, value in list(vars(self).items()):
+            if id(value) in replaced and replaced[id(value)][0] is value:
+                setattr(self, name, replaced[id(value)][1])
+
     def _push_initialization_config(self):
         for child in self.children:
             if isinstance(child, Initializable):
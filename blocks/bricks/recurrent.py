@@ -2,22 +2,30 @@
 import copy
 import inspect
 import logging
+import numbers
+from collections import OrderedDict
 from functools import wraps
 
 from picklable_itertools.extras import equizip
 import numpy
 import theano
 from theano import tensor, Variable
+from theano.ifelse import ifelse
 
 from blocks.bricks import Initializable, Sigmoid, Tanh, Linear
 from blocks.bricks.base import Application, application, Brick, lazy
 from blocks.initialization import NdarrayInitialization
-from blocks.roles import add_role, WEIGHT, INITIAL_STATE
+from blocks.roles import add_role, WEIGHT, INITIAL_STATE, CARRIED_STATE
 from blocks.utils import (pack, shared_floatx_nans, shared_floatx_zeros,
                           dict_union, dict_subset, is_shared_variable)
 
 logger = logging.getLogger()
 
+# The keyword arguments with which :func:`recurrent` controls the iteration
+ITERATION_OPTIONS = ('iterate', 'reverse', 'return_initial_states',
+                     'checkpoint_every', 'hoist_projections', 'unroll',
+                     'stateful', 'state_resets', 'sort_by_length')
+
 unknown_scan_input = """
 
 Your function uses a non-shared variable other than those given \
@@ -55,6 +63,42 @@ class BaseRecurrent(Brick):
             return tensor.zeros((batch_size,))
         return tensor.zeros((batch_size, dim))
 
+    def get_carried_state(self, state_name):
+        """Return the shared variable carrying a state across batches.
+
+        The variable is created the first time it is asked for. It is
+        empty until the first stateful application (see the `stateful`
+        argument of :func:`recurrent`) stores the final states of a batch
+        in it.
+
+        Parameters
+        ----------
+        state_name : str
+            The name of the state.
+
+        """
+        if not hasattr(self, 'carried_states'):
+            self.carried_states = OrderedDict()
+        if state_name not in self.carried_states:
+            dim = self.get_dim(state_name)
+            carried = shared_floatx_zeros(
+                (0, dim) if dim else (0,),
+                name='{}_carried'.format(state_name))
+            add_role(carried, CARRIED_STATE)
+            self.carried_states[state_name] = carried
+        return self.carried_states[state_name]
+
+    def reset_carried_states(self):
+        """Make the next stateful application start from initial states.
+
+        Call this when all the streams of a batch end, e.g. at the end
+        of an epoch.
+
+        """
+        for state in getattr(self, 'carried_states', {}).values():
+            state.set_value(numpy.zeros(
+                (0,) + state.get_value().shape[1:], dtype=state.dtype))
+
 
 def recurrent(*args, **kwargs):
     """Wraps an apply method to allow its iterative application.
@@ -103,6 +147,79 @@ def recurrent(*args, **kwargs):
             return_initial_states : bool
                 If ``True``, initial states are included in the returned
                 state tensors. ``False`` by default.
+            checkpoint_every : int, optional
+                If given, the sequences are processed in segments of this
+                many steps, see :func:`checkpointed_scan`. The backward
+                pass then only keeps the states at the beginning of every
+                segment and recomputes the rest of each segment, which
+                with a segment length of about the square root of the
+                number of steps makes the states it keeps grow with that
+                square root instead of the number of steps. The forward
+                pass computes every step twice.
+            unroll : int, optional
+                If given, the step function is applied this many times
+                without a scan, see :func:`unrolled_scan`. For
+                short sequences of a known maximum length, e.g. the
+                batches of a stream bucketed by length, this avoids the
+                overhead of the scan and lets Theano optimize across the
+                steps. Shorter sequences are padded to this length, and
+                the steps on the padding are computed but discarded.
+                Without sequences, the `n_steps` given are applied, which
+                must be an integer not exceeding this number. The
+                variables of every step are a part of the computation
+                graph.
+            stateful : bool, optional
+                If ``True``, the final states are stored in shared
+                variables (see :meth:`BaseRecurrent.get_carried_state`)
+                by updates attached to the application call, and the next
+                batch of the same batch size starts from them instead of
+                the initial states. When a long stream is cut into
+                batches of a few steps, this carries the context across
+                the batches, while the gradients are only propagated
+                through the steps of a batch, i.e. the backpropagation
+                through time is truncated to the length of the batches.
+                The shared variables have the :const:`.CARRIED_STATE`
+                role, and their updates are not done when monitoring
+                with a :class:`.DatasetEvaluator`, so that monitoring
+                does not change the states carried between the training
+                batches. ``False`` by default.
+            state_resets : :class:`~tensor.TensorVariable`, optional
+                A vector with an element for every sequence of the batch,
+                which is 1 for the sequences that start a new stream and
+                should start from the initial states in a stateful
+                application, and 0 for the others.
+            sort_by_length : bool, optional
+                If ``True``, the sequences of the batch are sorted by the
+                lengths given by their `mask`, and every step is only
+                computed for the sequences that have not ended yet,
+                which are the first ones. The states of the others are
+                kept and their other outputs are zero. The results are
+                returned in the original order. This requires a mask
+                whose ones precede its zeros in every sequence, and no
+                contexts. ``False`` by default.
+
+                The steps then have inputs of varying shapes, which the
+                ``scanOp_pushout_output`` optimization of Theano does not
+                support when it moves products out of the scan computing
+                the gradients. Exclude it when compiling the training
+                function, e.g. by passing
+                ``mode=theano.compile.get_default_mode().excluding(
+                'scanOp_pushout_output')`` in the `theano_func_kwargs`
+                of :class:`.GradientDescent`.
+            hoist_projections : bool, optional
+                If ``True``, the products of the inputs of a step with
+                matrices that do not change from step to step, like the
+                input projections of a transition, are computed for all
+                the steps at once before the iteration, see
+                :func:`hoist_projections`. ``False`` by default.
+
+                Only products with a sequence input are moved. The
+                transitions of this module expect inputs projected
+                beforehand and only multiply the states in their steps,
+                as does :class:`.BaseSequenceGenerator`, which applies
+                its fork to the feedback before the iteration, so only
+                custom transitions that project their inputs in the step
+                benefit from this.
 
             .. todo::
 
@@ -119,6 +236,17 @@ def recurrent(*args, **kwargs):
                 return application_function(brick, *args, **kwargs)
             reverse = kwargs.pop('reverse', False)
             return_initial_states = kwargs.pop('return_initial_states', False)
+            checkpoint_every = kwargs.pop('checkpoint_every', None)
+            hoist = kwargs.pop('hoist_projections', False)
+            unroll = kwargs.pop('unroll', None)
+            stateful = kwargs.pop('stateful', False)
+            state_resets = kwargs.pop('state_resets', None)
+            sort_by_length = kwargs.pop('sort_by_length', False)
+            if stateful and reverse:
+                raise ValueError("stateful iteration can not be reversed")
+            if unroll and checkpoint_every:
+                raise ValueError("unrolled iteration can not be "
+                                 "checkpointed")
 
             # Push everything to kwargs
             for arg, arg_name in zip(args, arg_names):
@@ -153,6 +281,15 @@ def recurrent(*args, **kwargs):
                 # TODO Raise error if n_steps and batch_size not found?
                 n_steps = kwargs.pop('n_steps')
                 batch_size = kwargs.pop('batch_size')
+                if unroll:
+                    if not isinstance(n_steps, numbers.Integral):
+                        raise ValueError("unrolled iteration without "
+                                         "sequences requires an integer "
+                                         "number of steps")
+                    if n_steps > unroll:
+                        raise ValueError(
+                            "the number of steps ({}) exceeds the number "
+                            "of unrolled steps ({})".format(n_steps, unroll))
 
             # Handle the rest kwargs
             rest_kwargs = {key: value for key, value in kwargs.items()
@@ -188,15 +325,101 @@ def recurrent(*args, **kwargs):
                 states_given[name] = tensor.unbroadcast(state,
                                                         *range(state.ndim))
 
+            # Continue from the final states of the previous batch
+            carried_states = OrderedDict()
+            if stateful:
+                for name, initial_state in states_given.items():
+                    carried = brick.get_carried_state(name)
+                    carried_states[name] = carried
+                    state = ifelse(tensor.eq(carried.shape[0], batch_size),
+                                   carried, initial_state)
+                    if state_resets is not None:
+                        state = tensor.switch(
+                            tensor.shape_padright(state_resets,
+                                                  state.ndim - 1),
+                            initial_state, state)
+                    states_given[name] = state
+
+            # Sort the sequences by decreasing length, so that the
+            # sequences that have not ended at a step are the first ones
+            order = None
+            active_sizes = []
+            if sort_by_length:
+                if kwargs.get('mask') is None:
+                    raise ValueError("sorting by length requires a mask")
+                if contexts_given:
+                    raise ValueError("sorting by length can not be "
+                                     "combined with contexts")
+                order = tensor.argsort(-kwargs['mask'].sum(axis=0))
+                for name, sequence in sequences_given.items():
+                    sequences_given[name] = _take_along_batch(sequence,
+                                                              order, 1)
+                for name, state in states_given.items():
+                    states_given[name] = state[order]
+                active_sizes = [tensor.cast(
+                    sequences_given['mask'].sum(axis=1), 'int64')]
+
+            # Find the projections of the inputs by tracing a step
+            projections = OrderedDict()
+            if hoist and sequences_given:
+                placeholders = OrderedDict(
+                    (name, tensor.TensorType(
+                        sequence.dtype, sequence.broadcastable[1:])())
+                    for name, sequence in sequences_given.items())
+                for name, variable in dict_union(states_given,
+                                                 contexts_given).items():
+                    placeholders[name] = variable.type()
+                traced = application_function(
+                    brick, **dict_union(placeholders, rest_kwargs))
+                projections = hoist_projections(
+                    pack(traced), [placeholders[name]
+                                   for name in sequences_given],
+                    list(placeholders.values()))
+                projections = OrderedDict(
+                    (name, weights) for name, weights in
+                    equizip(sequences_given, projections) if weights)
+            projected_sequences = [
+                tensor.dot(sequences_given[name],
+                           tensor.concatenate(weights, axis=1))
+                for name, weights in projections.items()]
+
             def scan_function(*args):
                 args = list(args)
+                projected = args[len(sequences_given):
+                                 len(sequences_given) + len(projections)]
+                del args[len(sequences_given):
+                         len(sequences_given) + len(projections)]
                 arg_names = (list(sequences_given) +
                              [output for output in application.outputs
                               if output in application.states] +
                              list(contexts_given))
+                if sort_by_length:
+                    active = args.pop(len(sequences_given))
+                    full_kwargs = dict(equizip(arg_names, args))
+                    args = [arg[:active] for arg in args]
+                    projected = [arg[:active] for arg in projected]
                 kwargs = dict(equizip(arg_names, args))
                 kwargs.update(rest_kwargs)
                 outputs = application(iterate=False, **kwargs)
+                if projections:
+                    outputs = replace_projections(
+                        pack(outputs), OrderedDict(
+                            (kwargs[name], (weights, step_projected))
+                            for (name, weights), step_projected in
+                            equizip(projections.items(), projected)))
+                if sort_by_length:
+                    outputs = pack(outputs)
+                    for i, name in enumerate(application.outputs):
+                        if name in application.states:
+                            rest = full_kwargs[name][active:]
+                        else:
+                            batch_size = full_kwargs['mask'].shape[0]
+                            rest = tensor.zeros(
+                                [batch_size - active] +
+                                [outputs[i].shape[j]
+                                 for j in range(1, outputs[i].ndim)],
+                                dtype=outputs[i].dtype)
+                        outputs[i] = tensor.concatenate([outputs[i], rest])
                 # We want to save the computation graph returned by the
                 # `application_function` when it is called inside the
                 # `theano.scan`.
@@ -207,27 +430,64 @@ def recurrent(*args, **kwargs):
                 states_given[name] if name in application.states
                 else None
                 for name in application.outputs]
-            result, updates = theano.scan(
-                scan_function, sequences=list(sequences_given.values()),
-                outputs_info=outputs_info,
-                non_sequences=list(contexts_given.values()),
-                n_steps=n_steps,
-                go_backwards=reverse,
-                name='{}_{}_scan'.format(
-                    brick.name, application.application_name))
+            scan_name = '{}_{}_scan'.format(brick.name,
+                                            application.application_name)
+            if unroll:
+                result, updates = unrolled_scan(
+                    scan_function,
+                    sequences=(list(sequences_given.values()) +
+                               projected_sequences + active_sizes),
+                    outputs_info=outputs_info,
+                    non_sequences=list(contexts_given.values()),
+                    n_steps=unroll if sequences_given else n_steps,
+                    go_backwards=reverse)
+            elif checkpoint_every:
+                result, updates = checkpointed_scan(
+                    scan_function, checkpoint_every,
+                    sequences=(list(sequences_given.values()) +
+                               projected_sequences + active_sizes),
+                    outputs_info=outputs_info,
+                    non_sequences=list(contexts_given.values()),
+                    n_steps=n_steps, go_backwards=reverse, name=scan_name)
+            else:
+                result, updates = theano.scan(
+                    scan_function,
+                    sequences=(list(sequences_given.values()) +
+                               projected_sequences + active_sizes),
+                    outputs_info=outputs_info,
+                    non_sequences=list(contexts_given.values()),
+                    n_steps=n_steps,
+                    go_backwards=reverse,
+                    name=scan_name)
             result = pack(result)
             if return_initial_states:
-                # Undo Subtensor
-                for i in range(len(states_given)):
+                for i, name in enumerate(application.states):
+                    if checkpoint_every or unroll:
+                        result[i] = tensor.concatenate(
+                            [tensor.shape_padleft(states_given[name]),
+                             result[i]])
+                        continue
+                    # Undo Subtensor
                     assert isinstance(result[i].owner.op,
                                       tensor.subtensor.Subtensor)
                     result[i] = result[i].owner.inputs[0]
+            if order is not None:
+                inverse = tensor.argsort(order)
+                result = [_take_along_batch(output, inverse, 1)
+                          for output in result]
+            for name, carried in carried_states.items():
+                final_state = result[application.outputs.index(name)][-1]
+                updates = dict_union(updates, OrderedDict(
+                    [(carried, final_state)]))
             if updates:
                 application_call.updates = dict_union(application_call.updates,
                                                       updates)
 
             return result
 
+        # Keep the signature of the transition, e.g. for
+        # :class:`Bidirectional` to iterate it itself
+        recurrent_apply.__wrapped__ = application_function
         return recurrent_apply
 
     # Decorator can be used with or without arguments
@@ -242,6 +502,305 @@ def recurrent(*args, **kwargs):
         return wrap_application
 
 
+def hoist_projections(outputs, sequences, step_inputs):
+    """Find the products of sequences with loop-invariant matrices.
+
+    Parameters
+    ----------
+    outputs : list of :class:`~tensor.TensorVariable`
+        The outputs of a step.
+    sequences : list of :class:`~tensor.TensorVariable`
+        The inputs of the step taken from the sequences.
+    step_inputs : list of :class:`~tensor.TensorVariable`
+        All the inputs of the step that change from step to step, or
+        that are given by the iteration, i.e. the sequences, states and
+        contexts.
+
+    Returns
+    -------
+    weights : list of lists
+        For every sequence, the matrices it or a copy of it is multiplied
+        with, in the order the products are computed. The matrices only
+        depend on variables that are not among `step_inputs`, so that the
+        products can be computed for all the steps as one matrix product
+        with their concatenation.
+
+    """
+    step_inputs = set(step_inputs)
+    weights = OrderedDict((sequence, []) for sequence in sequences)
+    nodes = theano.gof.graph.io_toposort(theano.gof.graph.inputs(outputs),
+                                         outputs)
+    for node in nodes:
+        if not isinstance(node.op, tensor.basic.Dot):
+            continue
+        sequence, weight = node.inputs
+        sequence = _uncopied(sequence)
+        if (sequence not in weights or sequence.ndim != 2 or
+                weight.ndim != 2 or
+                any(_same_variable(weight, other)
+                    for other in weights[sequence]) or
+                step_inputs.intersection(
+                    theano.gof.graph.ancestors([weight]))):
+            continue
+        weights[sequence].append(weight)
+    return list(weights.values())
+
+
+def replace_projections(outputs, projections):
+    """Replace products of the inputs of a step by precomputed ones.
+
+    Parameters
+    ----------
+    outputs : list of :class:`~tensor.TensorVariable`
+        The outputs of a step.
+    projections : OrderedDict
+        A dictionary mapping an input of the step to a pair of the
+        matrices it is multiplied with, as found by
+        :func:`hoist_projections`, and the product of the input with
+        their concatenation.
+
+    Returns
+    -------
+    outputs : list of :class:`~tensor.TensorVariable`
+        The outputs computed from the precomputed products.
+
+    """
+    replacements = OrderedDict()
+    nodes = theano.gof.graph.io_toposort(theano.gof.graph.inputs(outputs),
+                                         outputs)
+    for node in nodes:
+        if (not isinstance(node.op, tensor.basic.Dot) or
+                _uncopied(node.inputs[0]) not in projections):
+            continue
+        weights, projected = projections[_uncopied(node.inputs[0])]
+        offset = 0
+        for weight in weights:
+            width = weight.shape[1]
+            if _same_variable(node.inputs[1], weight):
+                replacements[node.outputs[0]] = tensor.patternbroadcast(
+                    projected[:, offset:offset + width],
+                    node.outputs[0].broadcastable)
+                break
+            offset += width
+    if not replacements:
+        return outputs
+    return theano.clone(outputs, replace=replacements)
+
+
+def _take_along_batch(variable, indices, axis):
+    """Select the elements of a batch along an axis of a variable."""
+    if axis == 0:
+        return variable[indices]
+    pattern = [axis] + [i for i in range(variable.ndim) if i != axis]
+    taken = variable.dimshuffle(*pattern)[indices]
+    return taken.dimshuffle(*[pattern.index(i)
+                              for i in range(variable.ndim)])
+
+
+def _uncopied(variable):
+    """Undo the copies of a variable made when it is given to bricks."""
+    while (variable.owner and
+           isinstance(variable.owner.op, tensor.Elemwise) and
+           variable.owner.op.scalar_op == theano.scalar.identity):
+        variable = variable.owner.inputs[0]
+    return variable
+
+
+def _same_variable(first, second):
+    return (first is second or
+            theano.gof.graph.is_same_graph(first, second))
+
+
+def checkpointed_scan(fn, segment_length, sequences, outputs_info,
+                      non_sequences, n_steps, go_backwards=False, name=None):
+    """Scan over segments of steps, keeping only the boundary states.
+
+    Takes the same arguments as :func:`theano.scan` and returns the same
+    results, computed in two passes over segments of `segment_length`
+    steps. The first pass is a scan over the segments that only returns
+    the states at the end of every segment, each segment's steps being
+    iterated by an inner scan. The second pass is a scan over the
+    segments again, which starts every segment from its boundary state
+    and returns the outputs of its steps. Neither scan has a sequence of
+    states along the steps among its outputs, so when differentiating,
+    the states kept for the backward pass are the ``n_steps /
+    segment_length`` boundary states, and the steps of each segment are
+    computed again when its gradient is.
+
+    Parameters
+    ----------
+    fn : callable
+        The step function, given the sequences, the previous values of
+        the outputs that have an initial value in `outputs_info`, and the
+        non-sequences.
+    segment_length : int
+        The number of steps in every segment. The sequences are padded
+        with zeros to a multiple of it; the steps on the padding come last
+        and their outputs are dropped.
+    sequences : list
+        The sequences to iterate over.
+    outputs_info : list
+        The initial values of the outputs, ``None`` for the outputs that
+        are not fed back.
+    non_sequences : list
+        The variables given to every step.
+    n_steps : int or :class:`~tensor.TensorVariable`
+        The number of steps.
+    go_backwards : bool, optional
+        If ``True``, the sequences are processed from last to first, and
+        the outputs are returned in processing order like
+        :func:`theano.scan` does. ``False`` by default.
+    name : str, optional
+        The name of the scan returning the boundary states. The scan
+        returning the outputs gets a ``_outputs`` suffix, and the inner
+        scans a ``_segment`` one.
+
+    Notes
+    -----
+    The steps are computed twice in the forward pass. The returned
+    outputs themselves still have a value for every step; with a segment
+    length of about the square root of the number of steps, it is the
+    memory of the recurrence beyond its results that grows with that
+    square root.
+
+    """
+    state_positions = [i for i, info in enumerate(outputs_info)
+                       if info is not None]
+    n_segments = (n_steps + segment_length - 1) // segment_length
+    padding = n_segments * segment_length - n_steps
+    segmented_sequences = []
+    for sequence in sequences:
+        if go_backwards:
+            sequence = sequence[::-1]
+        tail_shape = [sequence.shape[i] for i in range(1, sequence.ndim)]
+        sequence = tensor.concatenate(
+            [sequence[:n_steps],
+             tensor.zeros([padding] + tail_shape, dtype=sequence.dtype)])
+        segmented_sequences.append(sequence.reshape(
+            [n_segments, segment_length] + tail_shape,
+            ndim=sequence.ndim + 1))
+    segment_name = name + '_segment' if name else None
+
+    def scan_segment(segment_sequences, states, contexts):
+        inner_outputs_info = list(outputs_info)
+        for position, state in equizip(state_positions, states):
+            inner_outputs_info[position] = state
+        outputs, updates = theano.scan(
+            fn, sequences=segment_sequences,
+            outputs_info=inner_outputs_info, non_sequences=contexts,
+            n_steps=segment_length, name=segment_name)
+        return pack(outputs), updates
+
+    def boundary_function(*args):
+        n_states = len(state_positions)
+        outputs, updates = scan_segment(
+            list(args[:len(sequences)]),
+            list(args[len(sequences):len(sequences) + n_states]),
+            list(args[len(sequences) + n_states:]))
+        return [outputs[position][-1] for position in state_positions]
+
+    initial_states = [outputs_info[position]
+                      for position in state_positions]
+    boundaries = theano.scan(
+        boundary_function, sequences=segmented_sequences,
+        outputs_info=initial_states, non_sequences=non_sequences,
+        n_steps=n_segments, name=name)[0]
+    # The states each segment starts from
+    starts = [tensor.concatenate([tensor.shape_padleft(initial),
+                                  boundary[:-1]])
+              for initial, boundary in equizip(initial_states,
+                                               pack(boundaries))]
+
+    def output_function(*args):
+        n_states = len(state_positions)
+        return scan_segment(
+            list(args[:len(sequences)]),
+            list(args[len(sequences):len(sequences) + n_states]),
+            list(args[len(sequences) + n_states:]))
+
+    segments, updates = theano.scan(
+        output_function, sequences=segmented_sequences + starts,
+        non_sequences=non_sequences, n_steps=n_segments,
+        name=name + '_outputs' if name else None)
+    results = []
+    for output in pack(segments):
+        tail_shape = [output.shape[i] for i in range(2, output.ndim)]
+        results.append(output.reshape(
+            [n_segments * segment_length] + tail_shape,
+            ndim=output.ndim - 1)[:n_steps])
+    if len(results) == 1:
+        return results[0], updates
+    return results, updates
+
+
+def unrolled_scan(fn, sequences, outputs_info, non_sequences, n_steps,
+                  go_backwards=False):
+    """Apply a step function a fixed number of times without a scan.
+
+    Takes the same arguments as :func:`theano.scan` and returns the same
+    results, but the step function is called once for every step when
+    the graph is built, so that the steps become a part of the graph
+    itself, which Theano can optimize across the steps.
+
+    Parameters
+    ----------
+    fn : callable
+        The step function, given the sequences, the previous values of
+        the outputs that have an initial value in `outputs_info`, and the
+        non-sequences.
+    sequences : list
+        The sequences to iterate over. Their length can not exceed
+        `n_steps`, which is checked when the graph is run. Shorter
+        sequences are padded with zeros, after their end in the
+        processing order, and only the outputs of their steps are
+        returned, so that the steps on the padding do not change the
+        results.
+    outputs_info : list
+        The initial values of the outputs, ``None`` for the outputs that
+        are not fed back.
+    non_sequences : list
+        The variables given to every step.
+    n_steps : int
+        The number of steps.
+    go_backwards : bool, optional
+        If ``True``, the sequences are processed from last to first, and
+        the outputs are returned in processing order like
+        :func:`theano.scan` does. ``False`` by default.
+
+    """
+    length = n_steps
+    if sequences:
+        length = sequences[0].shape[0]
+        padded_sequences = []
+        for sequence in sequences:
+            sequence = tensor.opt.Assert()(
+                sequence, tensor.eq(sequence.shape[0], length),
+                tensor.le(length, n_steps))
+            padding = tensor.zeros(
+                [n_steps - length] +
+                [sequence.shape[i] for i in range(1, sequence.ndim)],
+                dtype=sequence.dtype)
+            padded_sequences.append(tensor.concatenate(
+                [padding, sequence] if go_backwards else [sequence, padding]))
+        sequences = padded_sequences
+    state_positions = [i for i, info in enumerate(outputs_info)
+                       if info is not None]
+    states = [outputs_info[position] for position in state_positions]
+    steps = []
+    for step in range(n_steps):
+        index = n_steps - 1 - step if go_backwards else step
+        outputs = pack(fn(*([sequence[index] for sequence in sequences] +
+                            states + list(non_sequences))))
+        states = [outputs[position] for position in state_positions]
+        steps.append(outputs)
+    results = [tensor.concatenate([tensor.shape_padleft(output)
+                                   for output in outputs])[:length]
+               for outputs in equizip(*steps)]
+    if len(results) == 1:
+        return results[0], OrderedDict()
+    return results, OrderedDict()
+
+
 class SimpleRecurrent(BaseRecurrent, Initializable):
     """The traditional recurrent transition.
 
@@ -542,7 +1101,8 @@ class GatedRecurrent(BaseRecurrent, Initializable):
         state_to_reset = self.weights_init.generate(
             self.rng, (self.dim, self.dim))
         self.state_to_gates.set_value(
-            numpy.hstack([state_to_update, state_to_reset]))
+            numpy.hstack([state_to_update, state_to_reset]).astype(
+                self.state_to_gates.dtype))
 
     @recurrent(sequences=['mask', 'inputs', 'gate_inputs'],
                states=['states'], outputs=['states'], contexts=[])
@@ -600,38 +1160,210 @@ class Bidirectional(Initializable):
     prototype : instance of :class:`BaseRecurrent`
         A prototype brick from which the forward and backward bricks are
         cloned.
+    fused : bool, optional
+        If ``True``, both networks are iterated by a single scan, every
+        step of which applies the forward network to a step of the
+        inputs and the backward network to the step as far from the
+        end. The states and the recurrent weights of the two networks
+        are stacked, so that the products of a step are a single batched
+        matrix product. This halves the overhead of the iteration and
+        makes the products larger. Only :class:`SimpleRecurrent`,
+        :class:`LSTM` and :class:`GatedRecurrent` transitions are
+        supported, and the iteration options of :func:`recurrent`, like
+        `reverse` or `unroll`, are not. ``False`` by default, in which
+        case each network has its own scan.
 
     Notes
     -----
     See :class:`.Initializable` for initialization parameters.
 
+    In a fused step, the activations of the forward network are applied
+    to the stacked values of both networks.
+
     """
     has_bias = False
 
     @lazy()
-    def __init__(self, prototype, **kwargs):
+    def __init__(self, prototype, fused=False, **kwargs):
         super(Bidirectional, self).__init__(**kwargs)
         self.prototype = prototype
+        self.fused = fused
 
         self.children = [copy.deepcopy(prototype) for _ in range(2)]
         self.children[0].name = 'forward'
         self.children[1].name = 'backward'
 
     @application
-    def apply(self, *args, **kwargs):
+    def apply(self, application_call, *args, **kwargs):
         """Applies forward and backward networks and concatenates outputs."""
-        forward = self.children[0].apply(as_list=True, *args, **kwargs)
-        backward = [x[::-1] for x in
-                    self.children[1].apply(reverse=True, as_list=True,
-                                           *args, **kwargs)]
+        if self.fused:
+            forward, backward = self._fused_apply(application_call,
+                                                  *args, **kwargs)
+        else:
+            forward = self.children[0].apply(as_list=True, *args, **kwargs)
+            backward = [x[::-1] for x in
+                        self.children[1].apply(reverse=True, as_list=True,
+                                               *args, **kwargs)]
         return [tensor.concatenate([f, b], axis=2)
                 for f, b in equizip(forward, backward)]
 
+    def _fused_apply(self, application_call, *args, **kwargs):
+        """Iterate both networks in a single scan.
+
+        Returns the outputs of the forward and backward networks, both in
+        the order of the inputs. The inner graph of the scan is saved in
+        the `application_call`.
+
+        """
+        unsupported = [option for option in ITERATION_OPTIONS
+                       if option in kwargs]
+        if unsupported:
+            raise ValueError("fused bidirectional networks do not support "
+                             "the iteration options {}".format(
+                                 ", ".join(unsupported)))
+        if type(self.prototype) not in _STACKED_STEPS:
+            raise ValueError("fused bidirectional networks only support "
+                             "SimpleRecurrent, LSTM and GatedRecurrent "
+                             "transitions, not {}".format(
+                                 self.prototype.__class__.__name__))
+        param_names, stacked_step = _STACKED_STEPS[type(self.prototype)]
+        application = self.children[0].apply
+        arg_names = inspect.getargspec(
+            application.application_function.__wrapped__).args[1:]
+        kwargs.update(zip(arg_names, args))
+        sequences = OrderedDict(
+            (name, tensor.as_tensor_variable(kwargs.pop(name)))
+            for name in application.sequences
+            if kwargs.get(name) is not None)
+        if not sequences:
+            raise ValueError("fused bidirectional networks require "
+                             "sequences")
+        given_states = dict_subset(kwargs, application.states,
+                                   pop=True, must_have=False)
+        unknown = [name for name, value in kwargs.items()
+                   if value is not None]
+        if unknown:
+            raise ValueError("unknown inputs {} of a fused bidirectional "
+                             "network".format(", ".join(unknown)))
+        batch_size = list(sequences.values())[0].shape[1]
+
+        # The variables of both networks are stacked along a new axis,
+        # which is the second one for the sequences and the first one
+        # for the states and the parameters
+        def stack(variables, axis=0):
+            pattern = list(range(axis)) + ['x'] + list(
+                range(axis, variables[0].ndim))
+            return tensor.concatenate(
+                [variable.dimshuffle(*pattern) for variable in variables],
+                axis=axis)
+        stacked_sequences = [stack([sequence, sequence[::-1]], axis=1)
+                             for sequence in sequences.values()]
+        states = []
+        for name in application.outputs:
+            if given_states.get(name) is not None:
+                state = tensor.as_tensor_variable(given_states[name])
+                state = stack([state, state])
+            else:
+                state = stack([brick.initial_state(name, batch_size,
+                                                   **sequences)
+                               for brick in self.children])
+            # Theano issue 1772
+            states.append(tensor.unbroadcast(state, *range(state.ndim)))
+        params = [stack([getattr(brick, name) for brick in self.children])
+                  for name in param_names]
+
+        def fused_step(*args):
+            step_sequences = dict(equizip(sequences,
+                                          args[:len(sequences)]))
+            step_states = args[len(sequences):len(sequences) + len(states)]
+            outputs = stacked_step(self.children[0],
+                                   args[len(sequences) + len(states):],
+                                   *step_states, **step_sequences)
+            application_call.inner_inputs = list(args)
+            application_call.inner_outputs = outputs
+            return outputs
+
+        results, updates = theano.scan(
+            fused_step, sequences=stacked_sequences, outputs_info=states,
+            non_sequences=params, name='{}_fused_scan'.format(self.name))
+        if updates:
+            application_call.updates = dict_union(application_call.updates,
+                                                  updates)
+        results = pack(results)
+        return ([result[:, 0] for result in results],
+                [result[::-1, 1] for result in results])
+
     @apply.delegate
     def apply_delegate(self):
         return self.children[0].apply
 
 
+def _stacked_mask(next_states, states, mask):
+    """Keep the stacked states of the sequences that have ended."""
+    if mask is None:
+        return next_states
+    return (mask[:, :, None] * next_states +
+            (1 - mask[:, :, None]) * states)
+
+
+def _stacked_simple_recurrent_step(brick, params, states, inputs,
+                                   mask=None):
+    """A step of two stacked :class:`SimpleRecurrent` transitions."""
+    W, = params
+    next_states = brick.children[0].apply(
+        inputs + tensor.batched_dot(states, W))
+    return [_stacked_mask(next_states, states, mask)]
+
+
+def _stacked_lstm_step(brick, params, states, cells, inputs, mask=None):
+    """A step of two stacked :class:`LSTM` transitions."""
+    W_state, W_cell_to_in, W_cell_to_forget, W_cell_to_out = (
+        params[0], params[1][:, None, :], params[2][:, None, :],
+        params[3][:, None, :])
+
+    def slice_last(x, no):
+        return x[:, :, no * brick.dim: (no + 1) * brick.dim]
+
+    nonlinearity = brick.children[0].apply
+    activation = tensor.batched_dot(states, W_state) + inputs
+    in_gate = tensor.nnet.sigmoid(slice_last(activation, 0) +
+                                  cells * W_cell_to_in)
+    forget_gate = tensor.nnet.sigmoid(slice_last(activation, 1) +
+                                      cells * W_cell_to_forget)
+    next_cells = (forget_gate * cells +
+                  in_gate * nonlinearity(slice_last(activation, 2)))
+    out_gate = tensor.nnet.sigmoid(slice_last(activation, 3) +
+                                   next_cells * W_cell_to_out)
+    next_states = out_gate * nonlinearity(next_cells)
+    return [_stacked_mask(next_states, states, mask),
+            _stacked_mask(next_cells, cells, mask)]
+
+
+def _stacked_gated_recurrent_step(brick, params, states, inputs,
+                                  gate_inputs, mask=None):
+    """A step of two stacked :class:`GatedRecurrent` transitions."""
+    state_to_state, state_to_gates = params
+    gate_values = brick.gate_activation.apply(
+        tensor.batched_dot(states, state_to_gates) + gate_inputs)
+    update_values = gate_values[:, :, :brick.dim]
+    reset_values = gate_values[:, :, brick.dim:]
+    next_states = brick.activation.apply(
+        tensor.batched_dot(states * reset_values, state_to_state) + inputs)
+    next_states = (next_states * update_values +
+                   states * (1 - update_values))
+    return [_stacked_mask(next_states, states, mask)]
+
+
+# The parameters stacked by a fused :class:`Bidirectional` network for
+# every supported transition, and the step of the stacked transitions
+_STACKED_STEPS = {
+    SimpleRecurrent: (['W'], _stacked_simple_recurrent_step),
+    LSTM: (['W_state', 'W_cell_to_in', 'W_cell_to_forget', 'W_cell_to_out'],
+           _stacked_lstm_step),
+    GatedRecurrent: (['state_to_state', 'state_to_gates'],
+                     _stacked_gated_recurrent_step)}
+
+
 #from blocks.bricks.recurrent import BaseRecurrent, recurrent
 #import copy
 class RecurrentStack(BaseRecurrent, Initializable):
@@ -139,6 +139,10 @@ class BaseSequenceGenerator(Initializable):
         The transition component of the sequence generator.
     fork : :class:`.Brick`
         The brick to compute the transition's inputs from the feedback.
+    checkpoint_every : int, optional
+        If given, passed to the transition when the costs are computed,
+        so that the backward pass only keeps the states of every this
+        many steps, see :func:`.recurrent`.
 
     See Also
     --------
@@ -149,11 +153,13 @@ class BaseSequenceGenerator(Initializable):
 
     """
     @lazy()
-    def __init__(self, readout, transition, fork, **kwargs):
+    def __init__(self, readout, transition, fork, checkpoint_every=None,
+                 **kwargs):
         super(BaseSequenceGenerator, self).__init__(**kwargs)
         self.readout = readout
         self.transition = transition
         self.fork = fork
+        self.checkpoint_every = checkpoint_every
 
         self.children = [self.readout, self.fork, self.transition]
 
@@ -253,9 +259,12 @@ class BaseSequenceGenerator(Initializable):
         inputs = self.fork.apply(feedback, as_dict=True)
 
         # Run the recurrent network
+        iteration_options = {}
+        if self.checkpoint_every:
+            iteration_options['checkpoint_every'] = self.checkpoint_every
         results = self.transition.apply(
             mask=mask, return_initial_states=True, as_dict=True,
-            **dict_union(inputs, states, contexts))
+            **dict_union(inputs, states, contexts, iteration_options))
 
         # Separate the deliverables. The last states are discarded: they
         # are not used to predict any output symbol. The initial glimpses
@@ -10,7 +10,13 @@ For this reason Blocks supports a cheaper but less reliable alternative
 called _dumping_. A dump of the main loop contains the most essential data
 from the training process: the model parameters and the log. In addition,
 to make training resumption possible, the iteration state is saved, that is
-the data stream and the epoch iterator.
+the data stream and the epoch iterator, as well as the state of the
+training algorithm (e.g. the velocities of :class:`.Momentum` or the
+moment estimates of :class:`.Adam`).
+
+A dump can be loaded into a freshly constructed main loop, which makes it
+possible to resume training without unpickling any Theano graphs, see
+:func:`blocks.scripts.continue_training`.
 
 While current dumping mechanism still uses serialization, this is subject
 to be gradually changed, aiming to use only stable and simple data formats
@@ -20,6 +26,7 @@ for dumps, such as for instance .npz files.
 import logging
 import os
 import os.path
+from collections import OrderedDict
 
 import numpy
 from six.moves import cPickle
@@ -28,6 +35,38 @@ from blocks.serialization import pickle_dump
 
 logger = logging.getLogger(__name__)
 
+ALGORITHM_STATE_KEY = 'state{}'
+ALGORITHM_STATE_NAMES_KEY = 'names'
+
+
+def get_algorithm_state(algorithm):
+    """Return the shared variables holding the state of an algorithm.
+
+    Currently only the state of :class:`.GradientDescent` is considered,
+    that is the shared variables updated by the step rule followed by the
+    master copies of the parameters, if any. The order of the step rule
+    variables is the order in which the step rule created its updates,
+    which is reproducible as long as the algorithm is constructed in the
+    same way. When the state is loaded from a dump,
+    the variables are matched by name, and only variables of the same
+    name are matched by position.
+
+    Parameters
+    ----------
+    algorithm : :class:`.TrainingAlgorithm`
+        The training algorithm.
+
+    Returns
+    -------
+    list of :class:`~tensor.TensorSharedVariable`
+        The shared variables, an empty list if the algorithm is stateless
+        or its state is unknown.
+
+    """
+    return ([variable for variable, _
+             in getattr(algorithm, 'step_rule_updates', [])] +
+            list(getattr(algorithm, 'masters', {}).values()))
+
 
 def save_parameter_values(param_values, path):
     """Compactly save parameter values.
@@ -99,6 +138,10 @@ class MainLoopDumpManager(object):
     def path_to_iteration_state(self):
         return os.path.join(self.folder, 'iterations_state.pkl')
 
+    @property
+    def path_to_algorithm_state(self):
+        return os.path.join(self.folder, 'algorithm_state.npz')
+
     @property
     def path_to_log(self):
         # The extension is omitted for the log because advanced
@@ -116,6 +159,14 @@ class MainLoopDumpManager(object):
         with open(self.path_to_iteration_state, "wb") as destination:
             pickle_dump(main_loop.iteration_state, destination)
 
+    def dump_algorithm_state(self, main_loop):
+        state = get_algorithm_state(main_loop.algorithm)
+        arrays = {ALGORITHM_STATE_KEY.format(index): variable.get_value()
+                  for index, variable in enumerate(state)}
+        arrays[ALGORITHM_STATE_NAMES_KEY] = numpy.array(
+            [_state_name(variable) for variable in state], dtype=str)
+        numpy.savez(self.path_to_algorithm_state, **arrays)
+
     def dump_log(self, main_loop):
         with open(self.path_to_log, "wb") as destination:
             pickle_dump(main_loop.log, destination)
@@ -132,6 +183,7 @@ class MainLoopDumpManager(object):
             os.mkdir(self.folder)
         self.dump_parameters(main_loop)
         self.dump_iteration_state(main_loop)
+        self.dump_algorithm_state(main_loop)
         self.dump_log(main_loop)
 
     def load_parameters(self):
@@ -141,6 +193,38 @@ class MainLoopDumpManager(object):
         with open(self.path_to_iteration_state, "rb") as source:
             return cPickle.load(source)
 
+    def load_algorithm_state(self):
+        """Load the values of the algorithm state variables.
+
+        Returns
+        -------
+        A list of :class:`~numpy.ndarray` in the order given by
+        :func:`get_algorithm_state`.
+
+        """
+        source = numpy.load(self.path_to_algorithm_state)
+        values = [source[ALGORITHM_STATE_KEY.format(index)]
+                  for index in range(len(source.files))
+                  if ALGORITHM_STATE_KEY.format(index) in source.files]
+        source.close()
+        return values
+
+    def load_algorithm_state_names(self):
+        """Load the names of the algorithm state variables.
+
+        Returns
+        -------
+        A list of strings in the order of :meth:`load_algorithm_state`,
+        or ``None`` for dumps made before the names were stored.
+
+        """
+        source = numpy.load(self.path_to_algorithm_state)
+        names = None
+        if ALGORITHM_STATE_NAMES_KEY in source.files:
+            names = [str(name) for name in source[ALGORITHM_STATE_NAMES_KEY]]
+        source.close()
+        return names
+
     def load_log(self):
         with open(self.path_to_log, "rb") as source:
             return cPickle.load(source)
@@ -151,8 +235,58 @@ class MainLoopDumpManager(object):
                 self.load_log())
 
     def load_to(self, main_loop):
-        """Loads the dump from the root folder into the main loop."""
+        """Loads the dump from the root folder into the main loop.
+
+        The algorithm state is only restored if it was dumped, dumps
+        made by older versions of Blocks do not contain it. The master
+        copies of the parameters kept by the algorithm, if any, are part
+        of its state, without it they are set to the loaded parameter
+        values.
+
+        """
         parameters, iteration_state, log = self.load()
         main_loop.model.set_param_values(parameters)
+        if hasattr(main_loop.algorithm, 'reset_master_copies'):
+            main_loop.algorithm.reset_master_copies()
+        if os.path.exists(self.path_to_algorithm_state):
+            self.load_algorithm_state_to(main_loop.algorithm)
+        else:
+            logger.warning("no algorithm state found in the dump, the state"
+                           " of the training algorithm will be reset")
         main_loop.iteration_state = iteration_state
         main_loop.log = log
+
+    def load_algorithm_state_to(self, algorithm):
+        """Loads the dumped algorithm state into an algorithm."""
+        state = get_algorithm_state(algorithm)
+        values = self.load_algorithm_state()
+        if len(state) != len(values):
+            raise ValueError("the dump contains {} algorithm state variables,"
+                             " the algorithm has {}".format(len(values),
+                                                            len(state)))
+        names = self.load_algorithm_state_names()
+        if names is not None:
+            # The values of every name are assigned in their dump order
+            values_by_name = OrderedDict()
+            for name, value in zip(names, values):
+                values_by_name.setdefault(name, []).append(value)
+            values = []
+            for variable in state:
+                name = _state_name(variable)
+                if not values_by_name.get(name):
+                    raise ValueError("no value for the algorithm state "
+                                     "variable {} in the dump".format(name))
+                values.append(values_by_name[name].pop(0))
+        for variable, value in zip(state, values):
+            if variable.get_value(borrow=True).shape != value.shape:
+                raise ValueError("shape mismatch for algorithm state variable"
+                                 " {}: expected {}, got {}".format(
+                                     variable,
+                                     variable.get_value(borrow=True).shape,
+                                     value.shape))
+            variable.set_value(value)
+
+
+def _state_name(variable):
+    """The name an algorithm state variable is stored under."""
+    return variable.name if variable.name else ''
@@ -1,9 +1,21 @@
 """Extensions for monitoring the training process."""
+import copy
 import logging
+from collections import OrderedDict
+import multiprocessing
+import traceback
+
+import theano
+from picklable_itertools.extras import equizip
+from six.moves import queue
 
 from blocks.extensions import SimpleExtension, TrainingExtension
 from blocks.algorithms import DifferentiableCostMinimizer
-from blocks.monitoring.evaluators import AggregationBuffer, DatasetEvaluator
+from blocks.graph import ComputationGraph
+from blocks.monitoring.aggregation import MonitoredQuantity
+from blocks.utils import named_copy
+from blocks.monitoring.evaluators import (AggregationBuffer,
+                                          CachedDataStream, DatasetEvaluator)
 
 PREFIX_SEPARATOR = '_'
 logger = logging.getLogger()
@@ -62,24 +74,411 @@ class DataStreamMonitoring(SimpleExtension, MonitoringExtension):
     data_stream : instance of :class:`.DataStream`
         The data stream to monitor on. A data epoch is requested
         each time monitoring is done.
+    cache : bool, optional
+        If ``True``, the batches of the data stream are cached when it is
+        first monitored on, and read from the cache afterwards, see
+        :class:`.CachedDataStream`. Only use this if all epochs of the
+        data stream are the same. ``False`` by default.
+    cache_memory_limit : int, optional
+        The maximum size of the cache in bytes when it is kept in memory.
+        If the data does not fit, the data stream is used as if there was
+        no cache. Unlimited by default.
+    cache_path : str, optional
+        A directory to which the batches are written as they are read,
+        and from where they are memory-mapped. By default the cache is
+        kept in memory.
+    out_of_process : bool, optional
+        If ``True``, the monitoring is done in a separate process, while
+        the training continues. Every time monitoring is requested, a
+        snapshot of the values of the shared variables the monitored
+        variables depend on (e.g. the parameters) is sent to this
+        process. The results are written to the log row of the iteration
+        at which the snapshot was taken once they are available, and at
+        the latest after training. If the training is interrupted or
+        fails, the process is terminated and the snapshots still queued
+        are not monitored on. The process is forked from the training
+        process after the Theano functions are compiled, which the GPU
+        backends do not support, so this is only available when Theano
+        runs on the CPU. ``False`` by default.
+    max_in_flight : int, optional
+        When monitoring out of process, the maximum number of snapshots
+        waiting to be monitored on. If reached, the training is blocked
+        until the oldest one is done. 1 by default.
+
+    share_evaluation : bool, optional
+        If ``True``, the monitoring extensions of the main loop with this
+        option that monitor on the same data stream at the same time
+        share a single pass over the data, see
+        :class:`MonitoringCoordinator`. All their values are then
+        computed when the first of them is run, i.e. before the
+        extensions run between them in the same callback. ``False`` by
+        default.
+    max_batches : int, optional
+        If given, the variables are only estimated on at most this number
+        of batches, and the standard errors and confidence intervals of
+        the estimates are recorded as well, see
+        :meth:`.DatasetEvaluator.evaluate`. The estimates are recorded
+        under the names of the variables with the ``_estimate`` suffix.
+        Only averages can be estimated this way.
+    max_seconds : float, optional
+        If given, the variables are only estimated on the batches that
+        can be evaluated in about this number of seconds.
+    subset_seed : int, optional
+        If given, the seed used to choose a random subset of
+        `max_batches` batches, which is the same every time. For a
+        :class:`~fuel.streams.DataStream` with an iteration scheme only
+        the chosen batches are read, other data streams are read entirely
+        to choose them. If ``None``, the first batches are used and only
+        they are read. ``None`` by default.
+    full_evaluation_every : int, optional
+        If given together with a budget, every this many times the
+        monitoring is done, it is done on the whole data stream.
+    num_workers : int, optional
+        If given, the whole data stream is evaluated by this number of
+        worker processes, see :meth:`.DatasetEvaluator.evaluate`. The
+        evaluation is then not shared with other extensions. With
+        `cache`, the first evaluation is done without workers, to record
+        the cache that the workers read afterwards.
+
+    Notes
+    -----
+    When monitoring out of process, the records are not available to
+    the extensions run in the same callback, e.g. to stop training early
+    or to print them, but only to the extensions run after they arrive.
+    The pending snapshots are dropped when the extension is pickled.
 
     """
     PREFIX_SEPARATOR = '_'
 
-    def __init__(self, variables, data_stream, updates=None, **kwargs):
+    def __init__(self, variables, data_stream, updates=None, cache=False,
+                 cache_memory_limit=None, cache_path=None,
+                 out_of_process=False, max_in_flight=1,
+                 share_evaluation=False, max_batches=None, max_seconds=None,
+                 subset_seed=None, full_evaluation_every=None,
+                 num_workers=None, **kwargs):
         kwargs.setdefault("after_epoch", True)
         kwargs.setdefault("before_first_epoch", True)
         super(DataStreamMonitoring, self).__init__(**kwargs)
+        self.variables = variables
+        self.updates = updates
         self._evaluator = DatasetEvaluator(variables, updates)
+        self._raw_data_stream = data_stream
+        if cache:
+            data_stream = CachedDataStream(data_stream, cache_memory_limit,
+                                           cache_path)
         self.data_stream = data_stream
+        self.out_of_process = out_of_process
+        self.max_in_flight = max_in_flight
+        if out_of_process:
+            if not theano.config.device.startswith('cpu'):
+                raise ValueError("monitoring out of process is not "
+                                 "supported on the device {}".format(
+                                     theano.config.device))
+            requires = []
+            for variable in variables:
+                if isinstance(variable, MonitoredQuantity):
+                    requires.extend(variable.requires)
+                else:
+                    requires.append(variable)
+            self._snapshot_variables = ComputationGraph(
+                requires).shared_variables
+        self._process = None
+        self.max_batches = max_batches
+        self.max_seconds = max_seconds
+        self.subset_seed = subset_seed
+        self.full_evaluation_every = full_evaluation_every
+        self._subsampled = max_batches is not None or max_seconds is not None
+        if self._subsampled and out_of_process:
+            raise ValueError("monitoring on a subset of the data is not "
+                             "supported out of process")
+        self._calls = 0
+        self.num_workers = num_workers
+        self.share_evaluation = (share_evaluation and not out_of_process and
+                                 not self._subsampled and
+                                 num_workers is None)
+        self._coordinator = None
 
     def do(self, callback_name, *args):
         """Write the values of monitored variables to the log."""
+        if self.out_of_process:
+            self._submit_snapshot()
+            return
         logger.info("Monitoring on auxiliary data started")
-        value_dict = self._evaluator.evaluate(self.data_stream)
+        self._calls += 1
+        if self._subsampled and not (
+                self.full_evaluation_every and
+                self._calls % self.full_evaluation_every == 0):
+            value_dict = self._evaluator.evaluate(
+                self.data_stream, self.max_batches, self.max_seconds,
+                self.subset_seed)
+        elif self.share_evaluation:
+            if self._coordinator is None:
+                MonitoringCoordinator.for_main_loop(self.main_loop)
+            value_dict = self._coordinator.evaluate(self, callback_name)
+        else:
+            value_dict = self._evaluator.evaluate(
+                self.data_stream, num_workers=self.num_workers)
         self.add_records(self.main_loop.log, value_dict.items())
         logger.info("Monitoring on auxiliary data finished")
 
+    def is_due(self, callback_name):
+        """Check whether :meth:`do` is invoked in the callback.
+
+        Parameters
+        ----------
+        callback_name : str
+            The name of the callback being run by the main loop.
+
+        """
+        return any(name == callback_name and predicate(self.main_loop.log)
+                   for name, predicate, _ in self._conditions)
+
+    def dispatch(self, callback_invoked, *from_main_loop):
+        if self._process is not None:
+            self._collect_results()
+        super(DataStreamMonitoring, self).dispatch(callback_invoked,
+                                                   *from_main_loop)
+        if self._process is not None and callback_invoked in (
+                'after_training', 'on_error', 'on_interrupt'):
+            # The snapshots still queued are only monitored on when the
+            # training finishes normally, not when it was interrupted
+            interrupted = (
+                self.main_loop.status.get('epoch_interrupt_received') or
+                self.main_loop.status.get('batch_interrupt_received'))
+            if callback_invoked == 'after_training' and not interrupted:
+                self._collect_results(wait_for=0)
+                self._stop_process()
+            else:
+                self._stop_process(terminate=True)
+
+    def _submit_snapshot(self):
+        if self._process is None:
+            self._start_process()
+        self._collect_results(wait_for=self.max_in_flight - 1)
+        iteration = self.main_loop.status['iterations_done']
+        logger.info("Monitoring on auxiliary data at iteration {} "
+                    "submitted".format(iteration))
+        self._tasks.put((iteration, [variable.get_value()
+                                     for variable in
+                                     self._snapshot_variables]))
+        self._in_flight += 1
+
+    def _start_process(self):
+        self._tasks = multiprocessing.Queue()
+        self._results = multiprocessing.Queue()
+        self._in_flight = 0
+        self._process = multiprocessing.Process(
+            target=_evaluate_snapshots,
+            args=(self._evaluator, self.data_stream,
+                  self._snapshot_variables, self._tasks, self._results))
+        self._process.daemon = True
+        self._process.start()
+
+    def _stop_process(self, terminate=False):
+        """Stop the monitoring process.
+
+        Parameters
+        ----------
+        terminate : bool, optional
+            If ``True``, the process is terminated right away instead of
+            after monitoring on the snapshots still queued. ``False`` by
+            default.
+
+        """
+        if terminate:
+            self._process.terminate()
+        else:
+            self._tasks.put(None)
+        self._process.join()
+        self._process = None
+
+    def _collect_results(self, wait_for=None):
+        """Write the available results to the log.
+
+        Parameters
+        ----------
+        wait_for : int, optional
+            If given, blocks until at most this number of snapshots is
+            still being monitored on.
+
+        """
+        while self._in_flight:
+            block = wait_for is not None and self._in_flight > wait_for
+            try:
+                iteration, value_dict, error = self._results.get(block)
+            except queue.Empty:
+                return
+            self._in_flight -= 1
+            if error is not None:
+                raise Exception("Monitoring at iteration {} failed:\n{}"
+                                .format(iteration, error))
+            row = self.main_loop.log[iteration]
+            for name, value in value_dict.items():
+                row[self._record_name(name)] = value
+            logger.info("Monitoring on auxiliary data at iteration {} "
+                        "finished".format(iteration))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attribute in ['_process', '_tasks', '_results', '_in_flight']:
+            state.pop(attribute, None)
+        state['_process'] = None
+        return state
+
+
+class MonitoringCoordinator(object):
+    """Shares a pass over the data between monitoring extensions.
+
+    Several :class:`DataStreamMonitoring` extensions often monitor on the
+    same data stream at the same time, e.g. one monitoring the costs and
+    another one monitoring some :class:`.MonitoredQuantity`. Instead of
+    each of them compiling its own function and reading all the data,
+    the coordinator evaluates the variables of all the extensions that
+    are due with a single :class:`.DatasetEvaluator`, and hence a single
+    compiled function, in which the common subexpressions are computed
+    once. The values are then handed out to every extension, which
+    records them under its own prefix.
+
+    Parameters
+    ----------
+    extensions : list of :class:`DataStreamMonitoring`
+        The extensions monitoring on the same data stream.
+
+    Notes
+    -----
+    The coordinators are created automatically for the extensions with
+    `share_evaluation` set, see :meth:`for_main_loop`.
+
+    """
+    def __init__(self, extensions):
+        self.extensions = extensions
+        for extension in extensions:
+            extension._coordinator = self
+        self._evaluators = {}
+        self._key = None
+        self._values = {}
+
+    @classmethod
+    def for_main_loop(cls, main_loop):
+        """Create coordinators for the extensions of a main loop.
+
+        The extensions sharing their evaluation are grouped by their data
+        stream, the data stream before caching it if requested.
+
+        Parameters
+        ----------
+        main_loop : :class:`.MainLoop`
+            The main loop.
+
+        """
+        groups = OrderedDict()
+        for extension in main_loop.extensions:
+            if (isinstance(extension, DataStreamMonitoring) and
+                    extension.share_evaluation):
+                groups.setdefault(id(extension._raw_data_stream),
+                                  []).append(extension)
+        for extensions in groups.values():
+            cls(extensions)
+
+    def evaluate(self, extension, callback_name):
+        """Evaluate the variables of an extension.
+
+        The values are computed for all the extensions due in the same
+        callback at once, the following calls in the same callback
+        return the values computed in the first one.
+
+        Parameters
+        ----------
+        extension : :class:`DataStreamMonitoring`
+            The extension whose variables are requested.
+        callback_name : str
+            The name of the callback being run by the main loop.
+
+        Returns
+        -------
+        dict
+            A mapping from the names of the variables of the extension
+            to their values.
+
+        """
+        status = extension.main_loop.log.status
+        key = (str(callback_name), status['iterations_done'],
+               status['epochs_done'])
+        if key != self._key or extension not in self._values:
+            due = [other for other in self.extensions
+                   if other is extension or other.is_due(callback_name)]
+            self._key = key
+            self._values = self._evaluate(due)
+        return self._values[extension]
+
+    def _evaluate(self, extensions):
+        if len(extensions) == 1:
+            extension, = extensions
+            return {extension:
+                    extension._evaluator.evaluate(extension.data_stream)}
+        group = tuple(self.extensions.index(extension)
+                      for extension in extensions)
+        if group not in self._evaluators:
+            self._evaluators[group] = self._merge(extensions)
+        evaluator, names = self._evaluators[group]
+        values = evaluator.evaluate(extensions[0].data_stream)
+        return dict((extension, dict((name, values[merged_name])
+                                     for name, merged_name in names[i]))
+                    for i, extension in enumerate(extensions))
+
+    @staticmethod
+    def _merge(extensions):
+        """Build an evaluator for the variables of several extensions.
+
+        The variables monitored by several extensions are evaluated once.
+        Different variables with the same name are renamed.
+
+        """
+        variables = []
+        updates = OrderedDict()
+        names = []
+        merged_names = {}
+        for extension in extensions:
+            extension_names = []
+            for variable in extension.variables:
+                if id(variable) not in merged_names:
+                    merged = variable
+                    if any(variable.name == other.name
+                           for other in variables):
+                        merged = _renamed(variable, '{}_{}'.format(
+                            len(variables), variable.name))
+                    merged_names[id(variable)] = merged.name
+                    variables.append(merged)
+                extension_names.append(
+                    (variable.name, merged_names[id(variable)]))
+            names.append(extension_names)
+            if extension.updates:
+                updates.update(extension.updates)
+        return DatasetEvaluator(variables, updates), names
+
+
+def _renamed(variable, name):
+    """A copy of a variable or a monitored quantity with another name."""
+    if isinstance(variable, MonitoredQuantity):
+        renamed = copy.copy(variable)
+        renamed.name = name
+        return renamed
+    renamed = named_copy(variable, name)
+    if hasattr(variable.tag, 'aggregation_scheme'):
+        renamed.tag.aggregation_scheme = variable.tag.aggregation_scheme
+    return renamed
+
+
+def _evaluate_snapshots(evaluator, data_stream, variables, tasks, results):
+    """Monitor on the snapshots from a queue until ``None`` is received."""
+    for iteration, values in iter(tasks.get, None):
+        try:
+            for variable, value in equizip(variables, values):
+                variable.set_value(value, borrow=True)
+            results.put((iteration, evaluator.evaluate(data_stream), None))
+        except Exception:
+            results.put((iteration, None, traceback.format_exc()))
+
 
 class TrainingDataMonitoring(SimpleExtension, MonitoringExtension):
     """Monitors values of Theano variables on training batches.
@@ -141,3 +540,30 @@ class TrainingDataMonitoring(SimpleExtension, MonitoringExtension):
             self.add_records(self.main_loop.log,
                              self._buffer.get_aggregated_values().items())
             self._buffer.initialize_aggregators()
+
+
+class PaddingMonitoring(SimpleExtension, MonitoringExtension):
+    """Records the fraction of padding of a bucketed data stream.
+
+    The fraction of the time steps that are padding in the batches
+    produced so far in the current epoch, see
+    :attr:`.Bucketing.padding_fraction`, is recorded under the name
+    ``padding_fraction``. By default it is recorded after every epoch,
+    when it covers the whole epoch.
+
+    Parameters
+    ----------
+    bucketing : :class:`.Bucketing`
+        The data stream whose padding is monitored, e.g. the data stream
+        of the main loop or the one it wraps.
+
+    """
+    def __init__(self, bucketing, **kwargs):
+        kwargs.setdefault("after_epoch", True)
+        super(PaddingMonitoring, self).__init__(**kwargs)
+        self.bucketing = bucketing
+
+    def do(self, callback_name, *args):
+        self.add_records(self.main_loop.log,
+                         [('padding_fraction',
+                           self.bucketing.padding_fraction)])
@@ -5,25 +5,30 @@ import logging
 from blocks.extensions import SimpleExtension, TrainingExtension
 from blocks.dump import MainLoopDumpManager
 from blocks.utils import reraise_as
-from blocks.serialization import secure_pickle_dump
+from blocks.serialization import (ArrayStore, secure_dump,
+                                  secure_pickle_dump)
 
 logger = logging.getLogger(__name__)
 
 LOADED_FROM = "loaded_from"
 SAVED_TO = "saved_to"
+DEDUPLICATED_BYTES = "deduplicated_bytes"
 
 
 class Checkpoint(SimpleExtension):
     """Saves a pickled version of the main loop to the disk.
 
     The pickled main loop can be later reloaded and training can be
-    resumed.
+    resumed, e.g. by using :func:`blocks.serialization.load` or the
+    ``blocks-continue`` script.
 
     Makes a `SAVED_TO` record in the log with the serialization destination
     in the case of success and ``None`` in the case of failure. The
     value of the record is a tuple of paths to which saving was done
     (there can be more than one if the user added a condition
-    with an argument, see :meth:`do` docs).
+    with an argument, see :meth:`do` docs). When deduplicating arrays,
+    also makes a `DEDUPLICATED_BYTES` record with the number of array
+    bytes that did not have to be written.
 
     Parameters
     ----------
@@ -35,6 +40,19 @@ class Checkpoint(SimpleExtension):
         the attribute name preceded by an underscore before the
         `path` extension. The whole main loop will still be pickled
         as usual.
+    use_cpickle : bool, optional
+        If ``True`` (default), the main loop is pickled as usual. If
+        ``False``, it is serialized with :func:`blocks.serialization.dump`,
+        which does not require a high recursion limit for big Theano
+        graphs, stores NumPy arrays out-of-band and is typically faster.
+    deduplicate : bool, optional
+        If ``True``, all the files of a checkpoint save their arrays to
+        one :class:`~blocks.serialization.ArrayStore`, a directory next
+        to `path` named like it with an ``_arrays`` suffix. Arrays, e.g.
+        the parameters, which are shared by the main loop and the
+        attributes saved separately are then written only once, as are
+        arrays unchanged since the previous checkpoint. Requires
+        `use_cpickle` to be ``False``. ``False`` by default.
 
     Notes
     -----
@@ -48,12 +66,18 @@ class Checkpoint(SimpleExtension):
 
 
     """
-    def __init__(self, path, save_separately=None, **kwargs):
+    def __init__(self, path, save_separately=None, use_cpickle=True,
+                 deduplicate=False, **kwargs):
         kwargs.setdefault("after_training", True)
         super(Checkpoint, self).__init__(**kwargs)
+        if deduplicate and use_cpickle:
+            raise ValueError("deduplicating arrays requires use_cpickle "
+                             "to be False")
 
         self.path = path
         self.save_separately = save_separately
+        self.use_cpickle = use_cpickle
+        self.deduplicate = deduplicate
 
         if not self.save_separately:
             self.save_separately = []
@@ -77,6 +101,18 @@ class Checkpoint(SimpleExtension):
         return {attribute: root + "_" + attribute + ext
                 for attribute in self.save_separately}
 
+    def array_store_path(self, path):
+        """Compute the path of the array store used when deduplicating.
+
+        Parameters
+        ----------
+        path : str
+            Path to which the main checkpoint file is being saved.
+
+        """
+        root, ext = os.path.splitext(path)
+        return root + "_arrays"
+
     def do(self, callback_name, *args):
         """Pickle the main loop object to the disk.
 
@@ -93,11 +129,27 @@ class Checkpoint(SimpleExtension):
             already_saved_to = self.main_loop.log.current_row.get(SAVED_TO, ())
             self.main_loop.log.current_row[SAVED_TO] = (
                 already_saved_to + (path,))
-            secure_pickle_dump(self.main_loop, path)
+            kwargs = {}
+            if self.deduplicate:
+                kwargs['array_store'] = ArrayStore(
+                    self.array_store_path(path))
+            save = secure_pickle_dump if self.use_cpickle else secure_dump
+            save(self.main_loop, path, **kwargs)
             filenames = self.save_separately_filenames(path)
             for attribute in self.save_separately:
-                secure_pickle_dump(getattr(self.main_loop, attribute),
-                                   filenames[attribute])
+                save(getattr(self.main_loop, attribute),
+                     filenames[attribute], **kwargs)
+            if self.deduplicate:
+                array_store = kwargs['array_store']
+                # All the files using the store have been rewritten, so
+                # the arrays they no longer refer to can go.
+                array_store.remove_unused()
+                self.main_loop.log.current_row[DEDUPLICATED_BYTES] = (
+                    array_store.bytes_saved)
+                logger.info("Checkpoint wrote {} bytes of arrays, {} "
+                            "bytes were deduplicated"
+                            .format(array_store.bytes_written,
+                                    array_store.bytes_saved))
         except Exception:
             self.main_loop.log.current_row[SAVED_TO] = None
             raise
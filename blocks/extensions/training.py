@@ -27,6 +27,12 @@ class SharedVariableModifier(SimpleExtension):
         iterations done (``int``) and old value of the shared variable
         (with the same dtype as `parameter`).
 
+    See Also
+    --------
+    :mod:`blocks.algorithms.schedules`
+        Schedules computed by the training function itself, which avoid
+        calling Python after every batch.
+
     """
     def __init__(self, parameter, function, **kwargs):
         kwargs.setdefault("after_batch", True)
@@ -44,7 +44,7 @@ class NdarrayInitialization(object):
         """
         if not shape:
             shape = var.get_value(borrow=True, return_internal_type=True).shape
-        var.set_value(self.generate(rng, shape))
+        var.set_value(self.generate(rng, shape).astype(var.dtype))
 
 
 class Constant(NdarrayInitialization):
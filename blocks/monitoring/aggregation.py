@@ -2,9 +2,12 @@
 import logging
 from abc import ABCMeta, abstractmethod
 
+import numpy
+import theano
 from six import add_metaclass
 from theano import tensor
 from theano.ifelse import ifelse
+from theano.tensor.extra_ops import cumsum
 
 from blocks.utils import shared_like
 
@@ -28,7 +31,18 @@ class AggregationScheme(object):
     variable: :class:`~tensor.TensorVariable`
         The variable that holds the desired value on a single batch.
 
+    Attributes
+    ----------
+    intensive : bool
+        Whether the value on a dataset is an average over its examples or
+        batches, as opposed to e.g. a sum, a count or a maximum. Only the
+        values of intensive schemes can be estimated on a subset of the
+        batches, see :meth:`.DatasetEvaluator.evaluate`. ``False`` by
+        default.
+
     """
+    intensive = False
+
     @abstractmethod
     def get_aggregator(self):
         """Return a new Aggregator for this variable."""
@@ -69,6 +83,21 @@ class Aggregator(object):
         Theano variable that holds the final value based on accumulated
         partial results. *readout_variable must only consist of shared
         variables and constants.*
+    accumulation_increments : list of tuples, optional
+        Pairs of an accumulator and its increment for the accumulators
+        which are initialized to zero and to which the increment is added
+        for every batch. The updates doing so must be part of the
+        initialization and accumulation updates as well. Listing them
+        here allows the scalar ones of many aggregators to be packed
+        into a single buffer, see :class:`.AggregationBuffer`.
+    merge_rules : list of tuples, optional
+        How to merge the partial results of aggregators accumulating
+        different parts of a dataset, e.g. in different processes. Every
+        shared variable updated by the aggregator is given as a triple
+        of the variable, a function merging a list of its values, and
+        either ``None`` or a shared variable flagging whether the
+        variable holds a value (only the values so flagged are merged).
+        If not given, the partial results can not be merged.
 
     Attributes
     ----------
@@ -76,7 +105,8 @@ class Aggregator(object):
 
     """
     def __init__(self, aggregation_scheme, initialization_updates=None,
-                 accumulation_updates=None, readout_variable=None):
+                 accumulation_updates=None, readout_variable=None,
+                 accumulation_increments=None, merge_rules=None):
         self.aggregation_scheme = aggregation_scheme
         self.readout_variable = readout_variable
 
@@ -84,8 +114,118 @@ class Aggregator(object):
             initialization_updates = []
         if accumulation_updates is None:
             accumulation_updates = []
+        if accumulation_increments is None:
+            accumulation_increments = []
         self.initialization_updates = initialization_updates
         self.accumulation_updates = accumulation_updates
+        self.accumulation_increments = accumulation_increments
+        self.merge_rules = merge_rules
+
+
+def _merge_sum(values):
+    return numpy.sum(values, axis=0)
+
+
+def _merge_max(values):
+    return numpy.max(values, axis=0)
+
+
+def _merge_min(values):
+    return numpy.min(values, axis=0)
+
+
+def _merge_last(values):
+    # The partial results are given in the order of their last batches
+    return values[-1]
+
+
+def _accumulate(variable, combine, neutral, merge):
+    """Accumulate the values of a variable over batches elementwise.
+
+    For a scalar variable the accumulator is initialized to the neutral
+    element of `combine`, so that accumulating does not need to branch.
+    The shape of other variables is not known before the first batch, so
+    a flag marks whether the accumulator holds a value already.
+
+    Parameters
+    ----------
+    variable : :class:`~tensor.TensorVariable`
+        The variable to accumulate.
+    combine : function
+        Combines the accumulator and the value of the variable.
+    neutral : float
+        The neutral element of `combine`.
+    merge : function
+        Merges a list of values of the accumulator, see
+        :class:`Aggregator`.
+
+    Returns
+    -------
+    accumulator : :class:`~tensor.TensorSharedVariable`
+        The accumulator.
+    initialization_updates : list of tuples
+    accumulation_updates : list of tuples
+    merge_rules : list of tuples
+
+    """
+    variable = tensor.as_tensor_variable(variable)
+    accumulator = shared_like(variable)
+    neutral = tensor.constant(neutral, dtype=accumulator.dtype)
+    if variable.ndim == 0:
+        return (accumulator, [(accumulator, neutral)],
+                [(accumulator, tensor.cast(combine(accumulator, variable),
+                                           accumulator.dtype))],
+                [(accumulator, merge, None)])
+    initialized = shared_like(0.)
+    # Only the accumulator is selected, so that both branches are valid
+    # even when not evaluated lazily.
+    previous = ifelse(initialized, accumulator,
+                      tensor.cast(tensor.zeros_like(variable) + neutral,
+                                  accumulator.dtype))
+    return (accumulator,
+            [(accumulator, tensor.zeros_like(accumulator)),
+             (initialized, 0.)],
+            [(accumulator, tensor.cast(combine(previous, variable),
+                                       accumulator.dtype)),
+             (initialized, 1.)],
+            [(accumulator, merge, initialized),
+             (initialized, _merge_max, None)])
+
+
+def _sum_aggregator(aggregation_scheme, variables, readout):
+    """An aggregator summing variables over batches.
+
+    Parameters
+    ----------
+    aggregation_scheme : :class:`AggregationScheme`
+        The aggregation scheme constructing the aggregator.
+    variables : list of :class:`~tensor.TensorVariable`
+        The variables to sum.
+    readout : function
+        Computes the readout variable from the accumulators.
+
+    """
+    accumulators = []
+    initialization_updates = []
+    accumulation_updates = []
+    increments = []
+    merge_rules = []
+    for variable in variables:
+        variable = tensor.as_tensor_variable(variable)
+        accumulator, initialization, accumulation, merge = _accumulate(
+            variable, tensor.add, 0, _merge_sum)
+        accumulators.append(accumulator)
+        initialization_updates.extend(initialization)
+        accumulation_updates.extend(accumulation)
+        merge_rules.extend(merge)
+        if accumulator.ndim == 0:
+            increments.append((accumulator, variable))
+    return Aggregator(aggregation_scheme=aggregation_scheme,
+                      initialization_updates=initialization_updates,
+                      accumulation_updates=accumulation_updates,
+                      accumulation_increments=increments,
+                      merge_rules=merge_rules,
+                      readout_variable=readout(*accumulators))
 
 
 class Mean(AggregationScheme):
@@ -99,38 +239,16 @@ class Mean(AggregationScheme):
         Theano variable for the denominator e.g. the batch size
 
     """
+    intensive = True
+
     def __init__(self, numerator, denominator):
         self.numerator = numerator
         self.denominator = denominator
 
     def get_aggregator(self):
-        initialized = shared_like(0.)
-        numerator_acc = shared_like(self.numerator)
-        denominator_acc = shared_like(self.denominator)
-
-        conditional_update_num = ifelse(initialized,
-                                        self.numerator + numerator_acc,
-                                        self.numerator)
-        conditional_update_den = ifelse(initialized,
-                                        self.denominator + denominator_acc,
-                                        self.denominator)
-
-        initialization_updates = [(numerator_acc,
-                                   tensor.zeros_like(numerator_acc)),
-                                  (denominator_acc,
-                                   tensor.zeros_like(denominator_acc)),
-                                  (initialized, 0.)]
-        accumulation_updates = [(numerator_acc,
-                                 conditional_update_num),
-                                (denominator_acc,
-                                 conditional_update_den),
-                                (initialized, 1.)]
-        aggregator = Aggregator(aggregation_scheme=self,
-                                initialization_updates=initialization_updates,
-                                accumulation_updates=accumulation_updates,
-                                readout_variable=(numerator_acc /
-                                                  denominator_acc))
-        return aggregator
+        return _sum_aggregator(self, [self.numerator, self.denominator],
+                               lambda numerator, denominator:
+                               numerator / denominator)
 
 
 def mean(numerator, denominator=1.):
@@ -141,8 +259,263 @@ def mean(numerator, denominator=1.):
     return variable
 
 
+class Sum(AggregationScheme):
+    """Aggregation scheme which sums the values over batches.
+
+    Parameters
+    ----------
+    variable : :class:`~tensor.TensorVariable`
+        The variable to sum.
+
+    """
+    def __init__(self, variable):
+        self.variable = variable
+
+    def get_aggregator(self):
+        return _sum_aggregator(self, [self.variable],
+                               lambda accumulator: accumulator)
+
+
+class Count(AggregationScheme):
+    """Aggregation scheme which counts the examples.
+
+    Parameters
+    ----------
+    variable : :class:`~tensor.TensorVariable`
+        A variable whose first axis is the batch axis, e.g. the input.
+        The lengths of this axis are summed over the batches. If the
+        variable is a scalar, the batches are counted instead.
+
+    """
+    def __init__(self, variable):
+        self.variable = variable
+
+    def get_aggregator(self):
+        count = (tensor.constant(1, dtype='int64') if self.variable.ndim == 0
+                 else tensor.cast(self.variable.shape[0], 'int64'))
+        return _sum_aggregator(self, [count],
+                               lambda accumulator: accumulator)
+
+
+class Max(AggregationScheme):
+    """Aggregation scheme which takes the maximum over batches.
+
+    The maximum is taken elementwise, over the values of the variable for
+    every batch. To get the maximum over the examples, aggregate the
+    maximum over the batch, e.g. ``Max(cost.max())``.
+
+    Parameters
+    ----------
+    variable : :class:`~tensor.TensorVariable`
+        The variable to take the maximum of.
+
+    """
+    def __init__(self, variable):
+        self.variable = variable
+
+    def get_aggregator(self):
+        accumulator, initialization_updates, accumulation_updates, merge = (
+            _accumulate(self.variable, tensor.maximum,
+                        _extreme(self.variable.dtype, -1), _merge_max))
+        return Aggregator(aggregation_scheme=self,
+                          initialization_updates=initialization_updates,
+                          accumulation_updates=accumulation_updates,
+                          merge_rules=merge,
+                          readout_variable=accumulator)
+
+
+class Min(AggregationScheme):
+    """Aggregation scheme which takes the minimum over batches.
+
+    See :class:`Max` for details.
+
+    Parameters
+    ----------
+    variable : :class:`~tensor.TensorVariable`
+        The variable to take the minimum of.
+
+    """
+    def __init__(self, variable):
+        self.variable = variable
+
+    def get_aggregator(self):
+        accumulator, initialization_updates, accumulation_updates, merge = (
+            _accumulate(self.variable, tensor.minimum,
+                        _extreme(self.variable.dtype, 1), _merge_min))
+        return Aggregator(aggregation_scheme=self,
+                          initialization_updates=initialization_updates,
+                          accumulation_updates=accumulation_updates,
+                          merge_rules=merge,
+                          readout_variable=accumulator)
+
+
+def _extreme(dtype, sign):
+    """The largest (sign 1) or smallest (sign -1) value of a dtype."""
+    if dtype.startswith('int') or dtype.startswith('uint'):
+        info = numpy.iinfo(dtype)
+        return info.max if sign > 0 else info.min
+    return sign * numpy.inf
+
+
+class ExponentialMovingAverage(AggregationScheme):
+    r"""Aggregation scheme for the exponential moving average over batches.
+
+    The average is initialized to zero, and corrected for the bias this
+    introduces by dividing by :math:`1 - \text{decay}^t` after :math:`t`
+    batches.
+
+    Parameters
+    ----------
+    variable : :class:`~tensor.TensorVariable`
+        The variable to average.
+    decay : float, optional
+        The weight of the previous average, 0.9 by default.
+
+    """
+    def __init__(self, variable, decay=0.9):
+        self.variable = variable
+        self.decay = decay
+
+    def get_aggregator(self):
+        decay = self.decay
+        # The average depends on the order of the batches, so the partial
+        # results can not be merged.
+        average, initialization_updates, accumulation_updates, _ = (
+            _accumulate(self.variable,
+                        lambda average, value:
+                        decay * average + (1 - decay) * value, 0, None))
+        counter = _sum_aggregator(self, [tensor.constant(1, dtype='int64')],
+                                  lambda accumulator: accumulator)
+        return Aggregator(
+            aggregation_scheme=self,
+            initialization_updates=(initialization_updates +
+                                    counter.initialization_updates),
+            accumulation_updates=(accumulation_updates +
+                                  counter.accumulation_updates),
+            accumulation_increments=counter.accumulation_increments,
+            readout_variable=(average /
+                              (1 - decay ** counter.readout_variable)))
+
+
+class Histogram(AggregationScheme):
+    """Aggregation scheme which counts the values falling into bins.
+
+    The elements of the variable are counted in a fixed number of bins
+    of equal width, so the memory used does not depend on the amount of
+    data. The counting is done by Theano, hence the values never need to
+    be copied from the device. The readout is the vector of counts.
+
+    Parameters
+    ----------
+    variable : :class:`~tensor.TensorVariable`
+        The variable whose values are counted, e.g. activations.
+    bounds : tuple of float
+        The lower bound of the first and the upper bound of the last bin.
+        Values outside of them, infinities included, are counted in the
+        first or the last bin. NaN values are not counted.
+    bins : int, optional
+        The number of bins, 10 by default.
+
+    """
+    def __init__(self, variable, bounds, bins=10):
+        self.variable = variable
+        self.bounds = bounds
+        self.bins = bins
+
+    @property
+    def edges(self):
+        """The edges of the bins."""
+        return numpy.linspace(self.bounds[0], self.bounds[1], self.bins + 1)
+
+    def _counts(self):
+        """Return the accumulator of the counts and its updates."""
+        low, high = self.bounds
+        width = (high - low) / float(self.bins)
+        values = self.variable.flatten()
+        # Casting NaN to an integer gives an arbitrary index, so NaN
+        # values are put in the first bin and counted as zero
+        counted = tensor.eq(tensor.isnan(values), 0)
+        values = tensor.switch(counted, values, low)
+        indices = tensor.cast(
+            tensor.clip(tensor.floor((values - low) / width),
+                        0, self.bins - 1), 'int64')
+        counts = theano.shared(numpy.zeros(self.bins, dtype='int64'),
+                               name='{}_histogram'.format(self.variable.name))
+        return (counts, [(counts, tensor.zeros_like(counts))],
+                [(counts, tensor.inc_subtensor(
+                    counts[indices], tensor.cast(counted, 'int64')))],
+                [(counts, _merge_sum, None)])
+
+    def get_aggregator(self):
+        counts, initialization_updates, accumulation_updates, merge = (
+            self._counts())
+        return Aggregator(aggregation_scheme=self,
+                          initialization_updates=initialization_updates,
+                          accumulation_updates=accumulation_updates,
+                          merge_rules=merge,
+                          readout_variable=counts)
+
+
+class Quantiles(Histogram):
+    """Aggregation scheme which estimates quantiles of the values.
+
+    The quantiles are interpolated from a histogram, see
+    :class:`Histogram`, so they are precise up to the width of its bins.
+    The readout is the vector of the estimated quantiles.
+
+    Parameters
+    ----------
+    variable : :class:`~tensor.TensorVariable`
+        The variable whose values are summarized.
+    bounds : tuple of float
+        The range of the histogram used for the estimation.
+    quantiles : tuple of float, optional
+        The quantiles to estimate, between 0 and 1. By default, the
+        median, the quartiles and the 5th and 95th percentiles.
+    bins : int, optional
+        The number of bins of the histogram, 1000 by default.
+
+    Notes
+    -----
+    The quantiles are NaN if no values were counted.
+
+    """
+    def __init__(self, variable, bounds,
+                 quantiles=(0.05, 0.25, 0.5, 0.75, 0.95), bins=1000):
+        super(Quantiles, self).__init__(variable, bounds, bins)
+        self.quantiles = quantiles
+
+    def get_aggregator(self):
+        counts, initialization_updates, accumulation_updates, merge = (
+            self._counts())
+        cumulative = cumsum(counts)
+        targets = (tensor.constant(numpy.array(self.quantiles)) *
+                   cumulative[-1])
+        # The bin of every quantile is the first one the cumulative count
+        # of which reaches the target.
+        indices = tensor.minimum(
+            (cumulative[None, :] < targets[:, None]).sum(axis=1),
+            self.bins - 1)
+        below = tensor.concatenate([[0], cumulative])[indices]
+        fractions = ((targets - below) /
+                     tensor.maximum(counts[indices], 1))
+        edges = tensor.constant(self.edges)
+        estimates = edges[indices] + fractions * (edges[1] - edges[0])
+        # Without any counted value, e.g. with NaN values only, the
+        # quantiles are not defined
+        estimates = tensor.switch(tensor.gt(cumulative[-1], 0), estimates,
+                                  numpy.nan)
+        return Aggregator(aggregation_scheme=self,
+                          initialization_updates=initialization_updates,
+                          accumulation_updates=accumulation_updates,
+                          merge_rules=merge,
+                          readout_variable=estimates)
+
+
 class _DataIndependent(AggregationScheme):
     """Dummy aggregation scheme for values that don't depend on data."""
+    intensive = True
+
     def __init__(self, variable):
         self.variable = variable
 
@@ -150,6 +523,7 @@ class _DataIndependent(AggregationScheme):
         return Aggregator(aggregation_scheme=self,
                           initialization_updates=[],
                           accumulation_updates=[],
+                          merge_rules=[],
                           readout_variable=self.variable)
 
 
@@ -164,6 +538,7 @@ class TakeLast(AggregationScheme):
                           initialization_updates=[
                               (self.storage, tensor.zeros_like(self.storage))],
                           accumulation_updates=[(self.storage, self.variable)],
+                          merge_rules=[(self.storage, _merge_last, None)],
                           readout_variable=self.storage)
 
 
@@ -177,12 +552,25 @@ class MonitoredQuantity(object):
     accumulates results for every batch, and finally readout is called
     to get the accumulated results.
 
+    The accumulate method is given the values of the required variables
+    for a whole batch as NumPy arrays. For the evaluation not to be
+    limited by the speed of Python, it should process them with
+    vectorized NumPy operations rather than loop over the examples. See
+    :mod:`blocks.monitoring.quantities` for examples.
+
     Attributes
     ----------
     requires : list
         List of Theano variables needed to calculate this quantity.
     name : str
         The name of monitored quantity which appears in the log.
+    intensive : bool
+        Whether the quantity is an average over the examples or batches,
+        see :class:`AggregationScheme`. ``False`` by default.
+    mergeable : bool
+        Whether :meth:`get_state` and :meth:`merge_states` are
+        implemented, which is required to evaluate the quantity in
+        parallel. ``False`` by default.
 
     See Also
     --------
@@ -190,6 +578,9 @@ class MonitoredQuantity(object):
     :class:`~blocks.extensions.DataStreamMonitoring`
 
     """
+    intensive = False
+    mergeable = False
+
     def __init__(self, requires=None, name=None):
         if requires is None:
             requires = []
@@ -210,3 +601,28 @@ class MonitoredQuantity(object):
     def readout(self):
         """Readout the accumulated results to capture the final result."""
         pass
+
+    def get_state(self):
+        """Return the partial result accumulated so far.
+
+        Together with :meth:`merge_states` allows to accumulate parts of
+        a dataset separately, e.g. in different processes. Optional, set
+        `mergeable` when implementing it.
+
+        Returns
+        -------
+        A picklable object.
+
+        """
+        raise NotImplementedError
+
+    def merge_states(self, states):
+        """Set the accumulated result to the merge of partial results.
+
+        Parameters
+        ----------
+        states : list
+            Partial results returned by :meth:`get_state`.
+
+        """
+        raise NotImplementedError
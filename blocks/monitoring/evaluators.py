@@ -1,18 +1,41 @@
 from collections import OrderedDict
+import atexit
 import logging
-
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import traceback
+
+from itertools import islice
+
+import numpy
+from fuel.iterator import DataIterator
+from fuel.streams import DataStream
 from picklable_itertools.extras import equizip
+from six.moves import queue
 import theano
 from theano import tensor
 
 from blocks.utils import dict_subset
-from blocks.monitoring.aggregation import (_DataIndependent, Mean,
-                                           TakeLast, MonitoredQuantity)
+from blocks.monitoring.aggregation import (_DataIndependent, _merge_sum,
+                                           Mean, TakeLast, MonitoredQuantity)
 from blocks.graph import ComputationGraph
+from blocks.roles import has_roles, CARRIED_STATE
 from blocks.utils import reraise_as
 
 logger = logging.getLogger()
 
+ESTIMATE_SUFFIX = '_estimate'
+STDERR_SUFFIX = '_stderr'
+CI_LOW_SUFFIX = '_ci_low'
+CI_HIGH_SUFFIX = '_ci_high'
+# The quantile of the standard normal distribution for 95% confidence
+CONFIDENCE_Z = 1.96
+# How often the parallel evaluation checks that its workers are alive
+WORKER_POLL_SECONDS = 1
+
 
 class MonitoredQuantityBuffer(object):
     """Intermediate results of aggregating values of monitored-quantity.
@@ -40,10 +63,17 @@ class MonitoredQuantityBuffer(object):
     """
     def __init__(self, quantities):
         self.quantities = quantities
-        requires = []
+        self.requires = []
         for quantity in quantities:
-            requires += quantity.requires
-        self.requires = list(set(requires))
+            for requirement in quantity.requires:
+                if requirement not in self.requires:
+                    self.requires.append(requirement)
+        # The positions of the requirements of every quantity among the
+        # computed values, so that no lookups are done per batch.
+        self._requirement_indices = [
+            [self.requires.index(requirement)
+             for requirement in quantity.requires]
+            for quantity in quantities]
         self._initialized = False
 
         self.quantity_names = [q.name for q in self.quantities]
@@ -71,10 +101,20 @@ class MonitoredQuantityBuffer(object):
             raise Exception("To readout you must first initialize, then"
                             "process batches!")
         else:
-            for quantity in self.quantities:
+            for quantity, indices in equizip(self.quantities,
+                                             self._requirement_indices):
                 quantity.accumulate(
-                    *[numerical_values[self.requires.index(requirement)]
-                        for requirement in quantity.requires])
+                    *[numerical_values[index] for index in indices])
+
+    def get_state(self):
+        """Return the partial results of the quantities."""
+        return [quantity.get_state() for quantity in self.quantities]
+
+    def merge_states(self, states):
+        """Merge partial results returned by :meth:`get_state`."""
+        self._initialized = True
+        for i, quantity in enumerate(self.quantities):
+            quantity.merge_states([state[i] for state in states])
 
 
 class AggregationBuffer(object):
@@ -95,6 +135,13 @@ class AggregationBuffer(object):
         instead of :class:`_DataIndependent` for those variables that
         do not require data to be computed.
 
+    Notes
+    -----
+    The scalar accumulators to which the aggregators add an increment
+    every batch (see :attr:`.Aggregator.accumulation_increments`) are
+    packed into a single vector per dtype, so that accumulating all of
+    them takes a single update.
+
     Attributes
     ----------
     initialization_updates : list of tuples
@@ -106,6 +153,9 @@ class AggregationBuffer(object):
         representing the aggregated values.
     inputs : list of :class:`~tensor.TensorVariable`
         The list of inputs needed for accumulation.
+    merge_rules : list of tuples or None
+        The merge rules of the aggregators (see :class:`.Aggregator`), or
+        ``None`` if the partial results of some can not be merged.
 
     """
     def __init__(self, variables, use_take_last=False):
@@ -127,6 +177,8 @@ class AggregationBuffer(object):
         self.initialization_updates = []
         self.accumulation_updates = []
         self.readout_variables = OrderedDict()
+        self.merge_rules = []
+        increments = OrderedDict()
 
         for v in self.variables:
             logger.debug('variable to evaluate: %s', v.name)
@@ -145,10 +197,55 @@ class AggregationBuffer(object):
                     v.tag.aggregation_scheme = Mean(v, 1.0)
 
             aggregator = v.tag.aggregation_scheme.get_aggregator()
+            packed = set()
+            for accumulator, increment in aggregator.accumulation_increments:
+                if accumulator.ndim == 0:
+                    increments.setdefault(accumulator.dtype, []).append(
+                        (accumulator, increment))
+                    packed.add(accumulator)
             self.initialization_updates.extend(
-                aggregator.initialization_updates)
-            self.accumulation_updates.extend(aggregator.accumulation_updates)
+                update for update in aggregator.initialization_updates
+                if update[0] not in packed)
+            self.accumulation_updates.extend(
+                update for update in aggregator.accumulation_updates
+                if update[0] not in packed)
+            if aggregator.merge_rules is None:
+                self.merge_rules = None
+            elif self.merge_rules is not None:
+                self.merge_rules.extend(
+                    rule for rule in aggregator.merge_rules
+                    if rule[0] not in packed)
             self.readout_variables[v.name] = aggregator.readout_variable
+        self._pack_accumulators(increments)
+
+    def _pack_accumulators(self, increments):
+        """Replace scalar accumulators by the elements of flat buffers.
+
+        Parameters
+        ----------
+        increments : dict
+            A mapping from dtypes to lists of pairs of accumulators and
+            their increments.
+
+        """
+        replacements = {}
+        for dtype, pairs in increments.items():
+            buffer_ = theano.shared(numpy.zeros(len(pairs), dtype=dtype),
+                                    name='accumulators_{}'.format(dtype))
+            self.initialization_updates.append(
+                (buffer_, tensor.zeros_like(buffer_)))
+            self.accumulation_updates.append(
+                (buffer_, buffer_ + tensor.stack(
+                    *[tensor.cast(increment, dtype)
+                      for _, increment in pairs])))
+            if self.merge_rules is not None:
+                self.merge_rules.append((buffer_, _merge_sum, None))
+            for i, (accumulator, _) in enumerate(pairs):
+                replacements[accumulator] = buffer_[i]
+        if replacements:
+            for name, variable in self.readout_variables.items():
+                self.readout_variables[name] = theano.clone(
+                    variable, replace=replacements)
 
     def _compile(self):
         """Compiles Theano functions.
@@ -190,6 +287,238 @@ class AggregationBuffer(object):
         ret_vals = self._readout_fun()
         return dict(equizip(self.variable_names, ret_vals))
 
+    def get_state(self):
+        """Return the partial results of the aggregators.
+
+        Returns
+        -------
+        list of :class:`~numpy.ndarray`
+            The values of the shared variables in :attr:`merge_rules`.
+
+        """
+        if self.merge_rules is None:
+            raise ValueError("the partial results of some aggregators "
+                             "can not be merged")
+        return [variable.get_value() for variable, _, _ in self.merge_rules]
+
+    def merge_states(self, states):
+        """Merge partial results returned by :meth:`get_state`.
+
+        Parameters
+        ----------
+        states : list
+            The partial results to merge into the aggregators.
+
+        """
+        if self.merge_rules is None:
+            raise ValueError("the partial results of some aggregators "
+                             "can not be merged")
+        self._initialized = True
+        indices = dict((variable, i) for i, (variable, _, _)
+                       in enumerate(self.merge_rules))
+        for i, (variable, merge, flag) in enumerate(self.merge_rules):
+            values = [state[i] for state in states
+                      if flag is None or state[indices[flag]]]
+            variable.set_value(merge(values) if values else states[0][i])
+
+
+class CachedDataStream(object):
+    """Caches the batches of a data stream after the first epoch.
+
+    The first epoch is read from the wrapped data stream, and the batches
+    are recorded while being passed through. Later epochs are read from
+    the recorded batches, which saves reading and transforming the data
+    again. This is only correct when all epochs of the data stream are
+    the same, which is typically the case for validation data.
+
+    Batches of every source that have the same dtype and the same shape
+    apart from the first axis are concatenated into a single array, so
+    that a cached source takes one contiguous block of memory.
+
+    Parameters
+    ----------
+    data_stream : instance of :class:`.DataStream`
+        The data stream to cache.
+    memory_limit : int, optional
+        The maximum size of the cache in bytes when it is kept in memory.
+        If an epoch does not fit, the cache is discarded and the data
+        stream is used from then on. Unlimited by default.
+    path : str, optional
+        If given, the batches are appended to a file per source in a new
+        subdirectory of this directory, which is created if needed, as
+        they are read, and the files are memory-mapped instead of the
+        cache being kept in memory. Every data stream has its own
+        subdirectory, so that several data streams can be cached in the
+        same directory. The subdirectory is deleted when a recording is
+        abandoned before the end of the epoch, when the data stream is
+        garbage collected and when the process exits.
+
+    Notes
+    -----
+    Sources that are not NumPy arrays with a numeric dtype can not be
+    cached, in which case the data stream is used as well.
+
+    Batches cached in memory are copies, so that data streams which
+    reuse their arrays for the next batch do not change the cache.
+
+    The cache is not pickled; it is recorded again, in a subdirectory of
+    its own, on the first epoch after unpickling.
+
+    """
+    def __init__(self, data_stream, memory_limit=None, path=None):
+        self.data_stream = data_stream
+        self.memory_limit = memory_limit
+        self.path = path
+        self.streaming = False
+        self._cache = None
+        self._directory = None
+        self._owner = None
+
+    @property
+    def sources(self):
+        return self.data_stream.sources
+
+    @property
+    def cached(self):
+        return self._cache is not None
+
+    def get_epoch_iterator(self, as_dict=False):
+        if self.cached:
+            iterator = self._iterate_cache()
+        elif self.streaming:
+            iterator = self.data_stream.get_epoch_iterator()
+        else:
+            iterator = self._record()
+        for batch in iterator:
+            yield dict(zip(self.sources, batch)) if as_dict else batch
+
+    def _record(self):
+        batches = []
+        files = self._open_files() if self.path is not None else None
+        size = 0
+        completed = False
+        try:
+            for batch in self.data_stream.get_epoch_iterator():
+                if batches is not None:
+                    if not all(self._cacheable(data) for data in batch):
+                        logger.info("Data of types other than numeric "
+                                    "arrays can not be cached, the data "
+                                    "stream will be used instead")
+                        batches = None
+                    elif files is not None:
+                        batches.append(tuple(
+                            self._write(file_, data)
+                            for file_, data in equizip(files, batch)))
+                    else:
+                        size += sum(data.nbytes for data in batch)
+                        if (self.memory_limit is not None and
+                                size > self.memory_limit):
+                            logger.info(
+                                "The data stream does not fit into the "
+                                "cache memory limit of {} bytes, it will be "
+                                "used instead".format(self.memory_limit))
+                            batches = None
+                        else:
+                            batches.append(tuple(data.copy()
+                                                 for data in batch))
+                yield batch
+            completed = True
+        finally:
+            if files is not None:
+                for file_ in files:
+                    file_.close()
+                if not completed:
+                    self._remove_directory()
+        if batches is None:
+            self.streaming = True
+            self._remove_directory()
+        else:
+            self._store(batches)
+
+    @staticmethod
+    def _cacheable(data):
+        return isinstance(data, numpy.ndarray) and data.dtype.kind in 'biufc'
+
+    def _filename(self, source):
+        return os.path.join(self._directory, source + '.dat')
+
+    def _open_files(self):
+        if self._directory is None:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            self._directory = tempfile.mkdtemp(prefix='stream_',
+                                               dir=self.path)
+            self._owner = os.getpid()
+            atexit.register(shutil.rmtree, self._directory, True)
+        return [open(self._filename(source), 'wb')
+                for source in self.sources]
+
+    def _remove_directory(self):
+        # Forked processes share the directory, only its creator removes it
+        if self._directory is not None and self._owner == os.getpid():
+            shutil.rmtree(self._directory, ignore_errors=True)
+        self._directory = None
+
+    @staticmethod
+    def _write(file_, data):
+        """Append an array to a file, returning where it can be found."""
+        offset = file_.tell()
+        numpy.ascontiguousarray(data).tofile(file_)
+        return offset, data.shape, data.dtype
+
+    def _store(self, batches):
+        self._cache = []
+        for index, source in enumerate(self.sources):
+            entries = [batch[index] for batch in batches]
+            if self.path is None:
+                shapes = [array.shape for array in entries]
+                dtypes = [array.dtype for array in entries]
+            else:
+                shapes = [shape for _, shape, _ in entries]
+                dtypes = [dtype for _, _, dtype in entries]
+            if entries and all(
+                    len(shape) > 0 and shape[1:] == shapes[0][1:] and
+                    dtype == dtypes[0]
+                    for shape, dtype in zip(shapes, dtypes)):
+                ends = numpy.cumsum([0] + [shape[0] for shape in shapes])
+                if self.path is None:
+                    arrays = [numpy.concatenate(entries)]
+                else:
+                    arrays = [self._map(source, 0,
+                                        (ends[-1],) + shapes[0][1:],
+                                        dtypes[0])]
+            else:
+                ends = None
+                if self.path is None:
+                    arrays = entries
+                else:
+                    arrays = [self._map(source, offset, shape, dtype)
+                              for offset, shape, dtype in entries]
+            self._cache.append((ends, arrays))
+        self._num_batches = len(batches)
+
+    def _map(self, source, offset, shape, dtype):
+        if not numpy.prod(shape, dtype='int64'):
+            return numpy.empty(shape, dtype=dtype)
+        return numpy.memmap(self._filename(source), dtype=dtype, mode='r',
+                            offset=offset, shape=shape)
+
+    def _iterate_cache(self):
+        for i in range(self._num_batches):
+            yield tuple(arrays[0][ends[i]:ends[i + 1]]
+                        if ends is not None else arrays[i]
+                        for ends, arrays in self._cache)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_cache'] = None
+        state['_directory'] = None
+        return state
+
+    def __del__(self):
+        if getattr(self, '_directory', None) is not None:
+            self._remove_directory()
+
 
 class DatasetEvaluator(object):
     """A DatasetEvaluator evaluates many Theano variables or other quantities.
@@ -224,7 +553,14 @@ class DatasetEvaluator(object):
         intended to alter your model in any meaningfullway. A typical
         use case of this option arises when the theano function used
         for evaluation contains a call to:function:`~theano.scan` which
-        might have returned shared variable updates.
+        might have returned shared variable updates. The updates of
+        variables with the :const:`.CARRIED_STATE` role, i.e. of the
+        states carried across batches by stateful recurrent networks,
+        are ignored.
+
+    Notes
+    -----
+    The Theano functions are compiled when the evaluator is first used.
 
     """
     def __init__(self, variables, updates=None):
@@ -240,11 +576,9 @@ class DatasetEvaluator(object):
         variable_names = [v.name for v in variables]
         if len(set(variable_names)) < len(variables):
             raise ValueError("variables should have different names")
-        self.theano_buffer = AggregationBuffer(theano_variables)
-        self.monitored_quantities_buffer = MonitoredQuantityBuffer(
-            monitored_quantities)
+        self.variables = variables
         self.updates = updates
-        self._compile()
+        self._compiled = False
 
     def _compile(self):
         """Compiles Theano functions.
@@ -256,6 +590,12 @@ class DatasetEvaluator(object):
             be out-sourced to `ComputationGraph` to deal with it.
 
         """
+        if self._compiled:
+            return
+        self._compiled = True
+        self.theano_buffer = AggregationBuffer(self.theano_variables)
+        self.monitored_quantities_buffer = MonitoredQuantityBuffer(
+            self.monitored_quantities)
         inputs = []
         outputs = []
         updates = None
@@ -263,7 +603,12 @@ class DatasetEvaluator(object):
             updates = OrderedDict()
             updates.update(self.theano_buffer.accumulation_updates)
             if self.updates:
-                updates.update(self.updates)
+                # Monitoring must not change the states carried between
+                # training batches
+                updates.update(
+                    (variable, update) for variable, update in
+                    OrderedDict(self.updates).items()
+                    if not has_roles(variable, [CARRIED_STATE]))
             inputs += self.theano_buffer.inputs
         inputs += self.monitored_quantities_buffer.inputs
         outputs = self.monitored_quantities_buffer.requires
@@ -277,10 +622,12 @@ class DatasetEvaluator(object):
             self._accumulate_fun = None
 
     def initialize_aggregators(self):
+        self._compile()
         self.theano_buffer.initialize_aggregators()
         self.monitored_quantities_buffer.initialize()
 
     def process_batch(self, batch):
+        self._compile()
         try:
             input_names = [v.name for v in self.unique_inputs]
             batch = dict_subset(batch, input_names)
@@ -295,25 +642,122 @@ class DatasetEvaluator(object):
                 numerical_values)
 
     def get_aggregated_values(self):
+        self._compile()
         values = self.theano_buffer.get_aggregated_values()
         values.update(
             self.monitored_quantities_buffer.get_aggregated_values())
         return values
 
-    def evaluate(self, data_stream):
+    def get_state(self):
+        """Return the partial results accumulated so far.
+
+        Raises
+        ------
+        ValueError
+            If the partial results of some aggregation scheme can not be
+            merged.
+        NotImplementedError
+            If some monitored quantity does not support merging.
+
+        """
+        self._compile()
+        return (self.theano_buffer.get_state(),
+                self.monitored_quantities_buffer.get_state())
+
+    def merge_states(self, states):
+        """Merge partial results returned by :meth:`get_state`.
+
+        After merging, :meth:`get_aggregated_values` returns the values
+        as if all the data had been processed by this evaluator.
+
+        """
+        self._compile()
+        self.theano_buffer.merge_states([state[0] for state in states])
+        self.monitored_quantities_buffer.merge_states(
+            [state[1] for state in states])
+
+    def evaluate(self, data_stream, max_batches=None, max_seconds=None,
+                 seed=None, num_workers=None):
         """Compute the variables over a data stream.
 
+        If a budget is given by `max_batches` or `max_seconds`, the
+        variables are only estimated on a subset of the batches. Every
+        batch is then evaluated on its own, and the estimate is the
+        average of the values for the batches, which is only meaningful
+        for averages, i.e. variables with an intensive aggregation scheme
+        (see :class:`.AggregationScheme`) and intensive monitored
+        quantities. The estimate of every variable is returned under its
+        name with the `ESTIMATE_SUFFIX`, so that it is not mistaken for
+        its value on the whole data, together with its standard error
+        and the bounds of its 95% confidence interval, under the name of
+        the variable with the `STDERR_SUFFIX`, `CI_LOW_SUFFIX` and
+        `CI_HIGH_SUFFIX` suffixes respectively. If the data stream has no
+        batches, the estimates are NaN.
+
         Parameters
         ----------
         data_stream : instance of :class:`.DataStream`
             The data stream. Only the first epoch of data is used.
+        max_batches : int, optional
+            The maximum number of batches to evaluate on.
+        max_seconds : float, optional
+            The time after which no more batches are evaluated. At least
+            one batch is always evaluated.
+        seed : int, optional
+            If given together with `max_batches`, the batches are a
+            uniformly random subset of the epoch, which is the same for
+            every evaluation with the same seed. Otherwise the first
+            batches of the epoch are used, which is only a random subset
+            if the data stream is shuffled.
+        num_workers : int, optional
+            If given, the data is processed by this number of worker
+            processes. Every worker processes every `num_workers`-th
+            batch, after which their partial results are merged, see
+            :meth:`merge_states`. For a :class:`~fuel.streams.DataStream`
+            with an iteration scheme, every worker only requests the
+            data of its own batches. Other data streams are read
+            entirely by every worker. A :class:`CachedDataStream` whose
+            cache is not recorded yet is evaluated without workers, which
+            records the cache, and the workers read the cache afterwards.
+            Can not be combined with a budget.
 
         Returns
         -------
         A mapping from record names to the values computed on the provided
         dataset.
 
+        Raises
+        ------
+        ValueError
+            If a budget is given and some variable is not intensive, or
+            if workers are used and the partial results of some variable
+            or quantity can not be merged.
+
+        Notes
+        -----
+        For a :class:`~fuel.streams.DataStream` with an iteration scheme,
+        a random subset of batches is selected among the requests of the
+        epoch, and only the data of the selected batches is requested.
+        For other data streams it requires reading the whole epoch, and
+        keeping `max_batches` batches in memory. Only the evaluation is
+        limited to `max_batches` batches then, not the reading of the
+        data.
+
+        The worker processes are forked, so they use the functions
+        compiled by this evaluator, and the data stream must not rely on
+        resources that can not be shared between processes. If a worker
+        dies without sending its results, e.g. because it is killed, an
+        error is raised.
+
         """
+        if num_workers is not None:
+            if max_batches is not None or max_seconds is not None:
+                raise ValueError("evaluating on a subset can not be done "
+                                 "by several workers")
+            return self._evaluate_in_parallel(data_stream, num_workers)
+        if max_batches is not None or max_seconds is not None:
+            return self._evaluate_subset(data_stream, max_batches,
+                                         max_seconds, seed)
         self.initialize_aggregators()
         if self._accumulate_fun is not None:
             for batch in data_stream.get_epoch_iterator(as_dict=True):
@@ -324,3 +768,167 @@ class DatasetEvaluator(object):
                 'will not iterate the over data!')
 
         return self.get_aggregated_values()
+
+    def _evaluate_subset(self, data_stream, max_batches, max_seconds, seed):
+        self._compile()
+        extensive = [variable.name for variable in self.theano_variables
+                     if not variable.tag.aggregation_scheme.intensive]
+        extensive += [quantity.name for quantity
+                      in self.monitored_quantities if not quantity.intensive]
+        if extensive:
+            raise ValueError("only averages can be estimated on a subset "
+                             "of the batches, not {}"
+                             .format(", ".join(extensive)))
+        batches = data_stream.get_epoch_iterator(as_dict=True)
+        if max_batches is not None and seed is not None:
+            rng = numpy.random.RandomState(seed)
+            if (isinstance(data_stream, DataStream) and
+                    batches.request_iterator is not None):
+                batches = DataIterator(
+                    data_stream, _sample_batches(batches.request_iterator,
+                                                 max_batches, rng),
+                    as_dict=True)
+            else:
+                batches = _sample_batches(batches, max_batches, rng)
+        batch_values = []
+        start = time.time()
+        for batch in batches:
+            if ((max_batches is not None and
+                    len(batch_values) == max_batches) or
+                    (max_seconds is not None and batch_values and
+                     time.time() - start > max_seconds)):
+                break
+            self.initialize_aggregators()
+            if self._accumulate_fun is not None:
+                self.process_batch(batch)
+            batch_values.append(self.get_aggregated_values())
+        logger.debug('Estimated the variables on %d batches',
+                     len(batch_values))
+        values = {}
+        for name in [variable.name for variable in self.variables]:
+            if batch_values:
+                samples = numpy.array([batch[name]
+                                       for batch in batch_values])
+                estimate = samples.mean(axis=0)
+            else:
+                estimate = numpy.nan
+            if len(batch_values) > 1:
+                stderr = samples.std(axis=0, ddof=1) / numpy.sqrt(
+                    len(samples))
+            else:
+                stderr = numpy.nan * estimate
+            values[name + ESTIMATE_SUFFIX] = estimate
+            values[name + STDERR_SUFFIX] = stderr
+            values[name + CI_LOW_SUFFIX] = estimate - CONFIDENCE_Z * stderr
+            values[name + CI_HIGH_SUFFIX] = estimate + CONFIDENCE_Z * stderr
+        return values
+
+    def _evaluate_in_parallel(self, data_stream, num_workers):
+        self._compile()
+        if self.theano_buffer.merge_rules is None:
+            raise ValueError("the partial results of some aggregators "
+                             "can not be merged")
+        unmergeable = [quantity.name for quantity
+                       in self.monitored_quantities if not quantity.mergeable]
+        if unmergeable:
+            raise ValueError("the partial results of the monitored "
+                             "quantities {} can not be merged"
+                             .format(", ".join(unmergeable)))
+        if isinstance(data_stream, CachedDataStream):
+            if not (data_stream.cached or data_stream.streaming):
+                # Every worker would record a cache of its own, so the
+                # first epoch is evaluated here, which records the cache
+                # for the workers of the next evaluations
+                return self.evaluate(data_stream)
+            if data_stream.streaming:
+                data_stream = data_stream.data_stream
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(
+            target=_evaluate_shard,
+            args=(self, data_stream, worker, num_workers, results))
+            for worker in range(num_workers)]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        states = [None] * num_workers
+        last_batches = [None] * num_workers
+        try:
+            for _ in range(num_workers):
+                while True:
+                    try:
+                        worker, state, last_batch, error = results.get(
+                            timeout=WORKER_POLL_SECONDS)
+                        break
+                    except queue.Empty:
+                        _check_workers(workers, states)
+                if error is not None:
+                    raise Exception("Evaluation in worker {} failed:\n{}"
+                                    .format(worker, error))
+                states[worker] = state
+                last_batches[worker] = last_batch
+        finally:
+            for worker in workers:
+                worker.terminate()
+                worker.join()
+        # The partial results are merged in the order of the last batches
+        # the workers processed, so that the results of the last batch of
+        # the epoch are the last ones, e.g. for TakeLast
+        order = sorted(range(num_workers), key=last_batches.__getitem__)
+        self.merge_states([states[worker] for worker in order])
+        return self.get_aggregated_values()
+
+
+def _check_workers(workers, states):
+    """Raise an error if a worker died without sending its results."""
+    for index, worker in enumerate(workers):
+        if states[index] is None and worker.exitcode not in (None, 0):
+            raise Exception("Evaluation worker {} died with exit code {}"
+                            .format(index, worker.exitcode))
+
+
+def _evaluate_shard(evaluator, data_stream, worker, num_workers, results):
+    """Process every `num_workers`-th batch, starting from `worker`.
+
+    The data of a :class:`~fuel.streams.DataStream` with an iteration
+    scheme is requested for these batches only. Other data streams can
+    only be read sequentially, so the other batches are read and skipped.
+
+    """
+    try:
+        evaluator.initialize_aggregators()
+        last_batch = -1
+        if evaluator._accumulate_fun is not None:
+            epoch = data_stream.get_epoch_iterator(as_dict=True)
+            if (isinstance(data_stream, DataStream) and
+                    epoch.request_iterator is not None):
+                batches = DataIterator(
+                    data_stream, islice(epoch.request_iterator, worker,
+                                        None, num_workers),
+                    as_dict=True)
+            else:
+                batches = islice(epoch, worker, None, num_workers)
+            for i, batch in enumerate(batches):
+                evaluator.process_batch(batch)
+                last_batch = worker + i * num_workers
+        results.put((worker, evaluator.get_state(), last_batch, None))
+    except Exception:
+        results.put((worker, None, None, traceback.format_exc()))
+
+
+def _sample_batches(batches, size, rng):
+    """A uniformly random subset of batches or requests, in random order.
+
+    Uses reservoir sampling, so the number of batches needs not be known
+    in advance.
+
+    """
+    sample = []
+    for i, batch in enumerate(batches):
+        if i < size:
+            sample.append(batch)
+        else:
+            j = rng.randint(i + 1)
+            if j < size:
+                sample[j] = batch
+    rng.shuffle(sample)
+    return sample
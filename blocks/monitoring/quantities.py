@@ -0,0 +1,166 @@
+"""Monitored quantities computed with NumPy.
+
+These :class:`.MonitoredQuantity` subclasses accumulate whole batches
+with vectorized NumPy operations, so that monitoring them on large
+datasets is not limited by the speed of Python. Their partial results
+can be merged, so they can be evaluated in parallel.
+
+"""
+import numpy
+
+from blocks.monitoring.aggregation import MonitoredQuantity
+
+
+class Sum(MonitoredQuantity):
+    """The sum of the elements of a variable over a dataset.
+
+    Parameters
+    ----------
+    requires : list of :class:`~tensor.TensorVariable`
+        A single variable to sum.
+
+    """
+    mergeable = True
+
+    def initialize(self):
+        self.total = 0
+
+    def accumulate(self, value):
+        self.total += numpy.sum(value)
+
+    def readout(self):
+        return self.total
+
+    def get_state(self):
+        return self.total
+
+    def merge_states(self, states):
+        self.total = sum(states)
+
+
+class Count(MonitoredQuantity):
+    """The number of examples in a dataset.
+
+    Parameters
+    ----------
+    requires : list of :class:`~tensor.TensorVariable`
+        A single variable whose first axis is the batch axis, e.g. the
+        targets.
+
+    """
+    mergeable = True
+
+    def initialize(self):
+        self.count = 0
+
+    def accumulate(self, value):
+        self.count += len(value)
+
+    def readout(self):
+        return self.count
+
+    def get_state(self):
+        return self.count
+
+    def merge_states(self, states):
+        self.count = sum(states)
+
+
+def _labels(predictions):
+    """Labels from either labels or the class probabilities."""
+    predictions = numpy.asarray(predictions)
+    if predictions.ndim == 2:
+        return predictions.argmax(axis=1)
+    return predictions
+
+
+class ConfusionMatrix(MonitoredQuantity):
+    """The confusion matrix of a classifier.
+
+    Parameters
+    ----------
+    requires : list of :class:`~tensor.TensorVariable`
+        The targets, a vector of labels, and the predictions, either a
+        vector of labels or a matrix of class probabilities.
+    num_classes : int
+        The number of classes.
+
+    Notes
+    -----
+    The element ``(i, j)`` of the matrix is the number of examples of
+    class ``i`` that were classified as ``j``.
+
+    """
+    mergeable = True
+
+    def __init__(self, num_classes, **kwargs):
+        super(ConfusionMatrix, self).__init__(**kwargs)
+        self.num_classes = num_classes
+
+    def initialize(self):
+        self.matrix = numpy.zeros((self.num_classes, self.num_classes),
+                                  dtype='int64')
+
+    def accumulate(self, targets, predictions):
+        # Labels are often stored in small integer types, in which the
+        # index of a pair would overflow
+        pairs = (self.num_classes *
+                 numpy.asarray(targets).ravel().astype('int64') +
+                 _labels(predictions).ravel().astype('int64'))
+        self.matrix += numpy.bincount(
+            pairs, minlength=self.num_classes ** 2).reshape(
+                self.num_classes, self.num_classes)
+
+    def readout(self):
+        return self.matrix
+
+    def get_state(self):
+        return self.matrix
+
+    def merge_states(self, states):
+        self.matrix = numpy.sum(states, axis=0)
+
+
+class TopKAccuracy(MonitoredQuantity):
+    """The ratio of examples with the target among the `k` best guesses.
+
+    Parameters
+    ----------
+    requires : list of :class:`~tensor.TensorVariable`
+        The targets, a vector of labels, and a matrix of class
+        probabilities or other scores.
+    k : int
+        The number of best scoring classes to consider.
+
+    Notes
+    -----
+    The ratio is NaN if no examples were seen.
+
+    """
+    intensive = True
+    mergeable = True
+
+    def __init__(self, k, **kwargs):
+        super(TopKAccuracy, self).__init__(**kwargs)
+        self.k = k
+
+    def initialize(self):
+        self.hits, self.examples_seen = 0, 0
+
+    def accumulate(self, targets, scores):
+        targets = numpy.asarray(targets).ravel()
+        top_k = numpy.argpartition(-scores, self.k - 1, axis=1)[:, :self.k]
+        self.hits += (top_k == targets[:, None]).any(axis=1).sum()
+        self.examples_seen += len(targets)
+
+    def readout(self):
+        if not self.examples_seen:
+            return numpy.nan
+        return float(self.hits) / self.examples_seen
+
+    def get_state(self):
+        return self.hits, self.examples_seen
+
+    def merge_states(self, states):
+        self.hits = sum(hits for hits, _ in states)
+        self.examples_seen = sum(examples for _, examples in states)
@@ -128,6 +128,13 @@ class InitialStateRole(ParameterRole):
 INITIAL_STATE = InitialStateRole()
 
 
+class CarriedStateRole(VariableRole):
+    pass
+
+#: The states a recurrent network carries from one batch to the next
+CARRIED_STATE = CarriedStateRole()
+
+
 class FilterRole(WeightRole):
     pass
 
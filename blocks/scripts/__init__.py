@@ -1,24 +1,62 @@
 import os.path
+from importlib import import_module
 
-from six.moves import cPickle
-
-from blocks.config import config
 from blocks.dump import MainLoopDumpManager
-from blocks.utils import change_recursion_limit
+from blocks.extensions.saveload import LoadFromDump
+from blocks.serialization import load
+
 
+def continue_training(path, factory=None):
+    """Resume training from a pickled main loop or a dump.
 
-def continue_training(path):
-    with change_recursion_limit(config.recursion_limit):
-        main_loop = cPickle.load(open(path, "rb"))
+    Parameters
+    ----------
+    path : str
+        The path to a main loop saved by :class:`.Checkpoint`, or, when
+        `factory` is given, the
+        path to a dump folder as created by :class:`.MainLoopDumpManager`.
+    factory : callable, optional
+        A function without arguments that builds the main loop from
+        scratch. If given, the main loop is not unpickled. Instead, the
+        main loop returned by the factory is used and the parameters,
+        the training algorithm state, the iteration state and the log are
+        loaded from the dump at `path` before training resumes. Since no
+        Theano graph has to be unpickled, this is typically much faster
+        and does not depend on the Theano version the dump was made with.
+
+    """
+    if factory is None:
+        with open(path, "rb") as source:
+            main_loop = load(source)
+    else:
+        if not os.path.isdir(path):
+            raise ValueError("no dump found at {}".format(path))
+        main_loop = factory()
+        main_loop.extensions.insert(0, LoadFromDump(path))
     main_loop.run()
 
 
+def import_factory(name):
+    """Import a main loop factory given its full dotted name.
+
+    Parameters
+    ----------
+    name : str
+        The name of the function, e.g. ``'my_experiment.build_main_loop'``.
+
+    """
+    module_name, _, function_name = name.rpartition('.')
+    if not module_name:
+        raise ValueError("expected a full dotted name, got {}".format(name))
+    return getattr(import_module(module_name), function_name)
+
+
 def dump(pickle_path, dump_path):
     if not dump_path:
         root, ext = os.path.splitext(pickle_path)
         if not ext:
             raise ValueError
         dump_path = root
-    with change_recursion_limit(config.recursion_limit):
-        main_loop = cPickle.load(open(pickle_path, "rb"))
+    with open(pickle_path, "rb") as source:
+        main_loop = load(source)
     MainLoopDumpManager(dump_path).dump(main_loop)
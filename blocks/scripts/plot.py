@@ -4,14 +4,12 @@ from __future__ import division, print_function
 import fnmatch
 
 from six import iteritems
-from six.moves import cPickle
 from collections import OrderedDict
 from functools import reduce
 
-from blocks.config import config
-from blocks.utils import change_recursion_limit
 from blocks.log import TrainingLog
 from blocks.main_loop import MainLoop
+from blocks.serialization import load
 
 try:
     from pandas import DataFrame
@@ -25,13 +23,13 @@ def load_log(fname):
 
     This function automatically handles various file formats that contain
     an instance of an :class:`TrainingLog`. This includes a pickled
-    Log object, a pickled :class:`MainLoop` or an experiment dump (TODO).
+    Log object, a pickled :class:`MainLoop`, the same objects serialized
+    with :func:`blocks.serialization.dump` or an experiment dump (TODO).
 
     """
-    with change_recursion_limit(config.recursion_limit):
-        with open(fname, 'rb') as f:
-            from_disk = cPickle.load(f)
-        # TODO: Load "dumped" experiments
+    with open(fname, 'rb') as f:
+        from_disk = load(f)
+    # TODO: Load "dumped" experiments
 
     if isinstance(from_disk, TrainingLog):
         log = from_disk
@@ -1,3 +1,32 @@
+"""Serialization of the main loop and other objects.
+
+Blocks provides two ways of serializing objects. The first one,
+:func:`pickle_dump`, is plain pickling, which for Theano graphs requires
+a high recursion limit (see ``recursion_limit`` in :mod:`blocks.config`),
+because the graph is serialized by recursively following the inputs of
+every node.
+
+The second one, :func:`dump` and :func:`load`, avoids this recursion. All
+Theano variables, applications and ops reachable from the object are
+pickled separately as entries of a flat node table, referring to each
+other by their index in this table. NumPy arrays are written out-of-band as
+``.npy`` files, each array only once no matter how many times it is
+referenced. The result is a zip archive with the following members:
+
+* ``pkl``: a sequence of pickles, namely the classes of the nodes in the
+  node table together with the order in which the states of the nodes
+  are set, the state of every node, and finally the object itself;
+* ``arrays/<index>.npy``: the arrays.
+
+Alternatively, the arrays can be saved to an :class:`ArrayStore` shared
+by several files, in which case they are referred to by the hash of
+their contents and the archive records the name of the store in the
+``array_store`` member.
+
+"""
+from contextlib import closing
+import hashlib
+from io import BytesIO
 import os
 from pickle import HIGHEST_PROTOCOL
 try:
@@ -6,11 +35,16 @@ except ImportError:
     DEFAULT_PROTOCOL = HIGHEST_PROTOCOL
 import shutil
 import tempfile
+import zipfile
 
+import numpy
 import six
 from six.moves import cPickle
+from theano.gof import Op
+from theano.gof.graph import Apply, Variable
 
-from blocks.utils import reraise_as
+from blocks.config import config
+from blocks.utils import change_recursion_limit, reraise_as
 
 PICKLING_ERROR = """
 
@@ -45,21 +79,26 @@ def pickle_dump(*args, **kwargs):
     try:
         cPickle.dump(*args, **kwargs)
     except Exception as e:
-        if six.PY3 and '<lambda>' in e.args[0]:
-            reraise_as("Pickling failed to pickle a lambda function." +
-                       LAMBDA_ERROR)
-        if six.PY3 and '<function' in e.args[0] and '<locals>' in e.args[0]:
-            reraise_as("Pickling failed to pickle a nested function." +
-                       NESTED_FUNCTION_ERROR)
-        if six.PY2 and 'function objects' in e.args[0]:
-            reraise_as("Pickling failed to pickle a function." +
-                       LAMBDA_ERROR + NESTED_FUNCTION_ERROR)
-        if ((six.PY2 and 'isinstancemethod' in e.args[0]) or
-                (six.PY3 and '<function' in e.args[0] and
-                 'attribute lookup' in e.args[0])):
-            reraise_as("Pickling failed to pickle a reference to a method." +
-                       INSTANCEMETHOD_ERROR)
-        reraise_as("Pickling failed." + PICKLING_ERROR)
+        _reraise_pickling_error(e)
+
+
+def _reraise_pickling_error(e):
+    """Reraise a pickling error with an informative message."""
+    if six.PY3 and '<lambda>' in e.args[0]:
+        reraise_as("Pickling failed to pickle a lambda function." +
+                   LAMBDA_ERROR)
+    if six.PY3 and '<function' in e.args[0] and '<locals>' in e.args[0]:
+        reraise_as("Pickling failed to pickle a nested function." +
+                   NESTED_FUNCTION_ERROR)
+    if six.PY2 and 'function objects' in e.args[0]:
+        reraise_as("Pickling failed to pickle a function." +
+                   LAMBDA_ERROR + NESTED_FUNCTION_ERROR)
+    if ((six.PY2 and 'isinstancemethod' in e.args[0]) or
+            (six.PY3 and '<function' in e.args[0] and
+             'attribute lookup' in e.args[0])):
+        reraise_as("Pickling failed to pickle a reference to a method." +
+                   INSTANCEMETHOD_ERROR)
+    reraise_as("Pickling failed." + PICKLING_ERROR)
 
 
 def secure_pickle_dump(object_, path):
@@ -73,15 +112,413 @@ def secure_pickle_dump(object_, path):
         The destination path.
 
     """
+    secure_dump(object_, path, dump_function=pickle_dump)
+
+
+def secure_dump(object_, path, dump_function=None, **kwargs):
+    r"""Robust serialization - does not corrupt your files when failed.
+
+    Parameters
+    ----------
+    object_ : object
+        The object to be saved to the disk.
+    path : str
+        The destination path.
+    dump_function : function, optional
+        The function that is used to perform the serialization. Must take
+        an object and file object as arguments. By default, :func:`dump`
+        is used.
+    \*\*kwargs
+        Keyword arguments to be passed to `dump_function`.
+
+    """
+    if dump_function is None:
+        dump_function = dump
     try:
         # Use the same destination directory, as /tmp can be too
         # small.  This also make the move to copy if the destination
         # wasn't on the same partition.
         with tempfile.NamedTemporaryFile(delete=False,
                                          dir=os.path.dirname(path)) as temp:
-            pickle_dump(object_, temp)
+            dump_function(object_, temp, **kwargs)
         shutil.move(temp.name, path)
     except:
         if "temp" in locals():
             os.remove(temp.name)
         raise
+
+
+PICKLE_MEMBER = 'pkl'
+ARRAY_MEMBER = 'arrays/{}.npy'
+ARRAY_STORE_MEMBER = 'array_store'
+NODE_ID = 'node'
+ARRAY_ID = 'array'
+STORED_ARRAY_ID = 'stored_array'
+
+
+def _write_array(array, file_):
+    numpy.lib.format.write_array(file_, array)
+
+
+class ArrayStore(object):
+    """A content-addressed store of NumPy arrays.
+
+    Every array is saved to the store directory as a ``.npy`` file named
+    after the SHA-1 hash of its dtype, shape and contents. Arrays with
+    equal contents are hence written only once, no matter how many files
+    refer to them.
+
+    Parameters
+    ----------
+    path : str
+        The directory of the store. Will be created if it does not
+        exist. Files serialized with the store refer to it by the name of
+        this directory only, so the store is expected to reside in the
+        same directory as these files.
+
+    Attributes
+    ----------
+    bytes_written : int
+        The number of array bytes written to the store by this instance.
+    bytes_saved : int
+        The number of array bytes that were not written because an array
+        with the same contents was already in the store.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.bytes_written = 0
+        self.bytes_saved = 0
+        self.keys = set()
+
+    @staticmethod
+    def key(array):
+        """Compute the key under which an array is stored."""
+        hash_ = hashlib.sha1()
+        hash_.update(six.b('{}{}'.format(array.dtype.str, array.shape)))
+        hash_.update(numpy.ascontiguousarray(array).data)
+        return hash_.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def add(self, array):
+        """Save an array to the store unless it is there already.
+
+        Returns
+        -------
+        str
+            The key of the array.
+
+        """
+        key = self.key(array)
+        if key in self.keys or os.path.exists(self.filename(key)):
+            self.bytes_saved += array.nbytes
+        else:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            secure_dump(array, self.filename(key), dump_function=_write_array)
+            self.bytes_written += array.nbytes
+        self.keys.add(key)
+        return key
+
+    def get(self, key):
+        """Load an array from the store."""
+        return numpy.load(self.filename(key))
+
+    def remove_unused(self):
+        """Delete the arrays not added using this instance.
+
+        Call this once all the files referring to the store have been
+        rewritten, to get rid of the arrays only older versions of these
+        files referred to.
+
+        """
+        # The directory is only created when the first array is added
+        if not os.path.exists(self.path):
+            return
+        for filename in os.listdir(self.path):
+            key, ext = os.path.splitext(filename)
+            if ext == '.npy' and key not in self.keys:
+                os.remove(os.path.join(self.path, filename))
+
+
+class _NullFile(object):
+    """A file object that discards everything written to it."""
+    def write(self, data):
+        pass
+
+
+class _PersistentObjects(object):
+    """Assigns persistent ids to graph nodes and NumPy arrays.
+
+    Theano variables, applications and ops are nodes: they are pickled
+    separately as entries of the node table.
+
+    Parameters
+    ----------
+    array_store : :class:`ArrayStore`, optional
+        If given, the arrays written are added to the store and referred
+        to by their keys.
+
+    Attributes
+    ----------
+    writing : bool
+        If ``False``, the pickle is discarded, so the arrays found are
+        not registered. Nodes are registered either way.
+    frozen : bool
+        If ``True``, encountering a node that was not registered before
+        is an error. Arrays can still be registered.
+
+    """
+    def __init__(self, array_store=None):
+        self.array_store = array_store
+        self.writing = False
+        self.frozen = False
+        self.nodes = []
+        self.arrays = []
+        self.array_keys = []
+        self.references = None
+        self._node_indices = {}
+        self._array_indices = {}
+
+    def persistent_id(self, object_):
+        if isinstance(object_, (Variable, Apply, Op)):
+            index = self._index(object_, self.nodes, self._node_indices,
+                                self.frozen)
+            if self.references is not None:
+                self.references.append(index)
+            return NODE_ID, index
+        if type(object_) is numpy.ndarray and not object_.dtype.hasobject:
+            if not self.writing:
+                # Some arrays, e.g. the state of random number generators,
+                # are created anew every time they are pickled, so only
+                # the arrays of the written pickle are registered.
+                return ARRAY_ID, 0
+            index = self._index(object_, self.arrays, self._array_indices)
+            if self.array_store is not None:
+                if index == len(self.array_keys):
+                    self.array_keys.append(self.array_store.add(object_))
+                return STORED_ARRAY_ID, self.array_keys[index]
+            return ARRAY_ID, index
+        return None
+
+    @staticmethod
+    def _index(object_, objects, indices, frozen=False):
+        # The objects are kept in the list, so their ids stay unique.
+        key = id(object_)
+        if key not in indices:
+            if frozen:
+                raise ValueError("{} was created while serializing"
+                                 .format(object_))
+            indices[key] = len(objects)
+            objects.append(object_)
+        return indices[key]
+
+
+def _get_state(node):
+    if hasattr(node, '__getstate__'):
+        return node.__getstate__()
+    return node.__dict__
+
+
+def _set_state(node, state):
+    if hasattr(node, '__setstate__'):
+        node.__setstate__(state)
+    else:
+        node.__dict__.update(state)
+
+
+def _dependency_order(references):
+    """Order the nodes so that nodes come after the ones they refer to.
+
+    Some nodes need the nodes they refer to be complete when their state
+    is set, e.g. :class:`theano.scalar.Composite` builds a function graph
+    from its inner graph. The nodes are hence ordered depth-first, each
+    node after the nodes its state refers to, apart from references
+    closing a cycle (e.g. between a variable and its owner). The
+    traversal uses an explicit stack instead of recursion.
+
+    Parameters
+    ----------
+    references : list of lists of int
+        The indices of the nodes referred to by the state of each node.
+
+    Returns
+    -------
+    list of int
+        The node indices in dependency order.
+
+    """
+    order = []
+    visited = [False] * len(references)
+    for root in range(len(references)):
+        if visited[root]:
+            continue
+        visited[root] = True
+        stack = [(root, iter(references[root]))]
+        while stack:
+            node, children = stack[-1]
+            for child in children:
+                if not visited[child]:
+                    visited[child] = True
+                    stack.append((child, iter(references[child])))
+                    break
+            else:
+                stack.pop()
+                order.append(node)
+    return order
+
+
+def _dump_all(object_, persistent, file_, protocol):
+    """Pickle the state of every node followed by the object itself.
+
+    The object is first pickled to a discarded file to find the nodes it
+    refers to. The state of the nodes is then pickled one node at a time,
+    in the order the nodes are found. Nodes refer to each other by
+    persistent ids, so the pickling never recurses into the inputs of a
+    node. New nodes are registered when they are encountered, hence the
+    worklist is processed until no new nodes are found. Finally the
+    object is pickled again, after the nodes, so that it is unpickled
+    once all the nodes are complete.
+
+    Returns
+    -------
+    list of lists of int
+        The indices of the nodes referred to by the state of each node.
+
+    """
+    discoverer = cPickle.Pickler(_NullFile(), protocol)
+    discoverer.persistent_id = persistent.persistent_id
+    discoverer.dump(object_)
+    persistent.writing = True
+    pickler = cPickle.Pickler(file_, protocol)
+    pickler.persistent_id = persistent.persistent_id
+    references = []
+    index = 0
+    while index < len(persistent.nodes):
+        persistent.references = []
+        references.append(persistent.references)
+        pickler.dump(_get_state(persistent.nodes[index]))
+        index += 1
+    persistent.references = None
+    persistent.frozen = True
+    pickler.dump(object_)
+    return references
+
+
+def dump(object_, file_, protocol=DEFAULT_PROTOCOL, array_store=None):
+    """Serialize an object containing Theano graphs without recursion.
+
+    See the module-level documentation for the description of the format.
+
+    Parameters
+    ----------
+    object_ : object
+        The object to be serialized, typically a :class:`.MainLoop`.
+    file_ : file
+        The destination. Must be opened in binary mode.
+    protocol : int, optional
+        The pickling protocol.
+    array_store : :class:`ArrayStore`, optional
+        If given, the arrays are saved to this store instead of the
+        archive itself, so that arrays shared by several files are
+        written only once.
+
+    Notes
+    -----
+    The state of the graph nodes is pickled once. The object itself is
+    pickled twice, first only to find the graph nodes it refers to, since
+    it has to be written after them.
+
+    The graph nodes are created before anything else is unpickled, and
+    their states are set in dependency order before the object itself is
+    unpickled, so objects that inspect graph nodes when being unpickled
+    (e.g. compiled Theano functions) will find them complete.
+
+    """
+    persistent = _PersistentObjects(array_store)
+    try:
+        pickled = BytesIO()
+        references = _dump_all(object_, persistent, pickled, protocol)
+        # The node table, needed to create the nodes before unpickling
+        # anything else, is written at the beginning
+        table = BytesIO()
+        cPickle.dump(([type(node) for node in persistent.nodes],
+                      _dependency_order(references)), table, protocol)
+    except Exception as e:
+        _reraise_pickling_error(e)
+    with closing(zipfile.ZipFile(file_, 'w', allowZip64=True)) as zip_file:
+        zip_file.writestr(PICKLE_MEMBER,
+                          table.getvalue() + pickled.getvalue())
+        if array_store is not None:
+            zip_file.writestr(ARRAY_STORE_MEMBER, os.path.basename(
+                os.path.normpath(array_store.path)))
+            return
+        for index, array in enumerate(persistent.arrays):
+            array_file = BytesIO()
+            _write_array(array, array_file)
+            zip_file.writestr(ARRAY_MEMBER.format(index),
+                              array_file.getvalue())
+
+
+def load(file_, array_store=None):
+    """Load an object serialized with :func:`dump`.
+
+    Files that were pickled as usual, e.g. with :func:`pickle_dump`, are
+    recognized and unpickled using the recursion limit from the Blocks
+    configuration.
+
+    Parameters
+    ----------
+    file_ : file
+        The file to load from. Must be opened in binary mode.
+    array_store : :class:`ArrayStore`, optional
+        The store the arrays were saved to. By default, the store the
+        file was serialized with is looked for in the directory of the
+        file.
+
+    Returns
+    -------
+    The deserialized object.
+
+    """
+    if not zipfile.is_zipfile(file_):
+        file_.seek(0)
+        with change_recursion_limit(config.recursion_limit):
+            return cPickle.load(file_)
+    file_.seek(0)
+    with closing(zipfile.ZipFile(file_, 'r')) as zip_file:
+        if (array_store is None and
+                ARRAY_STORE_MEMBER in zip_file.namelist()):
+            array_store = ArrayStore(os.path.join(
+                os.path.dirname(getattr(file_, 'name', '')),
+                zip_file.read(ARRAY_STORE_MEMBER).decode()))
+        nodes = []
+        arrays = {}
+
+        def persistent_load(persistent_id):
+            kind, index = persistent_id
+            if kind == NODE_ID:
+                return nodes[index]
+            if kind == ARRAY_ID:
+                if index not in arrays:
+                    arrays[index] = numpy.lib.format.read_array(
+                        BytesIO(zip_file.read(ARRAY_MEMBER.format(index))))
+                return arrays[index]
+            if kind == STORED_ARRAY_ID:
+                if index not in arrays:
+                    arrays[index] = array_store.get(index)
+                return arrays[index]
+            raise ValueError("unknown persistent id: {}"
+                             .format(persistent_id))
+
+        pickled = BytesIO(zip_file.read(PICKLE_MEMBER))
+        classes, order = cPickle.load(pickled)
+        nodes.extend(class_.__new__(class_) for class_ in classes)
+        unpickler = cPickle.Unpickler(pickled)
+        unpickler.persistent_load = persistent_load
+        states = [unpickler.load() for _ in nodes]
+        for index in order:
+            _set_state(nodes[index], states[index])
+        return unpickler.load()
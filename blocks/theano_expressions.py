@@ -1,12 +1,43 @@
 """Frequently used Theano expressions."""
+from operator import add
+
+from six.moves import reduce
 from theano import tensor
 
 
+def squared_norm(variable):
+    """Computes the squared L2 norm of a tensor.
+
+    The expression is remembered in the tag of `variable`, so that the
+    norms of the same gradients or steps asked for by several parts of a
+    training algorithm, e.g. by :class:`.StepClipping` and for
+    monitoring, are computed by a single reduction.
+
+    Parameters
+    ----------
+    variable : :class:`~tensor.TensorVariable` (or compatible)
+        The tensor.
+
+    """
+    variable = tensor.as_tensor_variable(variable)
+    # Tags are copied when graphs are cloned, hence the check that the
+    # remembered norm is the one of this very variable
+    cached = getattr(variable.tag, 'squared_norm', None)
+    if cached is not None and cached[0] is variable:
+        return cached[1]
+    norm = tensor.sqr(variable).sum()
+    variable.tag.squared_norm = (variable, norm)
+    return norm
+
+
 def l2_norm(tensors):
     """Computes the total L2 norm of a set of tensors.
 
     Converts all operands to :class:`~tensor.TensorVariable`
-    (see :func:`~tensor.as_tensor_variable`).
+    (see :func:`~tensor.as_tensor_variable`). The squared norms of the
+    tensors are summed instead of the tensors being joined, which avoids
+    copying them, and are shared with other norms (see
+    :func:`squared_norm`).
 
     Parameters
     ----------
@@ -14,8 +45,4 @@ def l2_norm(tensors):
         The tensors.
 
     """
-    flattened = [tensor.as_tensor_variable(t).flatten() for t in tensors]
-    flattened = [(t if t.ndim > 0 else t.dimshuffle('x'))
-                 for t in flattened]
-    joined = tensor.join(0, *flattened)
-    return tensor.sqrt(tensor.sqr(joined).sum())
+    return tensor.sqrt(reduce(add, [squared_norm(t) for t in tensors]))
@@ -0,0 +1,145 @@
+"""Transformers of Fuel data streams for training recurrent networks."""
+import logging
+from itertools import islice
+
+import numpy
+from fuel.transformers import Transformer
+from theano import config
+
+logger = logging.getLogger(__name__)
+
+
+class Bucketing(Transformer):
+    """Groups sequences of similar lengths into padded batches.
+
+    Reads the examples of a data stream into a buffer of several batches,
+    sorts the buffer by the lengths of the sequences of one source, and
+    cuts it into batches, which are padded like :class:`~fuel.transformers.
+    Padding` does. The sequences of a batch then have similar lengths, so
+    that little of the computation of a recurrent network is spent on the
+    padding.
+
+    Parameters
+    ----------
+    data_stream : :class:`~fuel.streams.AbstractDataStream` instance
+        The data stream to wrap. It must produce examples.
+    batch_size : int
+        The number of examples in a batch. The last batch of an epoch can
+        be smaller.
+    buffer_batches : int, optional
+        The number of batches sorted together. Defaults to 20.
+    sort_source : str, optional
+        The source of the sequences whose lengths are sorted. Defaults to
+        the first source.
+    mask_sources : tuple of strings, optional
+        The sources for which a mask is added, with the ``_mask`` suffix.
+        Defaults to all the sources.
+    mask_dtype : str, optional
+        The data type of the masks. Defaults to ``floatX``.
+
+    Attributes
+    ----------
+    total_elements : int
+        The number of time steps in the padded batches of `sort_source`
+        produced so far in the current epoch.
+    padding_elements : int
+        How many of these time steps are padding.
+
+    Notes
+    -----
+    The batches of a buffer are produced from the shortest to the
+    longest sequences. The fraction of padding of every epoch is logged
+    when the epoch ends, and can be recorded in the log of the main loop
+    with :class:`.PaddingMonitoring`.
+
+    """
+    def __init__(self, data_stream, batch_size, buffer_batches=20,
+                 sort_source=None, mask_sources=None, mask_dtype=None,
+                 **kwargs):
+        if not data_stream.produces_examples:
+            raise ValueError('the wrapped data stream must produce '
+                             'examples, not batches of examples')
+        super(Bucketing, self).__init__(
+            data_stream, produces_examples=False, **kwargs)
+        self.batch_size = batch_size
+        self.buffer_batches = buffer_batches
+        if sort_source is None:
+            sort_source = self.data_stream.sources[0]
+        self.sort_source = sort_source
+        if mask_sources is None:
+            mask_sources = self.data_stream.sources
+        self.mask_sources = mask_sources
+        self.mask_dtype = mask_dtype if mask_dtype else config.floatX
+        self.total_elements = 0
+        self.padding_elements = 0
+        self._batches = []
+
+    @property
+    def sources(self):
+        sources = []
+        for source in self.data_stream.sources:
+            sources.append(source)
+            if source in self.mask_sources:
+                sources.append(source + '_mask')
+        return tuple(sources)
+
+    @property
+    def padding_fraction(self):
+        """The fraction of the time steps of the epoch that are padding."""
+        if not self.total_elements:
+            return 0.
+        return self.padding_elements / float(self.total_elements)
+
+    def get_epoch_iterator(self, **kwargs):
+        self._batches = []
+        self.total_elements = 0
+        self.padding_elements = 0
+        return super(Bucketing, self).get_epoch_iterator(**kwargs)
+
+    def get_data(self, request=None):
+        if request is not None:
+            raise ValueError
+        if not self._batches:
+            self._fill_buffer()
+        if not self._batches:
+            logger.info("{:.1%} of the time steps of the epoch were "
+                        "padding".format(self.padding_fraction))
+            raise StopIteration
+        return self._batches.pop(0)
+
+    def _fill_buffer(self):
+        examples = list(islice(self.child_epoch_iterator,
+                               self.batch_size * self.buffer_batches))
+        sort_index = self.data_stream.sources.index(self.sort_source)
+        examples.sort(key=lambda example: len(example[sort_index]))
+        for start in range(0, len(examples), self.batch_size):
+            batch = list(zip(*examples[start:start + self.batch_size]))
+            lengths = [len(sequence) for sequence in batch[sort_index]]
+            self.total_elements += len(lengths) * max(lengths)
+            self.padding_elements += len(lengths) * max(lengths) - sum(
+                lengths)
+            self._batches.append(self._pad(batch))
+
+    def _pad(self, batch):
+        batch_with_masks = []
+        for source, source_batch in zip(self.data_stream.sources, batch):
+            if source not in self.mask_sources:
+                batch_with_masks.append(source_batch)
+                continue
+            sequences = [numpy.asarray(sequence) for sequence in source_batch]
+            lengths = [len(sequence) for sequence in sequences]
+            rest_shape = sequences[0].shape[1:]
+            if not all(sequence.shape[1:] == rest_shape
+                       for sequence in sequences):
+                raise ValueError("All dimensions except length must be "
+                                 "equal")
+            padded_batch = numpy.zeros(
+                (len(sequences), max(lengths)) + rest_shape,
+                dtype=sequences[0].dtype)
+            mask = numpy.zeros((len(sequences), max(lengths)),
+                               dtype=self.mask_dtype)
+            for i, sequence in enumerate(sequences):
+                padded_batch[i, :len(sequence)] = sequence
+                mask[i, :len(sequence)] = 1
+            batch_with_masks.extend([padded_batch, mask])
+        return tuple(batch_with_masks)
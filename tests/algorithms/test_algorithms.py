@@ -3,12 +3,16 @@ from collections import OrderedDict
 import numpy
 import theano
 from numpy.testing import assert_allclose, assert_raises
+from fuel.datasets import IterableDataset
 from theano import tensor
 
 from blocks.algorithms import (GradientDescent, StepClipping, VariableClipping,
                                CompositeRule, Scale, StepRule, BasicMomentum,
                                Momentum, AdaDelta, BasicRMSProp, RMSProp, Adam,
-                               AdaGrad, RemoveNotFinite, Restrict)
+                               AdaGrad, RemoveNotFinite, Restrict, LBFGS)
+from blocks.extensions import FinishAfter
+from blocks.graph import ComputationGraph
+from blocks.main_loop import MainLoop
 from blocks.utils import shared_floatx
 
 
@@ -123,6 +127,28 @@ def test_rmsprop():
     assert_allclose(f()[0], [0.06172134, 0.064699664])
 
 
+def test_gradient_descent_norms_shared():
+    W = shared_floatx(numpy.array([[1., 2.], [3., 4.]]))
+    b = shared_floatx(numpy.array([1., 2.]))
+    cost = (W ** 2).sum() + (b ** 3).sum()
+    algorithm = GradientDescent(cost=cost, params=[W, b],
+                                step_rule=StepClipping(1.))
+    norms = ComputationGraph([algorithm.total_gradient_norm] +
+                             list(algorithm.steps.values()))
+    # The squared norms of the gradients are computed once, not for
+    # the clipping and the total gradient norm separately
+    sums = [variable for variable in norms.variables
+            if variable.owner and isinstance(variable.owner.op,
+                                             tensor.elemwise.Sum) and
+            variable.owner.inputs[0].owner and
+            variable.owner.inputs[0].owner.op == tensor.sqr]
+    assert len(sums) == 2
+    gradient_norm = numpy.sqrt(
+        (4 * W.get_value() ** 2).sum() + (9 * b.get_value() ** 4).sum())
+    assert_allclose(algorithm.total_gradient_norm.eval(), gradient_norm)
+    assert_allclose(algorithm.total_step_norm.eval(), 1.)
+
+
 def test_step_clipping():
     rule1 = StepClipping(4)
     rule2 = StepClipping(5)
@@ -222,6 +248,65 @@ def test_adam():
     assert_allclose(f()[0], [0.00178724, 0.0018223], rtol=rtol)
 
 
+def test_step_rule_state_dtype():
+    for step_rule_class in [BasicMomentum, AdaDelta, BasicRMSProp, Adam,
+                            AdaGrad]:
+        outputs = []
+        for state_dtype in [None, 'float32']:
+            a = shared_floatx([3, 4])
+            cost = (a ** 2).sum()
+            steps, updates = step_rule_class(
+                state_dtype=state_dtype).compute_steps(
+                OrderedDict([(a, tensor.grad(cost, a))]))
+            for state, _ in updates:
+                if state.ndim:
+                    assert state.dtype == (state_dtype or
+                                           theano.config.floatX)
+            f = theano.function([], [steps[a]], updates=updates)
+            outputs.append([f()[0], f()[0]])
+        assert_allclose(outputs[0], outputs[1], rtol=1e-5)
+
+
+def test_factored_step_rules():
+    rows = numpy.array([1., 2., 3.])
+    columns = numpy.array([0.5, 1., 4., 2.])
+    W = shared_floatx(numpy.zeros((3, 4)))
+    b = shared_floatx(numpy.zeros(4))
+    gradients = OrderedDict([(W, shared_floatx(numpy.outer(rows, columns))),
+                             (b, shared_floatx(columns))])
+    for step_rule_class in [BasicRMSProp, Adam]:
+        outputs = []
+        for factored in [False, True]:
+            steps, updates = step_rule_class(
+                factored=factored).compute_steps(gradients)
+            f = theano.function([], list(steps.values()), updates=updates)
+            outputs.append([f(), f()])
+            if factored:
+                # Only the first moments of Adam keep the shape of W
+                assert (3, 4) not in [state.get_value().shape
+                                      for state, _ in updates
+                                      if state.name != 'mean']
+        # The squared gradients have rank one, which the factored running
+        # averages represent exactly
+        for full, factored in zip(outputs[0], outputs[1]):
+            for full_step, factored_step in zip(full, factored):
+                assert_allclose(full_step, factored_step, rtol=1e-6)
+
+
+def test_gradient_descent_step_rule_state_memory():
+    W = shared_floatx(numpy.zeros((100, 10)))
+    cost = (W ** 2).sum()
+    memory = []
+    for step_rule in [Scale(), Adam(), Adam(state_dtype='float32'),
+                      Adam(factored=True)]:
+        algorithm = GradientDescent(cost=cost, params=[W],
+                                    step_rule=step_rule)
+        memory.append(algorithm.step_rule_state_memory)
+    itemsize = numpy.dtype(theano.config.floatX).itemsize
+    assert memory == [0, (2000 + 1) * itemsize, 2000 * 4 + itemsize,
+                      (1000 + 110 + 1) * itemsize]
+
+
 def test_adagrad():
     a = shared_floatx([3, 4])
     cost = (a ** 2).sum()
@@ -278,3 +363,201 @@ def test_restrict():
     assert_allclose(steps[5].eval(), 25.0)
 
     assert updates == [(10, 100), (40, 400)]
+
+
+def test_gradient_descent_flat_buffers():
+    def train(flat_buffers, step_rule):
+        W = shared_floatx(numpy.arange(6).reshape(2, 3) / 5.)
+        b = shared_floatx([1., -2.])
+        c = shared_floatx(0.5)
+        cost = (tensor.sqr(tensor.dot(b, W)).sum() +
+                tensor.sqr(b - c).sum() + c ** 4)
+        algorithm = GradientDescent(cost=cost, params=[W, b, c],
+                                    step_rule=step_rule,
+                                    flat_buffers=flat_buffers)
+        algorithm.initialize()
+        for _ in range(3):
+            algorithm.process_batch(dict())
+        return algorithm, [W.get_value(), b.get_value(), c.get_value()]
+
+    for step_rule in [lambda: Scale(0.1), lambda: Momentum(0.1, 0.9),
+                      AdaDelta, Adam,
+                      lambda: CompositeRule([StepClipping(1.),
+                                             RMSProp(0.1)])]:
+        _, expected = train(False, step_rule())
+        algorithm, values = train(True, step_rule())
+        for value, expected_value in zip(values, expected):
+            assert_allclose(value, expected_value, rtol=1e-5)
+
+    algorithm, _ = train(True, AdaDelta())
+    assert [variable.get_value().shape
+            for variable, _ in algorithm.step_rule_updates] == [(9,), (9,)]
+    # The step rules that depend on the shapes of the parameters or on
+    # which parameter a step belongs to are rejected
+    for step_rule in [lambda: VariableClipping(1.),
+                      lambda: VariableClipping(1., axis=0),
+                      RemoveNotFinite,
+                      lambda: CompositeRule([Scale(0.1),
+                                             Restrict(Scale(0.1), [])])]:
+        train(False, step_rule())
+        assert_raises(ValueError, train, True, step_rule())
+
+
+def test_gradient_descent_sparse_updates():
+    def train(sparse_updates, step_rule, batches):
+        W = shared_floatx(numpy.arange(12).reshape(6, 2) / 10.)
+        b = shared_floatx([1., -1.])
+        indices = tensor.lvector('indices')
+        cost = tensor.sqr(W[indices] + b).sum() + tensor.sqr(b).sum()
+        algorithm = GradientDescent(cost=cost, params=[W, b],
+                                    step_rule=step_rule,
+                                    sparse_updates=sparse_updates)
+        algorithm.initialize()
+        norm = theano.function([indices], algorithm.total_gradient_norm)
+        norms = []
+        for batch in batches:
+            norms.append(norm(batch))
+            algorithm.process_batch(dict(indices=batch))
+        return algorithm, W.get_value(), b.get_value(), norms
+
+    batches = [numpy.array([1, 3, 1]), numpy.array([0, 1]),
+               numpy.array([2, 2])]
+    for step_rule in [lambda: Scale(0.1), lambda: AdaGrad(0.1)]:
+        expected = train(False, step_rule(), batches)
+        algorithm, W, b, norms = train(True, step_rule(), batches)
+        assert list(algorithm.sparse_indices) == [algorithm.params[0]]
+        assert_allclose(W, expected[1])
+        assert_allclose(b, expected[2])
+        assert_allclose(norms, expected[3])
+
+    # With momentum, the rows not selected in a batch are left untouched
+    _, dense_W, _, _ = train(False, Momentum(0.1, 0.9), batches)
+    _, W, _, _ = train(True, Momentum(0.1, 0.9), batches)
+    assert_allclose(W[4:], numpy.arange(8, 12).reshape(2, 2) / 10.)
+    assert not numpy.allclose(W[0], dense_W[0])
+    assert_allclose(W[2], dense_W[2])
+
+    # The cost of merging repeated rows is linear in the number of rows
+    # selected: comparing all the pairs of them would need 10^10 elements
+    batches = [numpy.arange(100000) % 3, numpy.arange(100000)[::-1] % 5]
+    expected = train(False, Adam(), batches)
+    algorithm, W, b, norms = train(True, Adam(), batches)
+    assert_allclose(W, expected[1])
+    assert_allclose(b, expected[2])
+    assert_allclose(norms, expected[3])
+
+
+def test_gradient_descent_sparse_updates_factored():
+    W = shared_floatx(numpy.ones((6, 2)))
+    indices = tensor.lvector('indices')
+    cost = tensor.sqr(W[indices]).sum()
+    for step_rule in [Adam(factored=True), RMSProp(factored=True)]:
+        assert_raises(ValueError, GradientDescent, cost=cost, params=[W],
+                      step_rule=step_rule, sparse_updates=True)
+    # The factored states are fine for the parameters updated densely
+    GradientDescent(cost=cost + tensor.sqr(W).sum(), params=[W],
+                    step_rule=Adam(factored=True), sparse_updates=True)
+
+
+def test_gradient_descent_master_copies():
+    def train(master_dtype):
+        W = theano.shared(numpy.ones(3, dtype='float32'))
+        algorithm = GradientDescent(cost=W.sum(), params=[W],
+                                    step_rule=Scale(1e-8),
+                                    master_dtype=master_dtype)
+        algorithm.initialize()
+        for _ in range(10):
+            algorithm.process_batch(dict())
+        return algorithm, W
+
+    _, W = train(None)
+    assert_allclose(W.get_value(), 1)
+    algorithm, W = train('float64')
+    master = algorithm.masters[W]
+    assert master.dtype == 'float64'
+    assert W.dtype == 'float32'
+    assert_allclose(master.get_value(), 1 - 1e-7)
+    assert_allclose(W.get_value(), numpy.float32(1 - 1e-7))
+
+    W.set_value(numpy.zeros(3, dtype='float32'))
+    algorithm.reset_master_copies()
+    assert_allclose(master.get_value(), 0)
+
+
+def test_gradient_descent_loss_scale():
+    def train(loss_scale):
+        W = theano.shared(numpy.ones(2, dtype='float32'))
+        cost = (W * numpy.float32(1e-30)).sum() * numpy.float32(1e-20)
+        algorithm = GradientDescent(cost=cost, params=[W],
+                                    step_rule=Scale(1e40),
+                                    master_dtype='float64',
+                                    loss_scale=loss_scale)
+        algorithm.initialize()
+        algorithm.process_batch(dict())
+        return algorithm.masters[W].get_value()
+
+    assert_allclose(train(None), 1)
+    assert_allclose(train(1e25), 1 - 1e-10)
+
+
+def test_gradient_descent_process_batch():
+    x = tensor.matrix('x')
+    W = shared_floatx(numpy.ones((2, 2)))
+    algorithm = GradientDescent(
+        cost=tensor.dot(x, W).sum(), params=[W], step_rule=Scale(0.5),
+        theano_func_kwargs=dict(mode=theano.Mode(linker='cvm_nogc')))
+    algorithm.initialize()
+
+    x_val = numpy.ones((3, 2), dtype=theano.config.floatX)
+    algorithm.process_batch(dict(x=x_val))
+    assert algorithm._function.trust_input
+    assert_allclose(W.get_value(), -0.5)
+
+    # Data of other types are converted by the function
+    algorithm.process_batch(dict(x=[[1, 1], [1, 1], [1, 1]]))
+    assert not algorithm._function.trust_input
+    assert_allclose(W.get_value(), -2)
+
+    assert_raises(ValueError, algorithm.process_batch, dict(y=x_val))
+    assert_raises(ValueError, algorithm.process_batch,
+                  dict(x=x_val, y=x_val))
+
+
+def test_lbfgs():
+    rng = numpy.random.RandomState(1)
+    x_val = rng.normal(size=(50, 4)).astype(theano.config.floatX)
+    y_val = (x_val.dot([1., -2., 3., 0.5]) + 1 +
+             0.1 * rng.normal(size=50)).astype(theano.config.floatX)
+    x = tensor.matrix('x')
+    y = tensor.vector('y')
+    W = shared_floatx(numpy.zeros(4))
+    b = shared_floatx(0.)
+    cost = tensor.sqr(tensor.dot(x, W) + b - y).mean()
+    algorithm = LBFGS(cost=cost, params=[W, b], history=5)
+    counter = shared_floatx(0.)
+    algorithm.add_updates([(counter, counter + 1)])
+    algorithm.initialize()
+    batch = dict(x=x_val, y=y_val)
+    costs = []
+    for _ in range(15):
+        algorithm.process_batch(batch)
+        costs.append(algorithm.cost_value)
+    assert counter.get_value() == 15
+    assert all(later <= earlier for earlier, later in zip(costs, costs[1:]))
+    solution = numpy.linalg.lstsq(
+        numpy.hstack([x_val, numpy.ones((50, 1))]), y_val)[0]
+    assert_allclose(W.get_value(), solution[:4], rtol=1e-5)
+    assert_allclose(b.get_value(), solution[4], rtol=1e-5)
+    assert len(algorithm._parameter_changes) <= 5
+
+    assert_raises(ValueError, algorithm.process_batch, dict(x=x_val))
+
+    # One iteration of the main loop per step
+    W.set_value(numpy.zeros(4))
+    data_stream = IterableDataset(
+        dict(x=[x_val], y=[y_val])).get_example_stream()
+    main_loop = MainLoop(LBFGS(cost=cost, params=[W, b]), data_stream,
+                         extensions=[FinishAfter(after_n_epochs=3)])
+    main_loop.run()
+    assert main_loop.status['iterations_done'] == 3
+    assert main_loop.algorithm.cost_value < costs[0]
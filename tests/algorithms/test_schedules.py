@@ -0,0 +1,96 @@
+import math
+
+import numpy
+import theano
+from numpy.testing import assert_allclose, assert_raises
+from theano import tensor
+
+from blocks.algorithms import AdaGrad, GradientDescent, Momentum, Scale
+from blocks.algorithms.schedules import (
+    CosineDecay, ExponentialDecay, InverseSquareRoot, LinearWarmup,
+    StepDecay, schedule_updates)
+from blocks.utils import shared_floatx
+
+
+def values(schedule, iterations):
+    function = theano.function([], schedule.variable)
+    result = []
+    for iteration in iterations:
+        schedule.iterations.set_value(iteration)
+        result.append(function())
+    return numpy.array(result)
+
+
+def test_step_decay():
+    assert_allclose(values(StepDecay(1., 0.5, 3), range(7)),
+                    [1., 1., 1., 0.5, 0.5, 0.5, 0.25])
+    assert_raises(ValueError, StepDecay, 1., 0.5, 0)
+
+
+def test_exponential_decay():
+    assert_allclose(values(ExponentialDecay(2., 0.5, 2), range(4)),
+                    2. * 0.5 ** (numpy.arange(4) / 2.))
+
+
+def test_cosine_decay():
+    assert_allclose(values(CosineDecay(1., 4, 0.2), [0, 2, 4, 10]),
+                    [1., 0.6, 0.2, 0.2])
+
+
+def test_inverse_square_root():
+    assert_allclose(values(InverseSquareRoot(1., 4), [0, 3, 15]),
+                    [0.25, 1., 0.5])
+    assert_allclose(values(InverseSquareRoot(1.), [0, 3]), [1., 0.5])
+
+
+def test_linear_warmup():
+    schedule = LinearWarmup(StepDecay(1., 0.1, 4), 2)
+    assert_allclose(values(schedule, [0, 1, 3, 4]), [0.5, 1., 1., 0.1])
+    assert schedule.value.iterations not in [
+        counter for counter, _ in schedule_updates([schedule.variable])]
+
+
+def test_schedules_in_gradient_descent():
+    W = shared_floatx(numpy.array([1., 2.]), name='W')
+    cost = tensor.sum(W ** 2)
+    learning_rate = StepDecay(0.1, 0.5, 2)
+    momentum = CosineDecay(0.9, 2)
+    algorithm = GradientDescent(
+        cost=cost, params=[W],
+        step_rule=Momentum(learning_rate=learning_rate, momentum=momentum))
+    algorithm.initialize()
+    for _ in range(3):
+        algorithm.process_batch({})
+    assert learning_rate.iterations.get_value() == 3
+    assert momentum.iterations.get_value() == 3
+
+    W_value = numpy.array([1., 2.])
+    velocity = numpy.zeros(2)
+    for iteration in range(3):
+        rate = 0.1 * 0.5 ** (iteration // 2)
+        beta = 0.45 * (1 + math.cos(math.pi * min(iteration, 2) / 2))
+        velocity = beta * velocity + rate * 2 * W_value
+        W_value = W_value - velocity
+    assert_allclose(W.get_value(), W_value)
+
+
+def test_schedule_shared_by_step_rules():
+    W = shared_floatx(numpy.array([1., 2.]), name='W')
+    V = shared_floatx(numpy.array([3.]), name='V')
+    learning_rate = ExponentialDecay(0.1, 0.5)
+    algorithm = GradientDescent(
+        cost=tensor.sum(W ** 2) + tensor.sum(V ** 2), params=[W, V],
+        step_rule=AdaGrad(learning_rate=learning_rate))
+    algorithm.initialize()
+    algorithm.process_batch({})
+    algorithm.process_batch({})
+    assert learning_rate.iterations.get_value() == 2
+
+    W = shared_floatx(numpy.array([1., 2.]), name='W')
+    algorithm = GradientDescent(cost=tensor.sum(W ** 2), params=[W],
+                                step_rule=Scale(learning_rate=StepDecay(
+                                    0.25, 0., 1)))
+    algorithm.initialize()
+    algorithm.process_batch({})
+    algorithm.process_batch({})
+    assert_allclose(W.get_value(), [0.5, 1.])
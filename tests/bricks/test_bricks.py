@@ -349,6 +349,24 @@ def test_mlp():
     assert mlp.rng == mlp.linear_transformations[0].rng
 
 
+def test_param_dtype():
+    x = tensor.fmatrix()
+    x_val = numpy.random.rand(2, 16).astype('float32')
+    mlp = MLP(activations=[Tanh(), None], dims=[16, 8, 4],
+              weights_init=Constant(1), biases_init=Constant(1),
+              param_dtype='float32')
+    y = mlp.apply(x)
+    mlp.initialize()
+    assert all(param.dtype == 'float32' for param in mlp.children[0].params)
+    assert all(param.dtype == 'float32'
+               for param in mlp.linear_transformations[1].params)
+    assert y.dtype == 'float32'
+    assert_allclose(
+        numpy.tanh(x_val.dot(numpy.ones((16, 8))) + numpy.ones((2, 8))).dot(
+            numpy.ones((8, 4))) + numpy.ones((2, 4)),
+        y.eval({x: x_val}), rtol=1e-06)
+
+
 def test_mlp_apply():
     x = tensor.matrix()
     x_val = numpy.random.rand(2, 16).astype(theano.config.floatX)
@@ -3,11 +3,13 @@ import unittest
 
 import numpy
 import theano
-from numpy.testing import assert_allclose
+from numpy.testing import assert_allclose, assert_raises
+from picklable_itertools.extras import equizip
 from theano import tensor
 from theano.gof.graph import is_same_graph
+from theano.sandbox.rng_mrg import MRG_RandomStreams
 
-from blocks.utils import is_shared_variable
+from blocks.utils import is_shared_variable, shared_floatx
 from blocks.bricks.base import application
 from blocks.bricks import Tanh
 from blocks.bricks.recurrent import (
@@ -45,6 +47,47 @@ class RecurrentWrapperTestClass(BaseRecurrent):
         return outputs, next_states_2, outputs_2, next_states
 
 
+class NoisyRecurrent(BaseRecurrent):
+    def __init__(self, dim, **kwargs):
+        super(NoisyRecurrent, self).__init__(**kwargs)
+        self.dim = dim
+
+    def get_dim(self, name):
+        if name in ['inputs', 'states']:
+            return self.dim
+        return super(NoisyRecurrent, self).get_dim(name)
+
+    @recurrent(sequences=['inputs'], states=['states'], outputs=['states'],
+               contexts=[])
+    def apply(self, inputs=None, states=None):
+        noise = MRG_RandomStreams(1).uniform(states.shape,
+                                             dtype=theano.config.floatX)
+        return states + inputs + noise
+
+
+class CountingRecurrent(BaseRecurrent):
+    def get_dim(self, name):
+        if name == 'states':
+            return 2
+        return super(CountingRecurrent, self).get_dim(name)
+
+    @recurrent(sequences=[], states=['states'], outputs=['states'],
+               contexts=[])
+    def apply(self, states):
+        return states + 1
+
+
+def test_unroll_without_sequences():
+    brick = CountingRecurrent()
+    states = brick.apply(n_steps=3, batch_size=2, unroll=4)
+    assert_allclose(states.eval(),
+                    numpy.arange(1, 4)[:, None, None] * numpy.ones((3, 2, 2)))
+    assert_raises(ValueError, brick.apply, n_steps=5, batch_size=2,
+                  unroll=4)
+    assert_raises(ValueError, brick.apply, n_steps=tensor.iscalar(),
+                  batch_size=2, unroll=4)
+
+
 class TestRecurrentWrapper(unittest.TestCase):
     def setUp(self):
         self.recurrent_example = RecurrentWrapperTestClass(dim=1)
@@ -68,6 +111,51 @@ class TestRecurrentWrapper(unittest.TestCase):
         assert_allclose(h2 * 10, out_2_eval)
 
 
+class ProjectingRecurrentTestClass(BaseRecurrent):
+    def __init__(self, **kwargs):
+        super(ProjectingRecurrentTestClass, self).__init__(**kwargs)
+        rng = numpy.random.RandomState(1)
+        self.W_in = shared_floatx(rng.rand(2, 3), name='W_in')
+        self.W_gate = shared_floatx(rng.rand(3, 2), name='W_gate')
+        self.W = shared_floatx(rng.rand(3, 3), name='W')
+
+    def get_dim(self, name):
+        if name == 'states':
+            return 3
+        return super(ProjectingRecurrentTestClass, self).get_dim(name)
+
+    @recurrent(sequences=['inputs'], states=['states'], outputs=['states'],
+               contexts=[])
+    def apply(self, inputs, states):
+        gate = tensor.nnet.sigmoid(tensor.dot(inputs, self.W_gate.T))
+        return tensor.tanh(tensor.dot(inputs, self.W_in) +
+                           gate * tensor.dot(states, self.W) +
+                           tensor.dot(inputs, self.W_in))
+
+
+def test_hoist_projections():
+    brick = ProjectingRecurrentTestClass()
+    x = tensor.tensor3('x')
+    x_val = numpy.random.RandomState(2).rand(5, 4, 2).astype(
+        theano.config.floatX)
+    params = [brick.W_in, brick.W_gate, brick.W]
+    values = []
+    for hoist in [False, True]:
+        h = brick.apply(x, hoist_projections=hoist)
+        gradients = tensor.grad(h.sum(), params)
+        values.append(theano.function([x], [h] + gradients)(x_val))
+        scan, = [variable.owner for variable in ComputationGraph(h).variables
+                 if variable.owner and isinstance(
+                     variable.owner.op, theano.scan_module.scan_op.Scan)]
+        dots = [node for node in theano.gof.graph.io_toposort(
+                    scan.op.inputs, scan.op.outputs)
+                if isinstance(node.op, tensor.basic.Dot)]
+        # Only the product with the previous states is left in the step
+        assert len(dots) == (1 if hoist else 4)
+    for value, hoisted_value in equizip(*values):
+        assert_allclose(value, hoisted_value, rtol=1e-6)
+
+
 class TestSimpleRecurrent(unittest.TestCase):
     def setUp(self):
         self.simple = SimpleRecurrent(dim=3, weights_init=Constant(2),
@@ -117,6 +205,140 @@ class TestSimpleRecurrent(unittest.TestCase):
         assert is_shared_variable(initial_state)
         assert initial_state.name == 'initial_state'
 
+    def test_checkpoint_every(self):
+        x = tensor.tensor3('x')
+        mask = tensor.matrix('mask')
+        x_val = numpy.random.RandomState(1).rand(7, 2, 3).astype(
+            theano.config.floatX)
+        mask_val = numpy.ones((7, 2), dtype=theano.config.floatX)
+        mask_val[5:, 1] = 0
+        values = []
+        for checkpoint_every in [None, 3]:
+            h = self.simple.apply(x, mask=mask, reverse=True,
+                                  return_initial_states=True,
+                                  checkpoint_every=checkpoint_every)
+            gradients = tensor.grad(h[1:].sum(), list(self.simple.params))
+            values.append(theano.function([x, mask], [h] + gradients)(
+                x_val, mask_val))
+        for value, checkpointed_value in equizip(*values):
+            assert_allclose(value, checkpointed_value, rtol=1e-6)
+
+        # The scans outside the segments iterate over the 4 segments of
+        # 2 steps, and the states they keep are the boundary ones
+        x_val = numpy.random.RandomState(1).rand(8, 2, 3).astype(
+            theano.config.floatX)
+        h = self.simple.apply(x, checkpoint_every=2)
+        gradients = tensor.grad(h.sum(), list(self.simple.params))
+        scans = [node for node in theano.gof.graph.io_toposort(
+                 theano.gof.graph.inputs(gradients), gradients)
+                 if isinstance(node.op, theano.scan_module.scan_op.Scan)]
+        boundaries, = [node.outputs[0] for node in scans
+                       if node.op.name == 'simplerecurrent_apply_scan']
+        values = theano.function(
+            [x], [node.inputs[0] for node in scans] + [boundaries.shape[0]],
+            on_unused_input='ignore')(x_val)
+        assert all(value == 4 for value in values[:-1])
+        assert values[-1] == 5
+
+    def test_unroll(self):
+        x = tensor.tensor3('x')
+        mask = tensor.matrix('mask')
+        x_val = numpy.random.RandomState(1).rand(4, 2, 3).astype(
+            theano.config.floatX)
+        mask_val = numpy.ones((4, 2), dtype=theano.config.floatX)
+        mask_val[3:, 1] = 0
+        values = []
+        for unroll in [None, 4]:
+            h = self.simple.apply(x, mask=mask, reverse=True,
+                                  return_initial_states=True, unroll=unroll)
+            gradients = tensor.grad(h[1:].sum(), list(self.simple.params))
+            values.append(theano.function([x, mask], [h] + gradients)(
+                x_val, mask_val))
+        for value, unrolled_value in equizip(*values):
+            assert_allclose(value, unrolled_value, rtol=1e-6)
+
+        # The variables of every step can be found in the graph
+        h = self.simple.apply(x, mask=mask, unroll=4)
+        cg = ComputationGraph(h)
+        assert not any(isinstance(variable.owner.op,
+                                  theano.scan_module.scan_op.Scan)
+                       for variable in cg.variables if variable.owner)
+        inputs = [variable for variable in
+                  VariableFilter(applications=[self.simple.apply])(
+                      cg.variables)
+                  if getattr(variable.tag, 'name', None) == 'inputs']
+        assert len(inputs) == 4
+        self.assertRaises(ValueError, self.simple.apply, x, unroll=4,
+                          checkpoint_every=2)
+        # Shorter batches are padded, longer ones rejected
+        for reverse in [False, True]:
+            h = self.simple.apply(x, mask=mask, reverse=reverse, unroll=4)
+            h_scan = self.simple.apply(x, mask=mask, reverse=reverse)
+            assert_allclose(
+                theano.function([x, mask], h)(x_val[:3], mask_val[:3]),
+                theano.function([x, mask], h_scan)(x_val[:3], mask_val[:3]),
+                rtol=1e-6)
+        h = self.simple.apply(x, mask=mask, unroll=3)
+        self.assertRaises(Exception, theano.function([x, mask], h),
+                          x_val, mask_val)
+
+    def test_sort_by_length(self):
+        x = tensor.tensor3('x')
+        mask = tensor.matrix('mask')
+        x_val = numpy.random.RandomState(1).rand(5, 4, 3).astype(
+            theano.config.floatX)
+        mask_val = numpy.ones((5, 4), dtype=theano.config.floatX)
+        mask_val[2:, 0] = 0
+        mask_val[4:, 2] = 0
+        mask_val[1:, 3] = 0
+        for reverse in [False, True]:
+            values = []
+            for sort_by_length in [False, True]:
+                h = self.simple.apply(x, mask=mask, reverse=reverse,
+                                      return_initial_states=True,
+                                      sort_by_length=sort_by_length)
+                gradients = tensor.grad(h[1:].sum(),
+                                        list(self.simple.params))
+                mode = theano.compile.get_default_mode().excluding(
+                    'scanOp_pushout_output')
+                values.append(theano.function(
+                    [x, mask], [h] + gradients, mode=mode)(x_val, mask_val))
+            for value, sorted_value in equizip(*values):
+                assert_allclose(value, sorted_value, rtol=1e-6)
+        self.assertRaises(ValueError, self.simple.apply, x,
+                          sort_by_length=True)
+
+    def test_stateful(self):
+        x = tensor.tensor3('x')
+        resets = tensor.vector('resets')
+        x_val = numpy.random.RandomState(1).rand(6, 2, 3).astype(
+            theano.config.floatX)
+        h_val = theano.function([x], self.simple.apply(x))(x_val)
+
+        h = self.simple.apply(x, stateful=True, state_resets=resets)
+        cg = ComputationGraph(h)
+        carried = self.simple.get_carried_state('states')
+        assert list(cg.updates) == [carried]
+        step = theano.function([x, resets], h, updates=cg.updates)
+        no_resets = numpy.zeros(2, dtype=theano.config.floatX)
+        # The second batch continues from the states of the first one
+        assert_allclose(step(x_val[:3], no_resets), h_val[:3], rtol=1e-6)
+        assert_allclose(step(x_val[3:], no_resets), h_val[3:], rtol=1e-6)
+        assert_allclose(carried.get_value(), h_val[-1], rtol=1e-6)
+        # Resetting the first sequence only
+        resets_val = numpy.array([1, 0], dtype=theano.config.floatX)
+        h_first = theano.function([x], self.simple.apply(x))(x_val[:3])
+        h_reset = step(x_val[:3], resets_val)
+        assert_allclose(h_reset[:, 0], h_first[:, 0], rtol=1e-6)
+        assert not numpy.allclose(h_reset[:, 1], h_first[:, 1])
+        # A batch of another size starts from the initial states
+        assert_allclose(step(x_val[:3, :1], no_resets[:1]), h_first[:, :1],
+                        rtol=1e-6)
+        self.simple.reset_carried_states()
+        assert_allclose(step(x_val[:3], no_resets), h_first, rtol=1e-6)
+        self.assertRaises(ValueError, self.simple.apply, x, stateful=True,
+                          reverse=True)
+
 
 class TestLSTM(unittest.TestCase):
     def setUp(self):
@@ -204,6 +426,21 @@ class TestLSTM(unittest.TestCase):
         assert {initial1.name, initial2.name} == {
             'initial_state', 'initial_cells'}
 
+    def test_param_dtype(self):
+        lstm = LSTM(dim=3, weights_init=Constant(2),
+                    biases_init=Constant(0), param_dtype='float32')
+        lstm.initialize()
+        assert all(param.dtype == 'float32' for param in lstm.params)
+        assert lstm.W_state in lstm.params
+        assert lstm.initial_cells in lstm.params
+        assert_allclose(lstm.W_state.get_value(), 2)
+        x = tensor.ftensor3('x')
+        h, c = lstm.apply(x)
+        initial_states = VariableFilter(roles=[INITIAL_STATE])(
+            ComputationGraph(h))
+        assert len(initial_states) == 2
+        assert h.dtype == 'float32'
+
 
 class TestGatedRecurrent(unittest.TestCase):
     def setUp(self):
@@ -321,6 +558,70 @@ class TestBidirectional(unittest.TestCase):
         assert_allclose(h_simple, h_bidir[..., :3], rtol=1e-04)
         assert_allclose(h_simple_rev, h_bidir[::-1, ...,  3:], rtol=1e-04)
 
+    def test_fused(self):
+        x = tensor.tensor3('x')
+        mask = tensor.matrix('mask')
+        self.bidir.children[1].params[0].set_value(
+            2 * self.simple.params[0].get_value())
+        values = []
+        for fused in [False, True]:
+            self.bidir.fused = fused
+            h = self.bidir.apply(x, mask=mask)
+            gradients = tensor.grad(h.sum(), [
+                param for child in self.bidir.children
+                for param in child.params])
+            values.append(theano.function([x, mask], [h] + gradients)(
+                self.x_val, self.mask_val))
+            scans = [variable for variable in ComputationGraph(h).variables
+                     if variable.owner and isinstance(
+                         variable.owner.op, theano.scan_module.scan_op.Scan)]
+            assert len(set(scan.owner for scan in scans)) == (
+                1 if fused else 2)
+        for value, fused_value in equizip(*values):
+            assert_allclose(value, fused_value, rtol=1e-6)
+        application_call = get_application_call(h)
+        assert application_call.inner_inputs
+        assert application_call.inner_outputs
+        self.assertRaises(ValueError, self.bidir.apply, x, mask=mask,
+                          unroll=24)
+
+    def test_fused_gated(self):
+        x = tensor.tensor3('x')
+        gate_x = tensor.tensor3('gate_x')
+        mask = tensor.matrix('mask')
+        rng = numpy.random.RandomState(1)
+        for prototype, inputs, input_dims in [
+                (LSTM(dim=3), [x], [12]),
+                (GatedRecurrent(dim=3), [x, gate_x], [3, 6])]:
+            bidir = Bidirectional(prototype=prototype,
+                                  weights_init=IsotropicGaussian(0.1))
+            bidir.initialize()
+            for param in bidir.children[1].params:
+                param.set_value(2 * param.get_value())
+            input_values = [rng.rand(5, 2, dim).astype(theano.config.floatX)
+                            for dim in input_dims]
+            mask_val = numpy.ones((5, 2), dtype=theano.config.floatX)
+            mask_val[3:, 1] = 0
+            values = []
+            for fused in [False, True]:
+                bidir.fused = fused
+                outputs = bidir.apply(*inputs, mask=mask, as_list=True)
+                gradients = tensor.grad(
+                    sum(output.sum() for output in outputs),
+                    [param for child in bidir.children
+                     for param in child.params])
+                values.append(theano.function(
+                    inputs + [mask], outputs + gradients)(
+                        *(input_values + [mask_val])))
+            for value, fused_value in equizip(*values):
+                assert_allclose(value, fused_value, rtol=1e-5)
+
+    def test_fused_unsupported(self):
+        x = tensor.tensor3('x')
+        bidir = Bidirectional(prototype=NoisyRecurrent(dim=3), fused=True)
+        self.assertRaises(ValueError, bidir.apply, x)
+        self.bidir.fused = True
+        self.assertRaises(ValueError, self.bidir.apply)
 
 def test_saved_inner_graph():
     """Make sure that the original inner graph is saved."""
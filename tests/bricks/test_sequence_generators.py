@@ -59,6 +59,13 @@ def test_sequence_generator():
     assert costs_val.shape == (n_steps, batch_size)
     assert_allclose(costs_val.sum(), 115.593, rtol=1e-5)
 
+    # The costs are the same when the transition is checkpointed
+    generator.checkpoint_every = 4
+    costs = generator.cost_matrix(y, mask)
+    assert_allclose(theano.function([y, mask], costs)(y_test, m_test),
+                    costs_val, rtol=1e-5)
+    generator.checkpoint_every = None
+
     # Test 'cost' method
     cost = generator.cost(y, mask)
     assert cost.ndim == 0
@@ -1,15 +1,22 @@
+import time
+
 import numpy
 import theano
 from fuel.datasets import IterableDataset
-from numpy.testing import assert_allclose
+from numpy.testing import assert_allclose, assert_raises
 from theano import tensor
 
 from blocks.extensions import TrainingExtension, FinishAfter
-from blocks.extensions.monitoring import TrainingDataMonitoring
+from blocks.extensions.monitoring import (DataStreamMonitoring,
+                                          PaddingMonitoring,
+                                          TrainingDataMonitoring)
 from blocks.monitoring import aggregation
+from blocks.monitoring.aggregation import MonitoredQuantity
 from blocks.algorithms import GradientDescent, Scale
 from blocks.utils import shared_floatx, named_copy
 from blocks.main_loop import MainLoop
+from blocks.transformers import Bucketing
+from tests import MockAlgorithm
 
 
 def test_training_data_monitoring():
@@ -66,3 +73,191 @@ def test_training_data_monitoring():
         main_loop.log[n_batches]['train2_W_sum'],
         sum([main_loop.log[i]['train1_W_sum']
              for i in range(1, n_batches + 1)]) / n_batches)
+
+
+def test_data_stream_monitoring_cache():
+    features = [numpy.array(f, dtype=theano.config.floatX)
+                for f in [[1, 2], [3, 4], [5, 6]]]
+    dataset = IterableDataset(dict(features=features))
+
+    x = tensor.vector('features')
+    W = shared_floatx([1, -1], name='W')
+    cost = named_copy((x * W).sum() ** 2, 'cost')
+
+    monitoring = DataStreamMonitoring([cost], dataset.get_example_stream(),
+                                      prefix='valid', cache=True,
+                                      after_batch=True)
+    main_loop = MainLoop(
+        model=None, data_stream=dataset.get_example_stream(),
+        algorithm=GradientDescent(cost=cost, params=[W],
+                                  step_rule=Scale(0.001)),
+        extensions=[FinishAfter(after_n_epochs=1), monitoring])
+    main_loop.run()
+
+    assert monitoring.data_stream.cached
+    expected = numpy.mean([(W.get_value() * f).sum() ** 2
+                           for f in features])
+    assert_allclose(main_loop.log.current_row['valid_cost'], expected)
+
+
+def test_data_stream_monitoring_out_of_process():
+    features = [numpy.array(f, dtype=theano.config.floatX)
+                for f in [[1, 2], [3, 4], [5, 6]]]
+    dataset = IterableDataset(dict(features=features))
+
+    x = tensor.vector('features')
+    W = shared_floatx([1, -1], name='W')
+    cost = named_copy((x * W).sum() ** 2, 'cost')
+
+    main_loop = MainLoop(
+        model=None, data_stream=dataset.get_example_stream(),
+        algorithm=GradientDescent(cost=cost, params=[W],
+                                  step_rule=Scale(0.001)),
+        extensions=[
+            FinishAfter(after_n_epochs=2),
+            DataStreamMonitoring([cost], dataset.get_example_stream(),
+                                 prefix='valid', after_batch=True),
+            DataStreamMonitoring([cost], dataset.get_example_stream(),
+                                 prefix='background', after_batch=True,
+                                 out_of_process=True, max_in_flight=2)])
+    main_loop.run()
+
+    for iteration in range(7):
+        row = main_loop.log[iteration]
+        assert_allclose(row['valid_cost'], row['background_cost'])
+
+
+class SlowCount(MonitoredQuantity):
+    def initialize(self):
+        self.count = 0
+
+    def accumulate(self, features):
+        time.sleep(0.5)
+        self.count += 1
+
+    def readout(self):
+        return self.count
+
+
+class FailAfterBatches(TrainingExtension):
+    def after_batch(self, batch):
+        if self.main_loop.status['iterations_done'] == 4:
+            self.failed_at = time.time()
+            raise ValueError
+
+
+def test_data_stream_monitoring_out_of_process_error():
+    features = [numpy.array(f, dtype=theano.config.floatX)
+                for f in [[1, 2], [3, 4], [5, 6]]]
+    dataset = IterableDataset(dict(features=features))
+
+    x = tensor.vector('features')
+    W = shared_floatx([1, -1], name='W')
+    cost = named_copy((x * W).sum() ** 2, 'cost')
+
+    failing = FailAfterBatches()
+    monitoring = DataStreamMonitoring(
+        [SlowCount(requires=[x], name='count')],
+        dataset.get_example_stream(), prefix='background',
+        after_batch=True, out_of_process=True, max_in_flight=10)
+    main_loop = MainLoop(
+        model=None, data_stream=dataset.get_example_stream(),
+        algorithm=GradientDescent(cost=cost, params=[W],
+                                  step_rule=Scale(0.001)),
+        extensions=[FinishAfter(after_n_epochs=2), monitoring, failing])
+    assert_raises(ValueError, main_loop.run)
+    # The queued snapshots, which take 1.5 seconds each, are dropped
+    assert time.time() - failing.failed_at < 1.5
+    assert monitoring._process is None
+
+
+def test_monitoring_coordinator():
+    features = [numpy.array(f, dtype=theano.config.floatX)
+                for f in [[1, 2], [3, 4], [5, 6]]]
+    dataset = IterableDataset(dict(features=features))
+    data_stream = dataset.get_example_stream()
+
+    x = tensor.vector('features')
+    W = shared_floatx([1, -1], name='W')
+    cost = named_copy((x * W).sum() ** 2, 'cost')
+    other_cost = named_copy(abs((x * W).sum()), 'cost')
+    W_sum = named_copy(W.sum(), 'W_sum')
+
+    extensions = [
+        DataStreamMonitoring([cost, W_sum], data_stream, prefix='first',
+                             after_batch=True, share_evaluation=True),
+        DataStreamMonitoring([other_cost, W_sum], data_stream,
+                             prefix='second', after_batch=True,
+                             share_evaluation=True),
+        DataStreamMonitoring([cost], data_stream, prefix='third',
+                             after_epoch=True, share_evaluation=True)]
+    # Sharing is opt-in
+    assert not DataStreamMonitoring([cost], data_stream).share_evaluation
+    main_loop = MainLoop(
+        model=None, data_stream=dataset.get_example_stream(),
+        algorithm=GradientDescent(cost=cost, params=[W],
+                                  step_rule=Scale(0.001)),
+        extensions=[FinishAfter(after_n_epochs=1)] + extensions)
+    main_loop.run()
+
+    coordinator = extensions[0]._coordinator
+    assert all(extension._coordinator is coordinator
+               for extension in extensions)
+    # All extensions are due before the first epoch, the first two after
+    # every batch, and the last one alone after the epoch.
+    assert set(coordinator._evaluators) == set([(0, 1, 2), (0, 1)])
+    assert not extensions[0]._evaluator._compiled
+    values = [(W.get_value() * f).sum() for f in features]
+    row = main_loop.log.current_row
+    assert_allclose(row['first_cost'], numpy.mean(numpy.square(values)))
+    assert_allclose(row['third_cost'], row['first_cost'])
+    assert_allclose(row['second_cost'], numpy.mean(numpy.abs(values)))
+    assert_allclose(row['first_W_sum'], W.get_value().sum())
+    assert_allclose(row['second_W_sum'], W.get_value().sum())
+
+
+def test_data_stream_monitoring_subset():
+    features = [numpy.array(f, dtype=theano.config.floatX)
+                for f in [[1, 2], [3, 4], [5, 6], [7, 8]]]
+    dataset = IterableDataset(dict(features=features))
+
+    x = tensor.vector('features')
+    W = shared_floatx([1, -1], name='W')
+    cost = named_copy((x * W).sum() ** 2, 'cost')
+
+    main_loop = MainLoop(
+        model=None, data_stream=dataset.get_example_stream(),
+        algorithm=GradientDescent(cost=cost, params=[W],
+                                  step_rule=Scale(0.001)),
+        extensions=[
+            FinishAfter(after_n_batches=3),
+            DataStreamMonitoring([cost], dataset.get_example_stream(),
+                                 prefix='valid', after_batch=True,
+                                 max_batches=2, full_evaluation_every=3)])
+    main_loop.run()
+
+    # Before the first epoch and after the first batch on a subset
+    for iteration in [0, 1]:
+        assert 'valid_cost_estimate' in main_loop.log[iteration]
+        assert 'valid_cost_stderr' in main_loop.log[iteration]
+        assert 'valid_cost' not in main_loop.log[iteration]
+    # After the second batch on the whole data
+    assert 'valid_cost_estimate' not in main_loop.log[2]
+    assert 'valid_cost_stderr' not in main_loop.log[2]
+    assert 'valid_cost' in main_loop.log[2]
+
+
+def test_padding_monitoring():
+    features = [numpy.ones(length) for length in [1, 3, 2, 2]]
+    bucketing = Bucketing(IterableDataset(dict(features=features))
+                          .get_example_stream(), batch_size=2)
+    main_loop = MainLoop(
+        model=None, data_stream=bucketing, algorithm=MockAlgorithm(),
+        extensions=[FinishAfter(after_n_epochs=2),
+                    PaddingMonitoring(bucketing, prefix='train')])
+    main_loop.run()
+
+    # The batches are [1, 2] and [2, 3], so 2 of the 10 steps are padding
+    for iteration in [2, 4]:
+        assert_allclose(main_loop.log[iteration]['train_padding_fraction'],
+                        0.2)
@@ -1,4 +1,12 @@
-from blocks.extensions.saveload import Checkpoint
+import os
+import shutil
+import tempfile
+
+from numpy.testing import assert_allclose
+
+from blocks.extensions.saveload import Checkpoint, DEDUPLICATED_BYTES
+from blocks.serialization import ArrayStore, load
+from tests.test_dump import build_main_loop
 
 
 def test_checkpoint_save_separately_paths():
@@ -16,3 +24,33 @@ def test_checkpoint_save_separately_paths():
     expected = {'foo': 'notmodelpath_foo',
                 'bar': 'notmodelpath_bar'}
     assert chkpt.save_separately_filenames('notmodelpath') == expected
+
+
+def test_checkpoint_deduplicate():
+    folder = tempfile.mkdtemp()
+    try:
+        path = os.path.join(folder, 'main_loop.zip')
+        main_loop = build_main_loop()
+        main_loop.extensions.append(
+            Checkpoint(path, save_separately=['model'], use_cpickle=False,
+                       deduplicate=True, after_batch=True))
+        main_loop.run()
+        # The parameters are in the store, but not their values from
+        # the previous checkpoints.
+        stored = os.listdir(os.path.join(folder, 'main_loop_arrays'))
+        for param in main_loop.model.get_params().values():
+            assert ArrayStore.key(param.get_value()) + '.npy' in stored
+        assert len(stored) == len(set(stored))
+        assert main_loop.log.current_row[DEDUPLICATED_BYTES] > 0
+        with open(path, 'rb') as main_loop_file, \
+                open(os.path.join(folder, 'main_loop_model.zip'),
+                     'rb') as model_file:
+            loaded_main_loop = load(main_loop_file)
+            loaded_model = load(model_file)
+        for params in [loaded_main_loop.model.get_params(),
+                       loaded_model.get_params()]:
+            for name, param in main_loop.model.get_params().items():
+                assert_allclose(params[name].get_value(),
+                                param.get_value())
+    finally:
+        shutil.rmtree(folder)
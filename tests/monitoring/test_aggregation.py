@@ -2,10 +2,12 @@ import numpy
 import theano
 from numpy.testing import assert_allclose
 from theano import tensor
+from theano.ifelse import IfElse
 
 from blocks import bricks
 from blocks.bricks.base import application
 from blocks.graph import ComputationGraph
+from blocks.monitoring import aggregation
 from blocks.monitoring.aggregation import mean, Mean
 from blocks.utils import shared_floatx
 
@@ -14,7 +16,7 @@ from fuel.datasets import IndexableDataset
 from fuel.streams import DataStream
 from fuel.schemes import SequentialScheme
 
-from blocks.monitoring.evaluators import DatasetEvaluator
+from blocks.monitoring.evaluators import AggregationBuffer, DatasetEvaluator
 
 
 class TestBrick(bricks.Brick):
@@ -89,3 +91,123 @@ def test_mean_aggregator():
                     numpy.array([8.25, 26.75], dtype=theano.config.floatX))
     assert_allclose(DatasetEvaluator([z]).evaluate(data_stream)['z'],
                     numpy.array([35], dtype=theano.config.floatX))
+
+
+def test_aggregation_schemes():
+    features = numpy.array([[0, 3],
+                            [2, 9],
+                            [2, 4],
+                            [5, 1],
+                            [1, 1]], dtype=theano.config.floatX)
+    dataset = IndexableDataset(OrderedDict([('features', features)]))
+    data_stream = DataStream(dataset,
+                             iteration_scheme=SequentialScheme(5, 2))
+    batches = [features[:2], features[2:4], features[4:]]
+
+    x = tensor.matrix('features')
+    variables = []
+    for name, scheme, variable in [
+            ('sum', aggregation.Sum, x.sum()),
+            ('column_sum', aggregation.Sum, x.sum(axis=0)),
+            ('count', aggregation.Count, x.copy()),
+            ('max', aggregation.Max, x.max()),
+            ('column_min', aggregation.Min, x.min(axis=0)),
+            ('average', aggregation.ExponentialMovingAverage, x.mean()),
+            ('column_average', aggregation.ExponentialMovingAverage,
+             x.mean(axis=0))]:
+        variable.name = name
+        variable.tag.aggregation_scheme = scheme(variable)
+        variables.append(variable)
+
+    # Evaluate twice to check the initialization
+    for _ in range(2):
+        values = DatasetEvaluator(variables).evaluate(data_stream)
+        assert_allclose(values['sum'], features.sum())
+        assert_allclose(values['column_sum'], features.sum(axis=0))
+        assert values['count'] == 5
+        assert_allclose(values['max'], 9)
+        assert_allclose(values['column_min'], features.min(axis=0))
+        average = 0
+        column_average = 0
+        for batch in batches:
+            average = 0.9 * average + 0.1 * batch.mean()
+            column_average = 0.9 * column_average + 0.1 * batch.mean(axis=0)
+        assert_allclose(values['average'], average / (1 - 0.9 ** 3))
+        assert_allclose(values['column_average'],
+                        column_average / (1 - 0.9 ** 3))
+
+
+def test_packed_accumulators():
+    x = tensor.matrix('features')
+    variables = [mean(x.sum(), x.shape[0]), mean((x ** 2).sum(), x.shape[0])]
+    for i, variable in enumerate(variables):
+        variable.name = 'variable_{}'.format(i)
+    buffer_ = AggregationBuffer(variables)
+    # One buffer for the numerators, another one for the denominators
+    assert len(buffer_.accumulation_updates) == 2
+    accumulate = theano.function([x], [],
+                                 updates=buffer_.accumulation_updates)
+    assert not any(isinstance(node.op, IfElse)
+                   for node in accumulate.maker.fgraph.toposort())
+
+    buffer_.initialize_aggregators()
+    accumulate(numpy.ones((2, 3), dtype=theano.config.floatX))
+    accumulate(2 * numpy.ones((1, 3), dtype=theano.config.floatX))
+    values = buffer_.get_aggregated_values()
+    assert_allclose(values['variable_0'], 4.)
+    assert_allclose(values['variable_1'], 6.)
+
+
+def test_histogram_and_quantiles():
+    values = numpy.random.RandomState(1).normal(
+        size=(1000, 3)).astype(theano.config.floatX)
+    dataset = IndexableDataset(OrderedDict([('features', values)]))
+    data_stream = DataStream(dataset,
+                             iteration_scheme=SequentialScheme(1000, 300))
+
+    x = tensor.matrix('features')
+    histogram = x.copy()
+    histogram.name = 'histogram'
+    histogram.tag.aggregation_scheme = aggregation.Histogram(
+        histogram, bounds=(-3, 3), bins=6)
+    quantiles = x.copy()
+    quantiles.name = 'quantiles'
+    quantiles.tag.aggregation_scheme = aggregation.Quantiles(
+        quantiles, bounds=(-5, 5), quantiles=(0.1, 0.5, 0.9), bins=500)
+
+    results = DatasetEvaluator([histogram, quantiles]).evaluate(data_stream)
+    counts, _ = numpy.histogram(numpy.clip(values, -3, 3), bins=6,
+                                range=(-3, 3))
+    assert_allclose(results['histogram'], counts)
+    assert_allclose(results['quantiles'],
+                    numpy.percentile(values, [10, 50, 90]), atol=0.02)
+
+
+def test_histogram_non_finite_values():
+    values = numpy.array([[numpy.nan, -numpy.inf, numpy.inf],
+                          [0.5, numpy.nan, 1.5]], dtype=theano.config.floatX)
+    dataset = IndexableDataset(OrderedDict([('features', values)]))
+    data_stream = DataStream(dataset,
+                             iteration_scheme=SequentialScheme(2, 1))
+
+    x = tensor.matrix('features')
+    histogram = x.copy()
+    histogram.name = 'histogram'
+    histogram.tag.aggregation_scheme = aggregation.Histogram(
+        histogram, bounds=(0, 2), bins=2)
+
+    quantiles = x.copy()
+    quantiles.name = 'quantiles'
+    quantiles.tag.aggregation_scheme = aggregation.Quantiles(
+        quantiles, bounds=(0, 2), quantiles=(0.5,), bins=2)
+
+    results = DatasetEvaluator([histogram]).evaluate(data_stream)
+    assert_allclose(results['histogram'], [2, 2])
+
+    # The quantiles of no counted values are not defined
+    nan_stream = DataStream(
+        IndexableDataset(OrderedDict([('features', numpy.nan *
+                                       numpy.ones_like(values))])),
+        iteration_scheme=SequentialScheme(2, 1))
+    results = DatasetEvaluator([quantiles]).evaluate(nan_stream)
+    assert numpy.all(numpy.isnan(results['quantiles']))
@@ -1,10 +1,26 @@
+import os
+import pickle
+import shutil
+import signal
+import tempfile
+from collections import OrderedDict
+
 import numpy
 import theano
-from fuel.datasets import IterableDataset
-from numpy.testing import assert_raises
+from fuel.datasets import IndexableDataset, IterableDataset
+from fuel.schemes import SequentialScheme
+from fuel.streams import DataStream
+from numpy.testing import assert_allclose, assert_raises
 
+from blocks.bricks import Identity
+from blocks.bricks.recurrent import SimpleRecurrent
 from blocks.graph import ComputationGraph
-from blocks.monitoring.evaluators import DatasetEvaluator
+from blocks.initialization import Constant
+from blocks.monitoring import aggregation
+from blocks.monitoring.aggregation import MonitoredQuantity
+from blocks.monitoring.evaluators import (CachedDataStream, DatasetEvaluator,
+                                          _evaluate_shard)
+from blocks.monitoring.quantities import Sum
 from tests.monitoring.test_aggregation import TestBrick
 
 
@@ -32,3 +48,297 @@ def test_dataset_evaluators():
         data_stream = IterableDataset(dict(X2=data)).get_example_stream()
         validator.evaluate(data_stream)
     assert "Not all data sources" in ar.exception.args[0]
+
+
+def test_dataset_evaluator_keeps_carried_states():
+    x = theano.tensor.tensor3('x')
+    recurrent = SimpleRecurrent(dim=2, activation=Identity(),
+                                weights_init=Constant(1))
+    recurrent.initialize()
+    h = recurrent.apply(x, stateful=True)
+    mean_h = h.mean()
+    mean_h.name = 'mean_h'
+    carried = recurrent.get_carried_state('states')
+    updates = ComputationGraph(mean_h).updates
+    assert list(updates) == [carried]
+
+    data = [numpy.ones((3, 1, 2), dtype=theano.config.floatX)]
+    evaluator = DatasetEvaluator([mean_h], updates=updates)
+    evaluator.evaluate(IterableDataset(dict(x=data)).get_example_stream())
+    assert carried.get_value().shape == (0, 2)
+
+
+def test_cached_data_stream():
+    data = [numpy.arange(4, dtype=theano.config.floatX).reshape(2, 2),
+            numpy.arange(6, dtype=theano.config.floatX).reshape(3, 2),
+            numpy.arange(3, dtype=theano.config.floatX).reshape(1, 3)]
+    y = [numpy.arange(len(X)) for X in data]
+    data_stream = IterableDataset(
+        OrderedDict([('X', data), ('y', y)])).get_example_stream()
+
+    def check(cached_stream):
+        epoch = list(cached_stream.get_epoch_iterator(as_dict=True))
+        assert len(epoch) == 3
+        for batch, X, y_ in zip(epoch, data, y):
+            assert_allclose(batch['X'], X)
+            assert_allclose(batch['y'], y_)
+
+    cached_stream = CachedDataStream(data_stream)
+    check(cached_stream)
+    assert cached_stream.cached
+    check(cached_stream)
+
+    cached_stream = CachedDataStream(data_stream, memory_limit=50)
+    check(cached_stream)
+    assert not cached_stream.cached and cached_stream.streaming
+    check(cached_stream)
+
+    folder = tempfile.mkdtemp()
+    try:
+        cached_stream = CachedDataStream(data_stream, path=folder)
+        check(cached_stream)
+        directory, = os.listdir(folder)
+        assert set(os.listdir(os.path.join(folder, directory))) == set(
+            ['X.dat', 'y.dat'])
+        batch = next(cached_stream.get_epoch_iterator())
+        assert isinstance(batch[0], numpy.memmap)
+        check(pickle.loads(pickle.dumps(cached_stream)))
+
+        # Another data stream with the same sources is cached separately
+        other_data = [X + 100 for X in data]
+        other_stream = CachedDataStream(IterableDataset(
+            OrderedDict([('X', other_data), ('y', y)])).get_example_stream(),
+            path=folder)
+        list(other_stream.get_epoch_iterator())
+        assert len(os.listdir(folder)) == 2
+        check(cached_stream)
+        for batch, X in zip(other_stream.get_epoch_iterator(), other_data):
+            assert_allclose(batch[0], X)
+
+        # The memory limit only applies to a cache kept in memory
+        cached_stream = CachedDataStream(data_stream, memory_limit=50,
+                                         path=folder)
+        check(cached_stream)
+        assert cached_stream.cached
+        check(cached_stream)
+        assert len(os.listdir(folder)) == 2
+
+        # The files of abandoned recordings and of unused data streams
+        # are deleted
+        del cached_stream, other_stream
+        assert not os.listdir(folder)
+        cached_stream = CachedDataStream(data_stream, path=folder)
+        iterator = cached_stream.get_epoch_iterator()
+        next(iterator)
+        assert len(os.listdir(folder)) == 1
+        iterator.close()
+        assert not os.listdir(folder) and not cached_stream.cached
+        check(cached_stream)
+        assert cached_stream.cached
+    finally:
+        shutil.rmtree(folder)
+
+
+class ReusingDataStream(object):
+    """A data stream that writes every batch into the same array."""
+    sources = ('X',)
+
+    def get_epoch_iterator(self):
+        buffer_ = numpy.zeros(2, dtype=theano.config.floatX)
+        for i in range(3):
+            buffer_[:] = i
+            yield (buffer_,)
+
+
+def test_cached_data_stream_copies_batches():
+    cached_stream = CachedDataStream(ReusingDataStream())
+    for _ in range(2):
+        for i, (X,) in enumerate(cached_stream.get_epoch_iterator()):
+            assert_allclose(X, [i, i])
+        assert cached_stream.cached
+
+
+def test_dataset_evaluator_subset():
+    x = theano.tensor.vector('x')
+    mean_x = x.mean()
+    mean_x.name = 'mean_x'
+    evaluator = DatasetEvaluator([mean_x])
+    data = [numpy.array([i, i + 1], dtype=theano.config.floatX)
+            for i in range(20)]
+    data_stream = IterableDataset(dict(x=data)).get_example_stream()
+
+    values = evaluator.evaluate(data_stream, max_batches=5)
+    assert 'mean_x' not in values
+    batch_means = [batch.mean() for batch in data[:5]]
+    assert_allclose(values['mean_x_estimate'], numpy.mean(batch_means))
+    stderr = numpy.std(batch_means, ddof=1) / numpy.sqrt(5)
+    assert_allclose(values['mean_x_stderr'], stderr)
+    assert_allclose(values['mean_x_ci_low'],
+                    values['mean_x_estimate'] - 1.96 * stderr)
+    assert_allclose(values['mean_x_ci_high'],
+                    values['mean_x_estimate'] + 1.96 * stderr)
+
+    first = evaluator.evaluate(data_stream, max_batches=5, seed=3)
+    second = evaluator.evaluate(data_stream, max_batches=5, seed=3)
+    assert first == second
+    assert first['mean_x_estimate'] != values['mean_x_estimate']
+
+    # Only the data of the chosen batches is requested
+    features = numpy.arange(10, dtype=theano.config.floatX)
+    dataset = RecordingDataset(OrderedDict([('x', features)]))
+    values = evaluator.evaluate(
+        DataStream(dataset, iteration_scheme=SequentialScheme(10, 2)),
+        max_batches=2, seed=3)
+    assert len(dataset.requests) == 2
+    assert_allclose(values['mean_x_estimate'],
+                    numpy.mean([features[request].mean()
+                                for request in dataset.requests]))
+
+    values = evaluator.evaluate(data_stream, max_seconds=0)
+    assert_allclose(values['mean_x_estimate'], data[0].mean())
+    assert numpy.isnan(values['mean_x_stderr'])
+
+    empty_stream = IterableDataset(dict(x=[])).get_example_stream()
+    values = evaluator.evaluate(empty_stream, max_batches=5)
+    assert numpy.isnan(values['mean_x_estimate'])
+
+    # Sums and other extensive values can not be estimated on a subset
+    sum_x = x.sum()
+    sum_x.name = 'sum_x'
+    sum_x.tag.aggregation_scheme = aggregation.Sum(sum_x)
+    for variable in [sum_x, Sum(requires=[x], name='quantity_sum')]:
+        assert_raises(ValueError,
+                      DatasetEvaluator([mean_x, variable]).evaluate,
+                      data_stream, max_batches=2)
+
+
+def test_dataset_evaluator_in_parallel():
+    features = numpy.arange(14, dtype=theano.config.floatX).reshape(7, 2)
+    features[3, 1] = 100
+    dataset = IndexableDataset(OrderedDict([('features', features)]))
+    data_stream = DataStream(dataset,
+                             iteration_scheme=SequentialScheme(7, 2))
+
+    x = theano.tensor.matrix('features')
+    variables = []
+    for name, scheme, variable in [
+            ('sum', aggregation.Sum, x.sum()),
+            ('column_sum', aggregation.Sum, x.sum(axis=0)),
+            ('count', aggregation.Count, x.copy()),
+            ('max', aggregation.Max, x.max()),
+            ('column_min', aggregation.Min, x.min(axis=0)),
+            ('last', aggregation.TakeLast, x.sum())]:
+        variable.name = name
+        variable.tag.aggregation_scheme = scheme(variable)
+        variables.append(variable)
+    mean = x.mean()
+    mean.name = 'mean'
+    variables.append(mean)
+    variables.append(Sum(requires=[x], name='quantity_sum'))
+    evaluator = DatasetEvaluator(variables)
+
+    sequential = evaluator.evaluate(data_stream)
+    for num_workers in [2, 5]:
+        parallel = evaluator.evaluate(data_stream, num_workers=num_workers)
+        assert set(parallel) == set(sequential)
+        for name in sequential:
+            assert_allclose(parallel[name], sequential[name])
+    assert_allclose(sequential['max'], 100)
+    assert sequential['count'] == 7
+    assert_allclose(sequential['last'], features[6].sum())
+
+    # The cache is recorded once, by the parent process
+    folder = tempfile.mkdtemp()
+    try:
+        cached_stream = CachedDataStream(data_stream, path=folder)
+        for _ in range(2):
+            parallel = evaluator.evaluate(cached_stream, num_workers=2)
+            assert cached_stream.cached
+            assert len(os.listdir(folder)) == 1
+            for name in sequential:
+                assert_allclose(parallel[name], sequential[name])
+    finally:
+        shutil.rmtree(folder)
+
+    average = x.mean()
+    average.name = 'average'
+    average.tag.aggregation_scheme = aggregation.ExponentialMovingAverage(
+        average)
+    assert_raises(ValueError, DatasetEvaluator([average]).evaluate,
+                  data_stream, num_workers=2)
+    assert_raises(ValueError, evaluator.evaluate, data_stream,
+                  max_batches=2, num_workers=2)
+
+    # Quantities that can not be merged are rejected before forking
+    class LastQuantity(MonitoredQuantity):
+        def initialize(self):
+            self.last = None
+
+        def accumulate(self, value):
+            self.last = value
+
+        def readout(self):
+            return self.last
+    assert_raises(ValueError, DatasetEvaluator(
+        [LastQuantity(requires=[x], name='last')]).evaluate,
+        data_stream, num_workers=2)
+
+
+class RecordingDataset(IndexableDataset):
+    def __init__(self, *args, **kwargs):
+        super(RecordingDataset, self).__init__(*args, **kwargs)
+        self.requests = []
+
+    def get_data(self, state=None, request=None):
+        self.requests.append(request)
+        return super(RecordingDataset, self).get_data(state, request)
+
+
+class ListQueue(list):
+    put = list.append
+
+
+class KillingQuantity(MonitoredQuantity):
+    mergeable = True
+
+    def initialize(self):
+        pass
+
+    def accumulate(self, value):
+        os.kill(os.getpid(), signal.SIGKILL)
+
+    def readout(self):
+        pass
+
+    def get_state(self):
+        pass
+
+    def merge_states(self, states):
+        pass
+
+
+def test_dataset_evaluator_shards():
+    features = numpy.arange(14, dtype=theano.config.floatX).reshape(7, 2)
+    dataset = RecordingDataset(OrderedDict([('features', features)]))
+    data_stream = DataStream(dataset,
+                             iteration_scheme=SequentialScheme(7, 2))
+    x = theano.tensor.matrix('features')
+    total = x.sum()
+    total.name = 'total'
+    total.tag.aggregation_scheme = aggregation.Sum(total)
+    evaluator = DatasetEvaluator([total])
+
+    # A worker only requests the data of its own batches
+    results = ListQueue()
+    _evaluate_shard(evaluator, data_stream, 1, 2, results)
+    assert dataset.requests == [[2, 3], [6]]
+    (worker, state, last_batch, error), = results
+    assert (worker, last_batch, error) == (1, 3, None)
+    evaluator.merge_states([state])
+    assert_allclose(evaluator.get_aggregated_values()['total'],
+                    features[[2, 3, 6]].sum())
+
+    # A worker killed before it sends its results is an error
+    evaluator = DatasetEvaluator([KillingQuantity(requires=[x],
+                                                  name='killing')])
+    assert_raises(Exception, evaluator.evaluate, data_stream, num_workers=2)
@@ -1,9 +1,13 @@
 import numpy
 import theano
 from fuel.datasets import IterableDataset
+from numpy.testing import assert_allclose
+from theano import tensor
 
 from blocks.monitoring.evaluators import DatasetEvaluator
 from blocks.monitoring.aggregation import MonitoredQuantity
+from blocks.monitoring.quantities import (ConfusionMatrix, Count, Sum,
+                                          TopKAccuracy)
 from blocks.bricks.cost import CategoricalCrossEntropy
 
 
@@ -44,3 +48,53 @@ def test_dataset_evaluators():
     numpy.testing.assert_allclose(
         values['monitored_cross_entropy1'],
         values['categoricalcrossentropy_apply_cost'])
+
+
+def test_numpy_quantities():
+    targets = tensor.lvector('targets')
+    scores = tensor.matrix('scores')
+    probabilities = tensor.nnet.softmax(scores)
+
+    rng = numpy.random.RandomState(1)
+    all_scores = rng.uniform(size=(10, 4)).astype(theano.config.floatX)
+    all_targets = rng.randint(4, size=10)
+    data_stream = IterableDataset(dict(
+        scores=numpy.split(all_scores, [3, 7]),
+        targets=numpy.split(all_targets, [3, 7]))).get_example_stream()
+
+    validator = DatasetEvaluator([
+        Sum(requires=[scores], name='sum'),
+        Count(requires=[targets], name='count'),
+        ConfusionMatrix(4, requires=[targets, probabilities],
+                        name='confusion'),
+        TopKAccuracy(2, requires=[targets, scores], name='top_2')])
+    values = validator.evaluate(data_stream)
+
+    assert_allclose(values['sum'], all_scores.sum(), rtol=1e-5)
+    assert values['count'] == 10
+    confusion = numpy.zeros((4, 4))
+    for target, guess in zip(all_targets, all_scores.argmax(axis=1)):
+        confusion[target, guess] += 1
+    assert_allclose(values['confusion'], confusion)
+    top_2 = numpy.argsort(-all_scores, axis=1)[:, :2]
+    assert_allclose(values['top_2'],
+                    numpy.mean([target in guesses for target, guesses
+                                in zip(all_targets, top_2)]))
+
+
+def test_confusion_matrix_small_integer_labels():
+    confusion = ConfusionMatrix(20, requires=[tensor.bvector('targets'),
+                                              tensor.bvector('predictions')])
+    confusion.initialize()
+    confusion.accumulate(numpy.array([19, 19, 3], dtype='uint8'),
+                         numpy.array([5, 19, 3], dtype='uint8'))
+    expected = numpy.zeros((20, 20))
+    expected[19, 5] = expected[19, 19] = expected[3, 3] = 1
+    assert_allclose(confusion.readout(), expected)
+
+
+def test_top_k_accuracy_without_examples():
+    top_2 = TopKAccuracy(2, requires=[tensor.lvector('targets'),
+                                      tensor.matrix('scores')])
+    top_2.initialize()
+    assert numpy.isnan(top_2.readout())
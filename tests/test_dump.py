@@ -1,9 +1,23 @@
+import os
 import tempfile
 
 import numpy
+import theano
+from fuel.datasets import IterableDataset
+from numpy.testing import assert_allclose, assert_raises
 from picklable_itertools.extras import equizip
+from theano import tensor
 
-from blocks.dump import load_parameter_values, save_parameter_values
+from blocks.algorithms import GradientDescent, Momentum
+from blocks.bricks import Linear
+from blocks.dump import (load_parameter_values, save_parameter_values,
+                         get_algorithm_state, MainLoopDumpManager)
+from blocks.extensions import FinishAfter
+from blocks.extensions.saveload import Dump
+from blocks.initialization import Constant
+from blocks.main_loop import MainLoop
+from blocks.model import Model
+from blocks.scripts import continue_training
 
 
 def test_save_load_parameter_values():
@@ -16,3 +30,120 @@ def test_save_load_parameter_values():
     for old, new in equizip(param_values, loaded_values):
         assert old[0] == new[0]
         assert numpy.all(old[1] == new[1])
+
+
+def build_main_loop(dump_path=None, n_batches=3, master_dtype=None):
+    x = tensor.matrix('features')
+    linear = Linear(input_dim=2, output_dim=1, weights_init=Constant(1),
+                    biases_init=Constant(0),
+                    param_dtype='float32' if master_dtype else None)
+    linear.initialize()
+    cost = tensor.sqr(linear.apply(x)).sum()
+    features = [numpy.array([[1, 2]], dtype=theano.config.floatX),
+                numpy.array([[3, 4]], dtype=theano.config.floatX)]
+    extensions = [FinishAfter(after_n_batches=n_batches)]
+    if dump_path:
+        extensions.append(Dump(dump_path))
+    return MainLoop(
+        GradientDescent(cost=cost, params=[linear.W, linear.b],
+                        step_rule=Momentum(0.01, 0.9),
+                        master_dtype=master_dtype),
+        IterableDataset(dict(features=features)).get_example_stream(),
+        model=Model(cost), extensions=extensions)
+
+
+def test_dump_algorithm_state():
+    dump_path = os.path.join(tempfile.mkdtemp(), 'dump')
+    main_loop = build_main_loop(dump_path)
+    main_loop.run()
+    velocities = [variable.get_value() for variable
+                  in get_algorithm_state(main_loop.algorithm)]
+    assert len(velocities) == 2
+    assert numpy.all(velocities[0] != 0)
+
+    new_main_loop = build_main_loop()
+    MainLoopDumpManager(dump_path).load_to(new_main_loop)
+    for old, new in equizip(velocities,
+                            get_algorithm_state(new_main_loop.algorithm)):
+        assert_allclose(old, new.get_value())
+    for old, new in equizip(main_loop.model.get_params().values(),
+                            new_main_loop.model.get_params().values()):
+        assert_allclose(old.get_value(), new.get_value())
+    assert new_main_loop.log.status['iterations_done'] == 3
+
+
+def test_continue_training_from_dump():
+    dump_path = os.path.join(tempfile.mkdtemp(), 'dump')
+    build_main_loop(dump_path).run()
+
+    def factory():
+        return build_main_loop(dump_path, n_batches=5)
+    continue_training(dump_path, factory)
+    main_loop = build_main_loop()
+    MainLoopDumpManager(dump_path).load_to(main_loop)
+    assert main_loop.log.status['iterations_done'] == 5
+    assert main_loop.log.status['epochs_done'] == 2
+
+
+def test_continue_training_with_master_copies():
+    main_loops = []
+
+    def factory(dump_path=None):
+        main_loops.append(build_main_loop(dump_path, n_batches=5,
+                                          master_dtype='float64'))
+        return main_loops[-1]
+    factory().run()
+    dump_path = os.path.join(tempfile.mkdtemp(), 'dump')
+    build_main_loop(dump_path, master_dtype='float64').run()
+    continue_training(dump_path, factory)
+    for expected, param in equizip(main_loops[0].algorithm.params,
+                                   main_loops[1].algorithm.params):
+        assert param.dtype == 'float32'
+        assert_allclose(param.get_value(), expected.get_value(), rtol=1e-5)
+
+    # Parameters loaded after the initialization are copied as well
+    main_loop = main_loops[1]
+    param = main_loop.algorithm.params[0]
+    param.set_value(numpy.zeros_like(param.get_value()))
+    MainLoopDumpManager(dump_path).load_to(main_loop)
+    assert_allclose(main_loop.algorithm.masters[param].get_value(),
+                    param.get_value())
+
+
+def test_dump_master_copies():
+    dump_path = os.path.join(tempfile.mkdtemp(), 'dump')
+    main_loop = build_main_loop(dump_path, master_dtype='float64')
+    main_loop.run()
+    masters = [master.get_value() for master
+               in main_loop.algorithm.masters.values()]
+    assert any(numpy.any(master != master.astype('float32'))
+               for master in masters)
+
+    # The master copies keep their precision when training is resumed
+    new_main_loop = build_main_loop(master_dtype='float64')
+    MainLoopDumpManager(dump_path).load_to(new_main_loop)
+    new_main_loop.algorithm.initialize()
+    for old, new in equizip(masters,
+                            new_main_loop.algorithm.masters.values()):
+        assert new.dtype == 'float64'
+        assert numpy.all(old == new.get_value())
+
+
+def test_load_algorithm_state_by_name():
+    dump_path = os.path.join(tempfile.mkdtemp(), 'dump')
+    main_loop = build_main_loop(dump_path)
+    main_loop.run()
+    velocities = dict((variable.name, variable.get_value()) for variable
+                      in get_algorithm_state(main_loop.algorithm))
+    assert len(velocities) == 2
+
+    # The values are matched by name, whatever the order of the variables
+    new_main_loop = build_main_loop()
+    new_main_loop.algorithm.step_rule_updates.reverse()
+    MainLoopDumpManager(dump_path).load_to(new_main_loop)
+    for variable in get_algorithm_state(new_main_loop.algorithm):
+        assert_allclose(variable.get_value(), velocities[variable.name])
+
+    new_main_loop.algorithm.step_rule_updates[0][0].name = 'velocity'
+    assert_raises(ValueError, MainLoopDumpManager(dump_path).load_to,
+                  new_main_loop)
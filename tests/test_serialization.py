@@ -0,0 +1,138 @@
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+from tempfile import NamedTemporaryFile
+
+import numpy
+from numpy.testing import assert_allclose
+from theano import tensor
+
+from blocks.extensions import FinishAfter
+from blocks.extensions.saveload import Checkpoint
+from blocks.serialization import (ArrayStore, dump, load, pickle_dump,
+                                  secure_dump)
+from blocks.utils import shared_floatx
+from tests import MockMainLoop
+from tests.test_dump import build_main_loop
+
+
+def test_serialization_deep_graph():
+    x = tensor.vector('x')
+    W = shared_floatx(numpy.ones(3), name='W')
+    y = x
+    for _ in range(3 * sys.getrecursionlimit()):
+        y = y + W
+    with NamedTemporaryFile() as f:
+        dump((x, y), f)
+        f.seek(0)
+        x_loaded, y_loaded = load(f)
+    depth = 0
+    while y_loaded.owner:
+        y_loaded, W_loaded = y_loaded.owner.inputs
+        assert_allclose(W_loaded.get_value(), W.get_value())
+        depth += 1
+    assert y_loaded is x_loaded
+    assert depth == 3 * sys.getrecursionlimit()
+
+
+class CountingPickles(object):
+    pickled = 0
+
+    def __reduce__(self):
+        CountingPickles.pickled += 1
+        return CountingPickles, ()
+
+
+def test_serialization_pickles_nodes_once():
+    x = tensor.vector('x')
+    y = x + 1
+    x.tag.counter = CountingPickles()
+    with NamedTemporaryFile() as f:
+        CountingPickles.pickled = 0
+        dump((x, y), f)
+        # The state of the nodes is only pickled when written
+        assert CountingPickles.pickled == 1
+        f.seek(0)
+        x_loaded, y_loaded = load(f)
+    assert isinstance(x_loaded.tag.counter, CountingPickles)
+    assert y_loaded.owner.inputs[0] is x_loaded
+
+
+def test_serialization_shared_arrays():
+    array = numpy.arange(10)
+    W = shared_floatx(numpy.ones((2, 2)), name='W')
+    with NamedTemporaryFile() as f:
+        dump({'first': array, 'second': array, 'W': W, 'W_again': W}, f)
+        f.seek(0)
+        arrays = [name for name in zipfile.ZipFile(f).namelist()
+                  if name.startswith('arrays/')]
+        assert len(arrays) == 2
+        f.seek(0)
+        loaded = load(f)
+    assert loaded['first'] is loaded['second']
+    assert_allclose(loaded['first'], array)
+    assert loaded['W'] is loaded['W_again']
+    assert_allclose(loaded['W'].get_value(), W.get_value())
+
+
+def test_serialization_main_loop():
+    main_loop = build_main_loop()
+    main_loop.run()
+    with NamedTemporaryFile() as f:
+        dump(main_loop, f)
+        f.seek(0)
+        loaded = load(f)
+    for old, new in zip(main_loop.model.get_params().values(),
+                        loaded.model.get_params().values()):
+        assert_allclose(old.get_value(), new.get_value())
+    loaded.find_extension('FinishAfter').add_condition(
+        'after_batch',
+        predicate=lambda log: log.status['iterations_done'] == 5)
+    loaded.run()
+    assert loaded.log.status['iterations_done'] == 5
+
+
+def test_load_pickled():
+    with NamedTemporaryFile() as f:
+        pickle_dump({'a': 1}, f)
+        f.seek(0)
+        assert load(f) == {'a': 1}
+
+
+def test_checkpoint_without_cpickle():
+    with NamedTemporaryFile() as dst:
+        main_loop = MockMainLoop(
+            extensions=[FinishAfter(after_n_epochs=1),
+                        Checkpoint(dst.name, use_cpickle=False)])
+        main_loop.run()
+        with open(dst.name, 'rb') as src:
+            assert load(src).log.status['iterations_done'] == 10
+
+
+def test_array_store():
+    folder = tempfile.mkdtemp()
+    try:
+        array = numpy.arange(10)
+        store = ArrayStore(os.path.join(folder, 'arrays'))
+        paths = [os.path.join(folder, name) for name in ['first', 'second']]
+        for path in paths:
+            secure_dump({'array': array, 'copy': array.copy()}, path,
+                        array_store=store)
+        assert os.listdir(store.path) == [store.key(array) + '.npy']
+        assert store.bytes_written == array.nbytes
+        assert store.bytes_saved == 3 * array.nbytes
+        for path in paths:
+            with open(path, 'rb') as f:
+                assert_allclose(load(f)['copy'], array)
+
+        store = ArrayStore(store.path)
+        secure_dump(array + 1, paths[0], array_store=store)
+        store.remove_unused()
+        assert os.listdir(store.path) == [store.key(array + 1) + '.npy']
+
+        # A store to which no arrays were added has nothing to remove
+        ArrayStore(os.path.join(folder, 'empty')).remove_unused()
+    finally:
+        shutil.rmtree(folder)
@@ -1,6 +1,8 @@
+import theano
 from numpy.testing import assert_allclose
+from theano import tensor
 
-from blocks.theano_expressions import l2_norm
+from blocks.theano_expressions import l2_norm, squared_norm
 
 
 def test_l2_norm():
@@ -9,3 +11,17 @@ def test_l2_norm():
     assert_allclose(l2_norm([3, [1, 2]]).eval(), 14.0 ** 0.5)
     assert_allclose(
         l2_norm([3, [1, 2], [[1, 2], [3, 4]]]).eval(), 44.0 ** 0.5)
+
+
+def test_squared_norm():
+    x = tensor.vector('x')
+    y = 2 * x
+    assert squared_norm(y) is squared_norm(y)
+    assert theano.gof.graph.is_same_graph(
+        l2_norm([x, y]), tensor.sqrt(squared_norm(x) + squared_norm(y)))
+
+    # The norm remembered by the original variable is not reused
+    z = tensor.vector('z')
+    y_clone = theano.clone(y, replace={x: z})
+    assert z in theano.gof.graph.inputs([squared_norm(y_clone)])
+    assert_allclose(squared_norm(y_clone).eval({z: [1., 2.]}), 20.)
@@ -0,0 +1,38 @@
+import numpy
+from fuel.datasets import IterableDataset
+from fuel.streams import DataStream
+from numpy.testing import assert_equal, assert_raises
+
+from blocks.transformers import Bucketing
+
+
+def test_bucketing():
+    lengths = [5, 1, 4, 2, 3, 6, 2]
+    features = [numpy.ones((length, 2)) * length for length in lengths]
+    targets = [numpy.arange(length) for length in lengths]
+    stream = DataStream(IterableDataset({'features': features,
+                                         'targets': targets}))
+    bucketing = Bucketing(stream, batch_size=2, buffer_batches=2,
+                          sort_source='targets', mask_sources=('targets',))
+    assert bucketing.sources == ('features', 'targets', 'targets_mask')
+
+    batches = list(bucketing.get_epoch_iterator())
+    # The first four examples are sorted together, the others next
+    assert [batch[2].sum(axis=1).tolist() for batch in batches] == [
+        [1, 2], [4, 5], [2, 3], [6]]
+    assert_equal(batches[0][1], [[0, 0], [0, 1]])
+    assert_equal(batches[0][2], [[1, 0], [1, 1]])
+    assert [len(feature) for feature in batches[1][0]] == [4, 5]
+    assert bucketing.total_elements == 4 + 10 + 6 + 6
+    assert bucketing.padding_elements == 1 + 1 + 1 + 0
+    assert bucketing.padding_fraction == 3 / 26.
+
+    # The statistics are those of the current epoch
+    assert len(list(bucketing.get_epoch_iterator())) == 4
+    assert bucketing.padding_elements == 3
+
+
+def test_bucketing_requires_examples():
+    stream = DataStream(IterableDataset([[1, 2]]))
+    bucketing = Bucketing(stream, batch_size=1)
+    assert_raises(ValueError, Bucketing, bucketing, batch_size=1)